@@ -98,3 +98,10 @@ def CalzettiDust_fn(rfwave,flux,E_BmV):
 
 dust_fn = {'SMC':SMCdust_fn,'CalzettiSB':CalzettiDust_fn}
 
+# the attenuation curves k(lambda) = A_lambda/E(B-V) used by the above
+
+def SMCdust_klam(rfwave):
+	return 1.39*(rfwave/1e4)**-1.2
+
+dust_klam = {'SMC':SMCdust_klam,'CalzettiSB':Calzetti_klam}
+
@@ -145,10 +145,11 @@ forestModels = {'Fan1999':Fan99_model,
                 'Worseck&Prochaska2011':WP11_model,
                 'McGreer+2013':McG13hiz_model}
 
-def generate_los(model,zmin,zmax):
+def generate_los(model,zmin,zmax,rng=np.random):
 	'''Given a model for the distribution of absorption systems, generate
 	   a random line-of-sight populated with absorbers.
 	   returns (z,logNHI,b) for each absorption system.
+	   Random draws are taken from rng [default: the numpy.random module].
 	'''
 	abs_dtype = [('z',np.float32),('logNHI',np.float32),('b',np.float32)]
 	absorbers = []
@@ -168,12 +169,12 @@ def generate_los(model,zmin,zmax):
 		#  (inverting n(z) = N0*(1+z)^gamma)
 		N = (p['N0']/gamma1) * ( (1+z2)**gamma1 - (1+z1)**gamma1 )
 		# sample from a Poisson distribution for <N>
-		n = stats.poisson.rvs(N,size=1)[0]
+		n = stats.poisson.rvs(N,size=1,random_state=rng)[0]
 		# invert the dN/dz CDF to get the sample redshifts
-		x = np.random.random_sample(n)
+		x = rng.random_sample(n)
 		z = (1+z1)*((((1+z2)/(1+z1))**gamma1 - 1)*x + 1)**(1/gamma1) - 1
 		# invert the NHI CDF to get the sample column densities
-		x = np.random.random_sample(n)
+		x = rng.random_sample(n)
 		NHI = NHImin*(1 + x*((NHImax/NHImin)**mbeta1 - 1))**(1/mbeta1)
 		#
 		try: 
@@ -184,7 +185,7 @@ def generate_los(model,zmin,zmax):
 			bsig = p['bsig']
 			bmin,bmax = p['brange']
 			bexp = lambda b: exp(-(b/bsig)**-4)
-			x = np.random.random_sample(n)
+			x = rng.random_sample(n)
 			b = bsig*(-np.log((bexp(bmax)-bexp(bmin))*x + bexp(bmin)))**(-1./4)
 		#
 		absorber = np.empty(n,dtype=abs_dtype)
@@ -295,12 +296,15 @@ class VoigtTable:
 		ll = np.where(w1<0)[0]
 		x1[ll] = -w1[ll]
 		w1[ll] = 0
-		# off right edge of spectrum
-		ll = np.where(w2>self.npix)[0]
-		x2[ll] = self.npix - w1[ll]
-		w2[ll] = self.npix
+		# off right edge of spectrum (the table is shared by all wavelength
+		# grids with the same starting point and spacing, so use the length
+		# of this one)
+		npix = len(tau_lam)
+		ll = np.where(w2>npix)[0]
+		x2[ll] = x1[ll] + npix - w1[ll]
+		w2[ll] = npix
 		# within the spectrum!
-		ll = np.where(~((w2<0)|(w1>=self.npix)|(w2-w1<=0)))[0]
+		ll = np.where(~((w2<0)|(w1>=npix)|(w2-w1<=0)))[0]
 		# now loop over the absorbers and add the tabled voigt profiles
 		for i,j,k in zip(ii[ll],jj[ll],ll):
 			tau_lam[w1[k]:w2[k]] += \
@@ -400,6 +404,11 @@ def generate_spectra(wave,z_em,los,**kwargs):
 	   by z_em; i.e., the return value is a stack of transmission spectra
 	   for a single line-of-sight, with each row corresponding to a
 	   redshift in z_em.
+	   If absorberStep is given in kwargs, the optical depth is accumulated
+	   in fixed steps of that many absorbers along the line-of-sight, and
+	   the remaining absorbers are added for each redshift separately, so
+	   that each spectrum does not depend on the other redshifts in z_em,
+	   and each spectrum extends only to 1250A in its own rest frame.
 	   Returns: array with shape (Nz,Nwave)
 	'''
 	# default is 10 km/s
@@ -412,6 +421,14 @@ def generate_spectra(wave,z_em,los,**kwargs):
 	# go well beyond LyA to get maximum wavelength
 	wavemax = min(wave[-1],1250*(1+z_em.max()))
 	npix = np.searchsorted(wave,wavemax,side='right')
+	absorberStep = kwargs.get('absorberStep')
+	if absorberStep is None:
+		npixz = np.repeat(npix,len(z_em))
+	else:
+		# each spectrum is cut off at its own maximum wavelength, so that
+		# it does not depend on the other redshifts along the sightline
+		npixz = np.searchsorted(wave,np.minimum(wave[-1],1250*(1+z_em)),
+		                        side='right')
 	fwave = exp(np.log(wavemin)+forestR**-1*np.arange(npix*nrebin))
 	# only need absorbers up to the maximum redshift
 	los = los[los['z']<z_em.max()]
@@ -420,12 +437,22 @@ def generate_spectra(wave,z_em,los,**kwargs):
 	tspec = np.ones(z_em.shape+wave.shape)
 	#
 	tau = np.zeros_like(fwave)
+	nstep = 0
 	for i in range(1,len(zi)):
-		zi1,zi2 = zi[i-1],zi[i]
-		tau = calc_tau_lambda(fwave,los[zi1:zi2],tauIn=tau,**kwargs)
-		T = exp(-tau).reshape(-1,nrebin)
-		tspec[i-1,:npix] = np.average(T,weights=fwave.reshape(-1,nrebin),
-		                              axis=1)
+		if absorberStep is None:
+			zi1,zi2 = zi[i-1],zi[i]
+			tau = calc_tau_lambda(fwave,los[zi1:zi2],tauIn=tau,**kwargs)
+			tau_i = tau
+		else:
+			while nstep+absorberStep <= zi[i]:
+				zi1,zi2 = nstep,nstep+absorberStep
+				tau = calc_tau_lambda(fwave,los[zi1:zi2],tauIn=tau,**kwargs)
+				nstep = zi2
+			tau_i = calc_tau_lambda(fwave,los[nstep:zi[i]],
+			                        tauIn=tau.copy(),**kwargs)
+		T = exp(-tau_i).reshape(-1,nrebin)
+		T = np.average(T,weights=fwave.reshape(-1,nrebin),axis=1)
+		tspec[i-1,:npixz[i-1]] = T[:npixz[i-1]]
 	return tspec
 
 def generate_N_spectra(wave,z_em,nlos,**kwargs):
@@ -439,6 +466,12 @@ def generate_N_spectra(wave,z_em,nlos,**kwargs):
 	    i.e., losMap has the same number of entries as z_em, and has elements 
 	    in the range 0..nlos-1
 	   Otherwise, losMap is generated randomly.
+	   If losSeed is provided in kwargs, line-of-sight i is generated from 
+	    its own random stream (losSeed+(i,)), and the losMap draws are taken
+	    from kwargs['rng'] [default: the numpy.random module]. For 
+	    nlos == -1, the line-of-sight ids can be given by losIds. Only the
+	    lines-of-sight that are used are generated, and the spectra are
+	    built in fixed absorber steps (see generate_spectra).
 	   Returns dictionary with
 	    T = transmission array (Nz,Nwave)
 	    losMap = line-of-sight to z_em mapping (Nz)
@@ -458,22 +491,37 @@ def generate_N_spectra(wave,z_em,nlos,**kwargs):
 		# each emission redshift gets its own line-of-sight
 		nlos = len(z_em)
 		losMap = np.arange(nlos)
-	# Generate the lines-of-sight first, to preserve random generator order
-	linesofsight = [generate_los(forestModel,zmin,zmax) for i in range(nlos)]
+		losIds = kwargs.get('losIds',losMap)
+	else:
+		losIds = np.arange(nlos)
+	losSeed = kwargs.get('losSeed')
+	if losSeed is not None:
+		# spectra that do not depend on the other redshifts along the los
+		kwargs.setdefault('absorberStep',100)
+	if losSeed is None:
+		# Generate the lines-of-sight first, to preserve random generator 
+		# order
+		linesofsight = [generate_los(forestModel,zmin,zmax) 
+		                  for i in range(nlos)]
 	if losMap is None:
 		# map each emission redshift to a randomly chosen line-of-sight
-		losMap = np.random.randint(0,nlos,z_em.shape[0])
+		rng = kwargs.get('rng',np.random)
+		losMap = rng.randint(0,nlos,z_em.shape[0])
 	# generate spectra for each line-of-sight
 	specAll = np.zeros(z_em.shape+wave.shape)
-	for losNum,los in enumerate(linesofsight):
+	for losNum in range(nlos):
 		ii = np.where(losMap == losNum)[0]
 		if len(ii)==0:
 			continue
+		if losSeed is None:
+			los = linesofsight[losNum]
+		else:
+			rs = np.random.RandomState(list(losSeed)+[int(losIds[losNum])])
+			los = generate_los(forestModel,zmin,zmax,rng=rs)
 		zi = z_em[ii].argsort()
 		spec = generate_spectra(wave,z_em[ii[zi]],los,**kwargs)
 		specAll[ii,:] = spec[zi.argsort()]
-		if ( len(linesofsight)>100 and 
-		      ((losNum+1) % (len(linesofsight)//10) == 0) ):
+		if nlos>100 and ((losNum+1) % (nlos//10) == 0):
 			print 'finished LOS #%d' % (losNum+1)
 	return dict(T=specAll,losMap=losMap,z=z_em.copy(),wave=wave.copy())
 
@@ -483,16 +531,24 @@ def generate_grid_spectra(wave,zbins,nlos,**kwargs):
 	    lines-of-sight.
 	   e.g., if zbins = [2.0,2.5,3.0] and nlos = 2, the returned spectra
 	    include two lines-of-sight with samplings at z = 2, 2.5, and 3.
+	   If RandomStreams is set in kwargs, each line-of-sight is generated 
+	    from its own random stream (GridSeed,i), so that it can later be
+	    regenerated on its own by generate_spectra_from_grid.
 	'''
 	zem = np.tile(zbins,nlos)
 	losMap = np.repeat(np.arange(nlos),len(zbins))
 	# This is needed for the absorber list to be reproducible.
 	seed = kwargs.get('GridSeed',1)
-	np.random.seed(seed)
+	losStreams = kwargs.get('RandomStreams',False)
+	if losStreams:
+		kwargs['losSeed'] = (seed,)
+	else:
+		np.random.seed(seed)
 	sp = generate_N_spectra(wave,zem,nlos,losMap=losMap,**kwargs)
 	sp['nLOS'] = nlos
 	sp['zbins'] = zbins
 	sp['seed'] = seed
+	sp['losStreams'] = losStreams
 	return sp
 
 def generate_spectra_from_grid(wave,z_em,tgrid,**kwargs):
@@ -506,6 +562,9 @@ def generate_spectra_from_grid(wave,z_em,tgrid,**kwargs):
 	   Similarly, the z=2.7 spectrum is generated from the z=2.5 grid spectrum.
 	   This is useful for quickly generating forest spectra at arbitrary
 	   redshifts without having to do the full calculation.
+	   If the grid was generated with independent line-of-sight streams,
+	    only the lines-of-sight that are used are regenerated, and the 
+	    losMap draws are taken from kwargs['rng'].
 	'''
 	nhiMin = kwargs.get('gridForestStep_minlogNHI',0)
 	# XXX these should all come out of the tgrid meta-data
@@ -521,13 +580,28 @@ def generate_spectra_from_grid(wave,z_em,tgrid,**kwargs):
 	# map each emission redshift to a line-of-sight, or a predefined
 	#  mapping if provided
 	nlos = tgrid['nLOS']
-	losMap = kwargs.get('losMap',np.random.randint(0,nlos,z_em.shape[0]))
+	losStreams = tgrid.get('losStreams',False)
+	if 'losMap' in kwargs:
+		losMap = kwargs['losMap']
+	elif losStreams:
+		losMap = kwargs.get('rng',np.random).randint(0,nlos,z_em.shape[0])
+	else:
+		losMap = np.random.randint(0,nlos,z_em.shape[0])
 	T = tgrid['T'].reshape(nlos,len(tgrid['zbins']),-1)
-	np.random.seed(tgrid['seed'])
+	if losStreams:
+		kwargs.setdefault('absorberStep',100)
+	else:
+		np.random.seed(tgrid['seed'])
 	# generate spectra for each line-of-sight
 	for losNum in range(nlos):
 		ii = np.where(losMap == losNum)[0]
-		los = generate_los(forestModel,zmin,zmax)
+		if losStreams:
+			if len(ii)==0:
+				continue
+			rs = np.random.RandomState([tgrid['seed'],losNum])
+			los = generate_los(forestModel,zmin,zmax,rng=rs)
+		else:
+			los = generate_los(forestModel,zmin,zmax)
 		if len(ii)==0:
 			# need to do it here, because all los'es must be generated for
 			# the random number generation to proceed in the correct order
@@ -564,15 +638,16 @@ def save_spectra(spec,forestName,outputDir):
 		ftab[k] = spec[k]
 	logwave = np.log(wave[:2])
 	# XXX should figure out the standard way
-	hdu = fits.new_table(ftab)
-	hdu.header.update('CD1_1',np.diff(logwave)[0])
-	hdu.header.update('CRPIX1',1)
-	hdu.header.update('CRVAL1',logwave[0])
-	hdu.header.update('CRTYPE1','LOGWAVE')
+	hdu = fits.BinTableHDU.from_columns(ftab)
+	hdu.header['CD1_1'] = np.diff(logwave)[0]
+	hdu.header['CRPIX1'] = 1
+	hdu.header['CRVAL1'] = logwave[0]
+	hdu.header['CRTYPE1'] = 'LOGWAVE'
 	if 'zbins' in spec:
-		hdu.header.update('NLOS',spec['nLOS'])
-		hdu.header.update('ZBINS',','.join('%.3f'%z for z in spec['zbins']))
-		hdu.header.update('GRIDSEED',spec['seed'])
+		hdu.header['NLOS'] = spec['nLOS']
+		hdu.header['ZBINS'] = ','.join('%.3f'%z for z in spec['zbins'])
+		hdu.header['GRIDSEED'] = spec['seed']
+		hdu.header['LOSSTRMS'] = spec.get('losStreams',False)
 	hdu.writeto(os.path.join(outputDir,forestName+'.fits.gz'),clobber=True)
 
 def load_spectra(forestName,outputDir):
@@ -588,5 +663,6 @@ def load_spectra(forestName,outputDir):
 		rv['nLOS'] = hdr['NLOS']
 		rv['zbins'] = np.array(hdr['ZBINS'].split(',')).astype(np.float)
 		rv['seed'] = hdr['GRIDSEED']
+		rv['losStreams'] = hdr.get('LOSSTRMS',False)
 	return rv
 
@@ -1,24 +1,45 @@
 #!/usr/bin/env python
 
 import inspect
+import warnings
 from collections import OrderedDict
 import numpy as np
 import astropy.units as u
 from scipy.interpolate import interp1d
-from scipy.integrate import quad
 from scipy.special import hyp2f1
 
+from .sqbase import getDistanceTable
+
 skyDeg2 = 41253.
 
 def interp_dVdzdO(zrange,cosmo):
-	zz = np.arange(zrange[0]-0.01,zrange[1]+0.0251,0.025)
-	diff_co_vol = [cosmo.differential_comoving_volume(z).value for z in zz]
-	return interp1d(zz,diff_co_vol)
+	# drawn from the distance table shared by all users of the cosmology
+	distTable = getDistanceTable(cosmo)
+	distTable.extend(zrange[1])
+	return distTable.dVdzdO
+
+def _interp2d_grid(x,F,xi,yi):
+	'''
+	Bilinear interpolation of F, tabulated on x (axis 0) and on evenly
+	spaced values in [0,1] (axis 1), at the points (xi,yi).
+	'''
+	nx,ny = F.shape
+	xf = np.interp(xi,x,np.arange(nx))
+	i = np.floor(xf).astype(np.int64).clip(0,nx-2)
+	wx = xf - i
+	yf = np.asarray(yi)*(ny-1)
+	j = np.floor(yf).astype(np.int64).clip(0,ny-2)
+	wy = yf - j
+	return (1-wx)*((1-wy)*F[i,j] + wy*F[i,j+1]) + \
+	          wx *((1-wy)*F[i+1,j] + wy*F[i+1,j+1])
 
 class LuminosityFunction(object):
+	# redshift spacing of cached parameter evaluations
+	zGridStep = 1e-3
 	def __init__(self):
 		self.paramEvol = OrderedDict()
 		self.nargs = {}
+		self._paramCache = {}
 	def logPhi(self,M,z,*args):
 		raise NotImplementedError
 #	def __call__(self,*args):
@@ -51,11 +72,13 @@ class LuminosityFunction(object):
 			self.paramEvol[paramName] = z_evol
 		argspec = inspect.getargspec(self.paramEvol[paramName])
 		self.nargs[paramName] = len(argspec[0]) - 1
+		self._paramCache = {}
 	def set_param_values(self,p):
 		self.paramVals = p
-	def eval_at_z(self,z,*args):
+		self._paramCache = {}
+	def _param_args(self,args):
+		# split the argument list into the arguments for each parameter
 		argnum = 0
-		vals = []
 		for p in self.paramEvol:
 			if len(args) > 0:
 				pp = args[argnum:argnum+self.nargs[p]]
@@ -64,9 +87,52 @@ class LuminosityFunction(object):
 					pp = ()
 				else:
 					pp = self.paramVals[argnum:argnum+self.nargs[p]]
-			vals.append(self.paramEvol[p](z,*pp))
+			yield p,pp
 			argnum += self.nargs[p]
+	def eval_at_z(self,z,*args):
+		vals = []
+		for p,pp in self._param_args(args):
+			vals.append(self.paramEvol[p](z,*pp))
 		return vals
+	def eval_params(self,z,*args):
+		'''
+		Evaluate the parameters at an array of redshifts, calling each
+		evolution function once with the full array. Returns an array of
+		shape (Nparams,)+z.shape. Functions that do not accept arrays are
+		evaluated element by element.
+		'''
+		z = np.asarray(z,dtype=np.float64)
+		vals = np.empty((len(self.paramEvol),)+z.shape)
+		for k,(p,pp) in enumerate(self._param_args(args)):
+			try:
+				vals[k] = self.paramEvol[p](z,*pp)
+			except (TypeError,ValueError):
+				vals[k] = np.reshape([self.paramEvol[p](_z,*pp)
+				                        for _z in z.flat],z.shape)
+		return vals
+	def eval_params_cached(self,z,*args):
+		'''
+		As eval_params, but interpolated from an evaluation on a fixed grid
+		of redshifts from zero with spacing zGridStep, which is cached for
+		each set of arguments and extended as needed. Used by the sampling
+		and integration routines.
+		'''
+		key = args
+		try:
+			hash(key)
+		except TypeError:
+			return self.eval_params(z,*args)
+		z = np.asarray(z,dtype=np.float64)
+		zmax = z.max() if z.size > 0 else 0
+		if key not in self._paramCache or self._paramCache[key][0] < zmax:
+			zmax = max(zmax,2*self._paramCache.get(key,(0,))[0],1.)
+			zgrid = np.arange(0,zmax+2*self.zGridStep,self.zGridStep)
+			self._paramCache[key] = (zgrid[-1],self.eval_params(zgrid,*args))
+		vals = self._paramCache[key][1]
+		zi = z / self.zGridStep
+		i = np.floor(zi).astype(np.int64).clip(0,vals.shape[1]-2)
+		w = zi - i
+		return (1-w)*vals[:,i] + w*vals[:,i+1]
 
 def doublePL_Lintegral(x,a,b):
 	return (b*x**(1-a) / ((a-1)*(a-b)) - 
@@ -74,23 +140,176 @@ def doublePL_Lintegral(x,a,b):
 	          hyp2f1(1.,(a-1)/(a-b),(a-1)/(a-b)+1,-x**(b-a)) + b) / 
 	           ((a-1)*(a-b)))
 
+class DPLIntegralTable(object):
+	'''
+	Tabulated antiderivative of the double power law 1/(x^a + x^b), i.e.,
+	of doublePL_Lintegral, for fixed (a,b). In t = ln(x) the derivative
+	is f(t) = 1/(exp((a-1)t) + exp((b-1)t)), so the antiderivative F(t)
+	is smooth. It is tabulated with spacing dt by integrating f with
+	5-point Gauss-Legendre quadrature on each step, and interpolated with
+	cubic Hermite polynomials using the exact f. For |a|,|b| < 5 the
+	interpolated integrals have a relative accuracy better than 1e-7.
+	F is zero at x=infinity when the integral converges there (otherwise
+	at x=1), and the table is extended as needed.
+	'''
+	_glNodes = np.polynomial.legendre.leggauss(5)
+	def __init__(self,a,b,trange=(-25.,25.),dt=0.02):
+		self.a = a
+		self.b = b
+		self.dt = dt
+		self._build(*trange)
+	def deriv(self,t):
+		return 1/(np.exp((self.a-1)*t) + np.exp((self.b-1)*t))
+	def _build(self,tmin,tmax):
+		k1 = min(int(np.floor(tmin/self.dt)),0)
+		k2 = max(int(np.ceil(tmax/self.dt)),0)
+		self.t = self.dt*np.arange(k1,k2+1)
+		x,w = self._glNodes
+		nodes = self.t[:-1,np.newaxis] + 0.5*self.dt*(x+1)
+		dF = 0.5*self.dt*np.sum(w*self.deriv(nodes),axis=-1)
+		self.f = self.deriv(self.t)
+		# accumulate outwards from x=1, or inwards from infinity if the
+		# bright end converges, so that nearby values never cancel
+		c = max(self.a,self.b) - 1
+		if c > 0:
+			Fpos = -np.cumsum(np.append(dF[-k1:],self.f[-1]/c)[::-1])[::-1]
+		else:
+			Fpos = np.concatenate([[0.],np.cumsum(dF[-k1:])])
+		Fneg = Fpos[0] - np.cumsum(dF[:-k1][::-1])[::-1]
+		self.F = np.concatenate([Fneg,Fpos])
+	def __call__(self,x):
+		'''Return the antiderivative at x.'''
+		t = np.log(x)
+		if t.size > 0 and (t.min() < self.t[0] or t.max() > self.t[-1]):
+			tmin = min(t.min(),self.t[0])
+			tmax = max(t.max(),self.t[-1])
+			self._build(tmin-abs(tmin),tmax+abs(tmax))
+		u = (t-self.t[0])/self.dt
+		k = np.floor(u).astype(np.int64).clip(0,len(self.t)-2)
+		s = u - k
+		s2,s3 = s**2,s**3
+		return ( (2*s3-3*s2+1)*self.F[k] + (s3-2*s2+s)*self.dt*self.f[k] + 
+		         (3*s2-2*s3)*self.F[k+1] + (s3-s2)*self.dt*self.f[k+1] )
+
+_dplTables = OrderedDict()
+
+def getDPLTable(a,b,maxTables=256):
+	'''
+	Return the DPLIntegralTable for (a,b), building it if needed. The
+	most recently used maxTables tables are kept.
+	'''
+	key = (float(a),float(b))
+	if key in _dplTables:
+		table = _dplTables.pop(key)
+	else:
+		table = DPLIntegralTable(*key)
+		if len(_dplTables) >= maxTables:
+			_dplTables.popitem(last=False)
+	_dplTables[key] = table
+	return table
+
+def tabulatedDPL_Lintegral(x,a,b):
+	'''
+	Antiderivative of 1/(x^a + x^b) from DPLIntegralTables, for arrays of
+	x and of (a,b), which are broadcast together. It differs from
+	doublePL_Lintegral by a constant for each (a,b), so only differences
+	at the same (a,b) are meaningful.
+	'''
+	x,a,b = np.broadcast_arrays(np.asarray(x,dtype=np.float64),a,b)
+	if a.size > 0 and np.all(a==a.flat[0]) and np.all(b==b.flat[0]):
+		return getDPLTable(a.flat[0],b.flat[0])(x)
+	Lint = np.empty(x.size)
+	ab,inv = np.unique(a.ravel()+1j*b.ravel(),return_inverse=True)
+	# group the points by (a,b) with a single sort
+	order = np.argsort(inv,kind='mergesort')
+	splits = np.searchsorted(inv[order],np.arange(1,len(ab)))
+	for _a,_b,ii in zip(ab.real,ab.imag,np.split(order,splits)):
+		Lint[ii] = getDPLTable(_a,_b)(x.ravel()[ii])
+	return Lint.reshape(x.shape)
+
+def definiteDPL_Lintegral(x1,x2,a,b,maxTables=32,dt=0.25,order=8):
+	'''
+	Integral of 1/(x^a + x^b) from x1 to x2, for arrays broadcast
+	together. When there are no more than maxTables distinct (a,b) pairs
+	the DPLIntegralTables are used; otherwise, e.g. for slopes that evolve
+	over a fine redshift grid, each integral is computed directly in ln(x)
+	with order-point Gauss-Legendre quadrature on steps of at most dt,
+	vectorized over all of the elements (relative accuracy ~1e-10).
+	'''
+	x1,x2,a,b = np.broadcast_arrays(np.asarray(x1,dtype=np.float64),
+	                                x2,a,b)
+	if a.size == 0 or len(np.unique(a.ravel()+1j*b.ravel())) <= maxTables:
+		Lint = tabulatedDPL_Lintegral(np.array([x1,x2]),a,b)
+		return Lint[1] - Lint[0]
+	t1,t2 = np.log(x1)[...,np.newaxis],np.log(x2)[...,np.newaxis]
+	nstep = max(int(np.ceil(np.abs(t2-t1).max()/dt)),1)
+	x,w = np.polynomial.legendre.leggauss(order)
+	s = (np.arange(nstep)[:,np.newaxis] + 0.5*(x+1)).ravel() / nstep
+	t = t1 + (t2-t1)*s
+	a,b = a[...,np.newaxis],b[...,np.newaxis]
+	f = 1/(np.exp((a-1)*t) + np.exp((b-1)*t))
+	return 0.5*(t2-t1)[...,0]/nstep * np.sum(np.tile(w,nstep)*f,axis=-1)
+
 # handy conversions are given in Hopkins, Richards, & Hernquist 2007
 # eqns. 6-8
-def integrateDPL(Mrange,logPhiStar,MStar,alpha,beta):
+def integrateDPL(Mrange,logPhiStar,MStar,alpha,beta,k=0):
+	'''
+	Integral of the double power-law LF over Mrange=(M1,M2). The limits
+	and the parameters can be arrays, which are broadcast together. If k
+	is nonzero the LF is weighted by (L/L*)^k.
+	'''
+	logPhiStar,MStar,alpha,beta = [ np.asarray(par,dtype=np.float64) 
+	                                  for par in (logPhiStar,MStar,alpha,beta) ]
 	PhiStar_M = 10**logPhiStar
-	MM = np.asarray(Mrange)
-	L_min,L_max = 10**(-0.4*(MM-MStar))
-	try:
-		Lsum = doublePL_Lintegral(L_max,-alpha,-beta) - \
-		        doublePL_Lintegral(L_min,-alpha,-beta) 
-	except:
-		Lsum = np.inf # proceed to the failure case below
-	if not np.isfinite(Lsum):
-		# if the analytic function failed to evaluate, revert to a numerical
-		# integration
-		Lsum,err = quad(lambda x: 1/(x**-alpha + x**-beta), L_min, L_max)
+	M1,M2 = [ np.asarray(M,dtype=np.float64) for M in Mrange ]
+	L_min = 10**(-0.4*(M1-MStar))
+	L_max = 10**(-0.4*(M2-MStar))
+	# the (L/L*)^k weight is absorbed into the slopes
+	alpha,beta = alpha+k,beta+k
+	Lsum = definiteDPL_Lintegral(L_min,L_max,-alpha,-beta)
 	return 1.0857 * PhiStar_M * Lsum
 
+def cumulativeDPL(Mbins,logPhiStar,MStar,alpha,beta):
+	'''
+	Integral of the double power-law LF from Mbins[...,0] to each of Mbins
+	along the last axis. The parameters must broadcast against Mbins.
+	'''
+	Mbins = np.asarray(Mbins,dtype=np.float64)
+	logPhiStar,MStar,alpha,beta = [ np.asarray(par,dtype=np.float64) 
+	                                  for par in (logPhiStar,MStar,alpha,beta) ]
+	PhiStar_M = 10**logPhiStar
+	L = 10**(-0.4*(Mbins-MStar))
+	Lint = tabulatedDPL_Lintegral(L,-alpha,-beta)
+	return 1.0857 * PhiStar_M * (Lint - Lint[...,:1])
+
+def glIntegrate(f,edges,epsrel=1e-6,order=8,maxiter=10):
+	'''
+	Integrate the vectorized function f over each interval between the
+	values in edges, using order-point Gauss-Legendre quadrature. f is
+	evaluated once per pass on all of the nodes. The intervals are split
+	in two on each pass, until the integrals change by less than epsrel
+	times their total, warning if that is not reached within maxiter
+	passes.
+	'''
+	x,w = np.polynomial.legendre.leggauss(order)
+	edges = np.asarray(edges,dtype=np.float64)
+	I0 = None
+	nsub = 1
+	for niter in range(maxiter):
+		sub = edges[:-1,np.newaxis] + np.diff(edges)[:,np.newaxis] * \
+		                                   np.arange(nsub+1) / float(nsub)
+		h = np.diff(sub,axis=-1)[...,np.newaxis] / 2
+		nodes = sub[:,:-1,np.newaxis] + h*(x+1)
+		I = np.sum(h*w*f(nodes),axis=(-2,-1))
+		if I0 is not None and np.all(np.abs(I-I0) <= epsrel*np.abs(I.sum())):
+			break
+		I0 = I
+		nsub *= 2
+	else:
+		warnings.warn('glIntegrate did not converge to epsrel=%g in %d '
+		              'iterations' % (epsrel,maxiter))
+	return I
+
 class DoublePowerLawLF(LuminosityFunction):
 	def __init__(self,logPhiStar=None,MStar=None,alpha=None,beta=None):
 		super(DoublePowerLawLF,self).__init__()
@@ -105,25 +324,45 @@ class DoublePowerLawLF(LuminosityFunction):
 		        np.log10(10**(0.4*(alpha+1)*(M-Mstar)) + \
 		                 10**(0.4*( beta+1)*(M-Mstar)))
 	__call__ = logPhi
-	def _sample(self,Mrange,zrange,p,cosmo,**kwargs):
+	def _zdistribution(self,Mrange,zrange,p,cosmo,**kwargs):
+		'''
+		Integrate the LF over Mrange(z) and the volume within zrange.
+		Returns the inverse CDF of redshift and the number of objects.
+		'''
 		nz = 100
-		nM = 30
 		skyfrac = kwargs.get('skyArea',skyDeg2) / skyDeg2
 		Mmin = Mrange(zrange[0])[0]
 		Mmax = Mrange(zrange[1])[1]
 		dVdzdO = interp_dVdzdO(zrange,cosmo)
-		phi_z = lambda z: integrateDPL((Mmin,Mmax),*self.eval_at_z(z,*p)) * \
+		phi_z = lambda z: integrateDPL((Mmin,Mmax),
+		                               *self.eval_params_cached(z,*p)) * \
 		                        dVdzdO(z)
 		zbins = np.linspace(zrange[0],zrange[1],nz)
-		zsamp = [quad(phi_z,*zr)[0] for zr in zip(zbins[:-1],zbins[1:])]
-		zsamp = [0,] + zsamp
+		zsamp = glIntegrate(phi_z,zbins,epsrel=kwargs.get('epsrel',1e-6))
+		zsamp = np.concatenate([[0,],zsamp])
 		Ntot = np.sum(zsamp)
 		zfun = interp1d(np.cumsum(zsamp)/Ntot,zbins)
 		Ntot = np.int(np.round(Ntot * skyfrac * 4*np.pi))
+		return zfun,Ntot
+	def _sample(self,Mrange,zrange,p,cosmo,**kwargs):
+		'''
+		Draw redshifts from the LF integrated over Mrange(z), then draw
+		magnitudes from the LF at each redshift. By default the magnitudes
+		are obtained with _Mquantile_table; tabulated=False gives the
+		original sampler, which integrates the LF for each object.
+		'''
+		nM = 30
+		zfun,Ntot = self._zdistribution(Mrange,zrange,p,cosmo,**kwargs)
 		print 'integration returned ',Ntot,' objects'
 		x = np.random.random(Ntot)
 		y = np.random.random(Ntot)
 		z = zfun(x)
+		if kwargs.get('tabulated',True):
+			zt,Q = self._Mquantile_table(Mrange,zrange,p)
+			u = _interp2d_grid(zt,Q,z,y)
+			Mr = Mrange(z)
+			M = Mr[0] + u*(Mr[1]-Mr[0])
+			return M,z
 		M = np.zeros_like(z)
 		for i in range(Ntot):
 			Mr = Mrange(z[i])
@@ -137,55 +376,163 @@ class DoublePowerLawLF(LuminosityFunction):
 			if ((i+1)%(Ntot//10))==0:
 				print i+1,' out of ',Ntot
 		return M,z
+	def _Mquantile_table(self,Mrange,zrange,p,nz=200,nM=100,nq=1000):
+		'''
+		Tabulate the quantiles of the LF in M at fixed z, on nz redshifts
+		spanning zrange and nq quantiles evenly spaced in [0,1]. M is given
+		as the fractional position within Mrange(z), and the CDF at each z
+		is taken as piecewise linear between nM magnitudes (as in the
+		original sampler, which uses 30).
+		'''
+		zt = np.linspace(zrange[0],zrange[1],nz)
+		u = np.linspace(0.,1,nM)
+		q = np.linspace(0.,1,nq)
+		Mr0,Mr1 = [np.broadcast_to(M,zt.shape)[:,np.newaxis] 
+		              for M in Mrange(zt)]
+		Mbins = Mr0 + u*(Mr1-Mr0)
+		params = self.eval_params_cached(zt,*p)[:,:,np.newaxis]
+		Mcdf = cumulativeDPL(Mbins,*params)
+		Mcdf /= Mcdf[:,-1:]
+		Q = np.empty((nz,nq))
+		for k in range(nz):
+			Q[k] = np.interp(q,Mcdf[k],u)
+		return zt,Q
+	def _sample_chunks(self,Mrange,zrange,p,cosmo,chunkSize,seed,**kwargs):
+		'''
+		Draw from the same distribution as _sample, in chunks of chunkSize
+		objects. The random values for chunk k come from a generator seeded
+		with (seed,k), so that each chunk can be reproduced on its own.
+		'''
+		zfun,Ntot = self._zdistribution(Mrange,zrange,p,cosmo,**kwargs)
+		print 'integration returned ',Ntot,' objects'
+		zt,Q = self._Mquantile_table(Mrange,zrange,p)
+		for k,i1 in enumerate(range(0,Ntot,chunkSize)):
+			rs = np.random.RandomState([seed,k])
+			n = min(chunkSize,Ntot-i1)
+			x = rs.random_sample(n)
+			y = rs.random_sample(n)
+			z = zfun(x)
+			u = _interp2d_grid(zt,Q,z,y)
+			Mr = Mrange(z)
+			yield Mr[0] + u*(Mr[1]-Mr[0]),z
 	def sample_from_fluxrange(self,mrange,zrange,m2M,cosmo,p=(),**kwargs):
 		_mrange = mrange[::-1]
-		_Mrange = lambda z: np.array(_mrange) - m2M(z)
+		_Mrange = lambda z: (_mrange[0]-m2M(z),_mrange[1]-m2M(z))
 		M,z = self._sample(_Mrange,zrange,p,cosmo,**kwargs)
 		m = M + m2M(z)
 		return m,z
+	def iter_sample_from_fluxrange(self,mrange,zrange,m2M,cosmo,
+	                               chunkSize,seed,p=(),**kwargs):
+		'''
+		As sample_from_fluxrange, but yield the (m,z) samples in chunks of
+		chunkSize objects, each drawn with a random seed derived from seed.
+		'''
+		_mrange = mrange[::-1]
+		_Mrange = lambda z: (_mrange[0]-m2M(z),_mrange[1]-m2M(z))
+		for M,z in self._sample_chunks(_Mrange,zrange,p,cosmo,
+		                               chunkSize,seed,**kwargs):
+			yield M + m2M(z),z
 	def sample_from_Lrange(self,Mrange,zrange,cosmo,p=(),**kwargs):
 		_Mrange = lambda z: Mrange
 		return self._sample(_Mrange,zrange,p,cosmo,**kwargs)
-	def _get_Lcdf_fun(self,Mrange,z,p):
-		nM = 30
-		Mbins = np.linspace(Mrange[0],Mrange[1],nM)
-		logPhiStar,MStar,alpha,beta = self.eval_at_z(z,*p)
+	def _get_Lcdf_table(self,Mrange,z,p,nM=30):
+		'''
+		Tabulate the normalized L-CDFs within Mrange=(M1,M2) at each of the
+		redshifts z, where M1 and M2 are arrays matching z. Returns the
+		(Nz,nM) arrays of M bins and CDF values.
+		'''
+		s = np.linspace(0,1,nM)
+		Mbins = Mrange[0][:,np.newaxis] + \
+		            (Mrange[1]-Mrange[0])[:,np.newaxis]*s
+		logPhiStar,MStar,alpha,beta = [ par[:,np.newaxis] 
+		                                   for par in self.eval_params(z,*p) ]
 		Lbins = 10**(-0.4*(Mbins-MStar))
-		Lcdf = doublePL_Lintegral(Lbins[1:],-alpha,-beta) - \
-		        doublePL_Lintegral(Lbins[0],-alpha,-beta) 
-		Lcdf /= Lcdf[-1]
-		Lcdf = np.concatenate([[0.,],Lcdf])
-		return interp1d(Lcdf,Mbins)
+		Lcdf = tabulatedDPL_Lintegral(Lbins,-alpha,-beta)
+		Lcdf -= Lcdf[:,:1]
+		Lcdf /= Lcdf[:,-1:]
+		return Mbins,Lcdf
+	@staticmethod
+	def _invert_cdf_rows(Mbins,Lcdf,x):
+		'''
+		Linearly interpolate each row of x, with x in [0,1], on the inverse
+		of the corresponding row of the tabulated CDF. The rows are stacked
+		end to end with offsets so that a single searchsorted locates all
+		of the points.
+		'''
+		nz,nM = Lcdf.shape
+		offset = 2*np.arange(nz)[:,np.newaxis]
+		i0 = nM*np.arange(nz)[:,np.newaxis]
+		cdf = (Lcdf+offset).ravel()
+		k = np.searchsorted(cdf,(x+offset).ravel(),side='right').reshape(x.shape)
+		k = (k-1).clip(i0,i0+nM-2)
+		c1,c2 = Lcdf.ravel()[k],Lcdf.ravel()[k+1]
+		M1,M2 = Mbins.ravel()[k],Mbins.ravel()[k+1]
+		dc = np.where(c2>c1,c2-c1,1)
+		return M1 + (M2-M1)*(x-c1)/dc
 	def sample_at_flux_intervals(self,mrange,zbins,m2M,Nintervals,nPerBin,p=()):
-		_mrange = np.array(mrange[::-1])
-		medges = np.empty((Nintervals+1,len(zbins)))
-		mgrid = np.empty((Nintervals,len(zbins),nPerBin))
+		'''
+		Divide the flux range at each redshift in zbins into Nintervals
+		bins containing equal numbers of objects, and sample nPerBin
+		magnitudes within each. All of the redshifts are handled together,
+		and m2M is evaluated once at the bin redshifts. Returns the bin
+		edges, shape (Nintervals+1,Nz), and the sampled apparent
+		magnitudes, shape (Nintervals,Nz,nPerBin).
+		'''
+		zbins = np.asarray(zbins,dtype=np.float64)
+		nz = len(zbins)
+		m2Mz = m2M(zbins)
+		Mrange = (mrange[1]-m2Mz,mrange[0]-m2Mz)
+		Mbins,Lcdf = self._get_Lcdf_table(Mrange,zbins,p)
 		xedges = np.linspace(0.,1,Nintervals+1)
-		for j,z in enumerate(zbins):
-			Mrange = _mrange - m2M(z)
-			Lcdf_fun = self._get_Lcdf_fun(Mrange,z,p)
-			medges[:,j] = Lcdf_fun(xedges)[::-1] + m2M(z)
-			for i in range(Nintervals):
-				x = xedges[i] + (xedges[i+1]-xedges[i])*np.random.random(nPerBin)
-				mgrid[i,j,:] = Lcdf_fun(x) + m2M(z)
+		medges = self._invert_cdf_rows(Mbins,Lcdf,np.tile(xedges,(nz,1)))
+		medges = medges[:,::-1].T + m2Mz
+		# same random stream as looping over redshifts, then intervals
+		x = np.random.random((nz,Nintervals,nPerBin))
+		x = xedges[:-1,np.newaxis] + np.diff(xedges)[:,np.newaxis]*x
+		mgrid = self._invert_cdf_rows(Mbins,Lcdf,x.reshape(nz,-1))
+		mgrid = mgrid.reshape(nz,Nintervals,nPerBin).transpose(1,0,2) + \
+		             m2Mz[:,np.newaxis]
 		return medges,mgrid
-	def integrate(self,mrange,zrange,m2M,cosmo,p=()):
+	def integrate(self,mrange,zrange,m2M,cosmo,p=(),epsrel=1e-6):
+		'''
+		Number of objects over the full sky within the flux and redshift
+		ranges, integrated to a relative accuracy of ~epsrel.
+		'''
 		dVdzdO = interp_dVdzdO(zrange,cosmo)
-		Mrange = lambda z: np.array(mrange) - m2M(z)
-		phi_z = lambda z: integrateDPL(Mrange(z),*self.eval_at_z(z,*p)) * \
+		Mrange = lambda z: (mrange[0]-m2M(z),mrange[1]-m2M(z))
+		phi_z = lambda z: integrateDPL(Mrange(z),
+		                               *self.eval_params_cached(z,*p)) * \
 		                        dVdzdO(z)
-		nqso,err = quad(phi_z,*zrange)
+		nqso = glIntegrate(phi_z,zrange,epsrel=epsrel).sum()
 		nqso *= 4*np.pi
 		return nqso
-	def ionizing_emissivity(self,z,Mrange,p=(),**kwargs):
-		logPhiStar,MStar,alpha,beta = self.eval_at_z(z,*p)
-		# phi(L) integral is over (L/L*)^-alpha
-		# Lphi(L) integral is over (L/L*)^-alpha-1, so send (alpha+1)
-		x = integrateDPL(Mrange,logPhiStar,MStar,alpha+1,beta+1)
-		if True:
+	def integrate_moment(self,z,Mrange,k=0,p=(),cached=False):
+		'''
+		Integral of L^k phi(M) dM over Mrange=(M1,M2) at each of the
+		redshifts z, where L is the luminosity density (erg/s/Hz) of the
+		AB absolute magnitude M. k=0 gives the number density and k=1 the
+		luminosity density. The limits can be arrays broadcast against z.
+		If cached is True the parameters are interpolated from the cached
+		redshift grid (see eval_params_cached).
+		'''
+		z = np.asarray(z,dtype=np.float64)
+		if cached:
+			logPhiStar,MStar,alpha,beta = self.eval_params_cached(z,*p)
+		else:
+			logPhiStar,MStar,alpha,beta = self.eval_params(z,*p)
+		x = integrateDPL(Mrange,logPhiStar,MStar,alpha,beta,k=k)
+		if k != 0:
 			# until astropy provides AB mag -> Lnu conversion
 			c = 4.*np.pi*(10*u.pc.to(u.cm))**2
 			LStar_nu = c * 10**(-0.4*(MStar + 48.6))
+			x = x * LStar_nu**k
+		return x
+	def ionizing_emissivity(self,z,Mrange,p=(),**kwargs):
+		'''
+		Emissivities at 1450A and 912A from the luminosity density within
+		Mrange, for a scalar or an array of redshifts z.
+		'''
+		e1450 = self.integrate_moment(z,Mrange,1,p)
 		if True:
 			# until I get something more flexible in here
 			# ... use the power-law conversion in .spectrum
@@ -196,5 +543,5 @@ class DoublePowerLawLF(LuminosityFunction):
 			#       (alpha2,break_wave,alpha1)
 			l912 = (1450./break_wave)**alpha1 * (break_wave/912.)**alpha2
 		# for now return e1450, e912
-		return LStar_nu * x, LStar_nu * l912 * x
+		return e1450, l912 * e1450
 
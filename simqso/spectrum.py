@@ -82,70 +82,242 @@ def _Mtoflam(lam0,M,z,DM):
 	flam0 = nu0*fnu0/lam0
 	return flam0/(1+z)
 
+def powerLawContinuum(wave,z,slopes,breakpts,logwave=None):
+	'''
+	Construct broken power-law continua, normalized to unity at the first
+	pixel, for one or more objects at once.
+	  wave: observed wavelength grid
+	  z: redshift, scalar or array of length K
+	  slopes: f_nu power-law slopes, shape (Nseg,) or (K,Nseg)
+	  breakpts: rest-frame wavelengths where each slope begins, or only the
+	            breaks between slopes (Nseg-1 values)
+	  logwave: precomputed log(wave)
+	Within each segment log(f_lambda) is linear in log(wave), so the log
+	continuum is a sum of hinge functions pivoting at the pixel before each
+	break, and only a single exp is needed per pixel.
+	Returns an array of shape (npix,) or (K,npix).
+	'''
+	if logwave is None:
+		logwave = np.log(wave)
+	slopes = np.asarray(slopes,dtype=np.float64)
+	breakpts = np.asarray(breakpts).astype(np.float32)
+	scalar = slopes.ndim == 1 and np.ndim(z) == 0
+	if breakpts.size < slopes.shape[-1]:
+		breakpts = np.concatenate([[0,],breakpts])
+	z1 = 1 + np.asarray(z,dtype=np.float64).reshape(-1,1)
+	alpha_lams = np.atleast_2d(-(2+slopes)) # a_nu --> a_lam
+	nobj = max(z1.shape[0],alpha_lams.shape[0])
+	# pixel where each segment begins, and the change in slope there
+	wb = np.searchsorted(wave,(breakpts*z1).flatten())
+	wb = np.broadcast_to(wb.reshape(-1,breakpts.size),(nobj,breakpts.size))
+	pivot = np.clip(wb-1,0,len(wave)-1)
+	dalpha = np.diff(alpha_lams,axis=-1)
+	dalpha = np.concatenate([alpha_lams[:,:1],dalpha],axis=-1)
+	logf = np.zeros((nobj,len(wave)))
+	for j in range(breakpts.size):
+		dlogw = logwave[np.newaxis,:] - logwave[pivot[:,j]][:,np.newaxis]
+		logf += dalpha[:,j,np.newaxis] * dlogw.clip(0,np.inf)
+	f_lambda = np.exp(logf)
+	if scalar:
+		return f_lambda[0]
+	return f_lambda
+
+class GaussianLineTable(object):
+	'''
+	Gaussian line profiles tabulated for a logarithmic wavelength grid with
+	spacing dloglam. On such a grid the profile of a line with width sigma
+	centered at lambda_c depends only on the sub-pixel offset of the line
+	center and on the width in pixels, sigma/(lambda_c*dloglam). Profiles
+	are tabulated over both and interpolated bilinearly, with nodes spaced
+	and the profiles truncated at +/-nsig (by default, the width at which
+	the profile falls below tol/4) so that the interpolated profiles agree
+	with the untruncated Gaussian to within tol of the line peak.
+	Lines with widths outside of sigmaRange (in pixels) are not tabulated.
+	'''
+	def __init__(self,dloglam,tol=1e-3,sigmaRange=(0.5,50.),nsig=None):
+		if nsig is None:
+			nsig = np.sqrt(2*np.log(4/tol))
+		self.dloglam = dloglam
+		self.tol = tol
+		self.nsig = nsig
+		self.sigmaRange = sigmaRange
+		sigmin,sigmax = sigmaRange
+		if nsig*sigmax*dloglam >= 1:
+			raise ValueError('line widths too large for table')
+		# the interpolation error is (node spacing)^2/8 times the curvature
+		# of the profile, which is <1/sigma^2 as a function of the pixel
+		# offset and <1.235 as a function of log(sigma). a quarter of the
+		# tolerance is assigned to each, and another to the truncation
+		# (which the interpolation can stretch across a node spacing).
+		self.nsub = int(np.ceil(1/(sigmin*np.sqrt(2*tol))))
+		self.nsigma = int(np.ceil(np.log(sigmax/sigmin) /
+		                          np.sqrt(2*tol/1.235))) + 1
+		self.logsigmin = np.log(sigmin)
+		self.dlogsig = np.log(sigmax/sigmin) / (self.nsigma-1)
+		self.J0 = int(self._halfwidth(sigmax))
+		offsets = np.arange(self.nsub+1,dtype=np.float64) / self.nsub
+		sigmas = np.exp(self.logsigmin + self.dlogsig*np.arange(self.nsigma))
+		u = np.arange(-self.J0,self.J0+1)[np.newaxis,np.newaxis,:] - \
+		                                    offsets[:,np.newaxis,np.newaxis]
+		# (lambda - lambda_c)/sigma at each pixel
+		t = np.expm1(u*dloglam) / (dloglam*sigmas[np.newaxis,:,np.newaxis])
+		table = np.exp(-0.5*t**2)
+		table[(t < -nsig) | (t >= nsig)] = 0
+		self.table = table.astype(np.float32)
+	def _halfwidth(self,sigpix):
+		# largest pixel offset from the line center within the window
+		umax = -np.log(1-self.nsig*sigpix*self.dloglam) / self.dloglam
+		return np.ceil(umax).astype(np.int64) + 1
+	def render(self,wave,continuum,lineWave,eqWidth,sigma):
+		'''
+		Sum emission line profiles scaled by the continuum for K spectra.
+		  continuum: (K,npix) continuum spectra on the grid wave
+		  lineWave,eqWidth,sigma: (K,Nlines) observed-frame line parameters
+		Returns the (K,npix) line template and a boolean (K,Nlines) array
+		flagging the lines that could not be drawn from the table.
+		'''
+		K,npix = continuum.shape
+		nlines = lineWave.shape[1]
+		lw,ew,sig = lineWave.flatten(),eqWidth.flatten(),sigma.flatten()
+		sigpix = sig / (lw*self.dloglam)
+		xc = (np.log(lw) - np.log(wave[0])) / self.dloglam
+		intable = (sigpix >= self.sigmaRange[0]) & \
+		           (sigpix <= self.sigmaRange[1])
+		# lines entirely off the grid contribute nothing
+		J = np.zeros(len(lw),dtype=np.int64)
+		J[intable] = self._halfwidth(sigpix[intable])
+		visible = intable & (xc+J >= 0) & (xc-J < npix)
+		template = np.zeros(K*npix)
+		contflat = continuum.ravel()
+		# group the lines into windows of power-of-two half widths, so
+		# that narrow lines are not evaluated over the widest window
+		Jbin = np.minimum(2**np.ceil(np.log2(J.clip(1))).astype(np.int64),
+		                  self.J0)
+		for Jb in np.unique(Jbin[visible]):
+			ii = np.where(visible & (Jbin==Jb))[0]
+			c = np.floor(xc[ii])
+			# interpolation weights for the offset and width nodes
+			x = (xc[ii] - c)*self.nsub
+			i0 = np.floor(x).astype(np.int32).clip(0,self.nsub-1)
+			wi = (x - i0).astype(np.float32)[:,np.newaxis]
+			y = (np.log(sigpix[ii]) - self.logsigmin) / self.dlogsig
+			j0 = np.floor(y).astype(np.int32).clip(0,self.nsigma-2)
+			wj = (y - j0).astype(np.float32)[:,np.newaxis]
+			T = self.table[...,self.J0-Jb:self.J0+Jb+1]
+			prof = (1-wj)*((1-wi)*T[i0,j0] + wi*T[i0+1,j0]) + \
+			          wj*((1-wi)*T[i0,j0+1] + wi*T[i0+1,j0+1])
+			pix = c.astype(np.int64)[:,np.newaxis] + np.arange(-Jb,Jb+1)
+			A = ew[ii]/(np.sqrt(2*np.pi)*sig[ii])
+			good = (pix >= 0) & (pix < npix)
+			obj = (ii // nlines)[:,np.newaxis]
+			flatpix = (obj*npix + pix)[good]
+			weights = (A[:,np.newaxis]*prof)[good] * contflat[flatpix]
+			template += np.bincount(flatpix,weights=weights,
+			                        minlength=K*npix)
+		return template.reshape(K,npix),~intable.reshape(K,nlines)
+
+_lineTables = {}
+
+def getLineTable(dloglam,tol=1e-3):
+	'''Return a GaussianLineTable for the grid, building it if needed.'''
+	key = (np.round(dloglam,12),tol)
+	if key not in _lineTables:
+		_lineTables[key] = GaussianLineTable(dloglam,tol)
+	return _lineTables[key]
+
 class QSOSpectrum(Spectrum):
 	def __init__(self,wave,**kwargs):
 		super(QSOSpectrum,self).__init__(wave,**kwargs)
 		self.templates = {}
+		self._setLogWave()
+	def _setLogWave(self):
+		self.logwave = np.log(self.wave)
+		# pixel size for a logarithmic grid, otherwise None
+		dloglam = np.diff(self.logwave)
+		if np.allclose(dloglam,dloglam[0],rtol=1e-6,atol=0):
+			self.dloglam = dloglam[0]
+		else:
+			self.dloglam = None
+	def resample(self,newWave):
+		super(QSOSpectrum,self).resample(newWave)
+		self._setLogWave()
 	#
 	def setPowerLawContinuum(self,plaws,fluxNorm=None):
 		self.components['PowerLawContinuum'] = plaws
-		w1 = 1
-		self.f_lambda[0] = 1.0
-		z1 = 1 + self.z
+		z1 = 1 + np.asarray(self.z)
 		slopes,breakpts = plaws
-		alpha_lams = -(2+slopes) # a_nu --> a_lam
-		breakpts = breakpts.astype(np.float32)
-		wb = np.searchsorted(self.wave,breakpts*z1)
-		ii = np.where((wb>0)&(wb<=len(self.wave)))[0]
-		wb = wb[ii]
-		for alpha_lam,w2 in zip(alpha_lams[ii-1],wb):
-			if w1==w2:
-				break
-			self.f_lambda[w1:w2] = \
-			   self.f_lambda[w1-1] * \
-			     (self.wave[w1:w2]/self.wave[w1-1])**alpha_lam
-			w1 = w2
+		self.f_lambda = powerLawContinuum(self.wave,self.z,slopes,breakpts,
+		                                  logwave=self.logwave)
 		if fluxNorm is not None:
 			normwave = fluxNorm['wavelength']
-			wave0 = self.wave/z1
 			fnorm = _Mtoflam(normwave,fluxNorm['M_AB'],self.z,fluxNorm['DM'])
-			if wave0[0] > normwave:
-				raise NotImplementedError("outside of wave range: ",
-				                          wave0[0],normwave)
+			wave0 = self.wave/z1[...,np.newaxis]
+			if np.any(wave0[...,0] > normwave):
 				# XXX come back to this; for normalizing the flux when the norm
 				#     wavelength is outside of the spectral range
-				for alam,bkpt in zip(alpha_lams,breakpts):
-					if bkpt > normwave:
-						fnorm *= (normwave/bkpt)**alam
-					if bkpt > wave0[0]:
-						break
-			elif wave0[-1] < normwave:
+				raise NotImplementedError("outside of wave range: ",
+				                          wave0[...,0].max(),normwave)
+			elif np.any(wave0[...,-1] < normwave):
 				raise NotImplementedError("%.1f (%.1f) outside lower "
-				 "wavelength bound %.1f" % (wave0[-1],self.wave[-1],normwave))
+				 "wavelength bound %.1f" % (wave0[...,-1].min(),
+				                            self.wave[-1],normwave))
 			else:
 				# ... to be strictly correct, would need to account for power law
 				#     slope within the pixel
-				fscale = fnorm/self.f_lambda[np.searchsorted(wave0,normwave)]
+				inorm = np.sum(wave0 < normwave,axis=-1)
+				if self.f_lambda.ndim == 1:
+					fscale = fnorm/self.f_lambda[inorm]
+				else:
+					fscale = fnorm/self.f_lambda[np.arange(len(inorm)),inorm]
+					fscale = fscale[:,np.newaxis]
 			self.f_lambda *= fscale
 		self.plcontinuum = self.f_lambda.copy()
 	#
-	def addEmissionLines(self,emlines):
+	def addEmissionLines(self,emlines,profiles='exact',tol=1e-3):
+		'''
+		Add Gaussian emission lines given as rest-frame (wavelength,
+		equivalent width, sigma), each with shape (Nlines,) or (Nlines,K).
+		By default each line is evaluated directly out to 3.5 sigma.
+		profiles='kerneltable' draws the profiles from a GaussianLineTable
+		with accuracy tol instead, which changes the line fluxes by up to
+		tol of the line peak; lines the table cannot represent are then
+		evaluated directly, but cut off at the same width as the table.
+		'''
 		self.components['EmissionLines'] = emlines
-		wave,eqWidth,sigma = [p*(1+self.z) for p in emlines]
-		self.templates['EmissionLines'] = np.zeros_like(self.plcontinuum)
-		nsig = 3.5*np.array([-1.,1])
+		continuum = np.atleast_2d(self.plcontinuum)
+		z1 = np.asarray(1+self.z).reshape(-1,1)
+		ones = np.ones((continuum.shape[0],1))
+		wave,eqWidth,sigma = [ones*z1*np.atleast_2d(np.transpose(p))
+		                        for p in emlines]
+		nsig = 3.5
+		if profiles == 'exact' or self.dloglam is None:
+			template = np.zeros_like(continuum)
+			exact = np.ones(wave.shape,dtype=bool)
+		else:
+			table = getLineTable(self.dloglam,tol)
+			template,exact = table.render(self.wave,continuum,
+			                              wave,eqWidth,sigma)
+			nsig = table.nsig
+		nsig = nsig*np.array([-1.,1])
 		A = eqWidth/(np.sqrt(2*np.pi)*sigma)
 		twosig2 = 2*sigma**2
-		for i in xrange(wave.shape[0]):
-			i1,i2 = np.searchsorted(self.wave,wave[i]+nsig*sigma[i])
+		for k,i in zip(*np.where(exact)):
+			i1,i2 = np.searchsorted(self.wave,wave[k,i]+nsig*sigma[k,i])
 			if i2 != i1:
-				lineprofile = A[i]*np.exp(-(self.wave[i1:i2]-wave[i])**2
-				                           / twosig2[i])
-				self.templates['EmissionLines'][i1:i2] += \
-				                         self.plcontinuum[i1:i2]*lineprofile
+				lineprofile = A[k,i]*np.exp(-(self.wave[i1:i2]-wave[k,i])**2
+				                             / twosig2[k,i])
+				template[k,i1:i2] += continuum[k,i1:i2]*lineprofile
+		self.templates['EmissionLines'] = \
+		                          template.reshape(self.plcontinuum.shape)
 		self.f_lambda += self.templates['EmissionLines']
 	def convolve_restframe(self,g,*args):
-		self.f_lambda = g(self.wave/(1+self.z),self.f_lambda,*args)
+		if np.ndim(self.z) == 0:
+			self.f_lambda = g(self.wave/(1+self.z),self.f_lambda,*args)
+		else:
+			# apply to each spectrum in the block in turn
+			for k,z in enumerate(self.z):
+				kargs = [a[k] if np.ndim(a) > 0 else a for a in args]
+				self.f_lambda[k] = g(self.wave/(1+z),self.f_lambda[k],*kargs)
 	def addTemplate(self,name,template):
 		self.templates[name] = self.plcontinuum * template
 		self.f_lambda += self.templates[name]
@@ -4,7 +4,8 @@ import os
 import numpy as np
 from scipy.interpolate import RectBivariateSpline
 
-from .sqrun import readSimulationData
+from .sqbase import getDistanceTable
+from .sqrun import SimulationData
 
 class Interp2DSeries:
 	def __init__(self,interpFun):
@@ -28,13 +29,14 @@ def getGridBins(simPars):
 
 def calcKCorrFromGrid(fileName,outputDir='./',retGrid=False,retGridFun=False,bandNum=0):
 	from astropy import cosmology
-	simData,simPars = readSimulationData(fileName,outputDir,retParams=True)
+	simData = SimulationData(fileName,outputDir)
+	simPars = simData.params()
 	mBins,zBins,gridShape = getGridBins(simPars)
 	# XXX have to map name to object...
 	simPars['Cosmology'] = {
 	  'WMAP9':cosmology.WMAP9,
 	}[simPars['Cosmology']]
-	DM_z = simPars['Cosmology'].distmod(zBins).value
+	DM_z = getDistanceTable(simPars['Cosmology']).distmod(zBins)
 	# XXX should be loading sim data reshaped already
 	appMag = simData['synMag'][...,bandNum].reshape(gridShape)
 	absMag = simData['M'].reshape(gridShape)
@@ -59,7 +61,8 @@ class ClippedFunction(object):
 
 def calcSelectionFunctionFromGrid(fileName,selector,outputDir='./',
 	                              retGridFun=False):
-	simData,simPars = readSimulationData(fileName,outputDir,retParams=True)
+	simData = SimulationData(fileName,outputDir)
+	simPars = simData.params()
 	mBins,zBins,gridShape = getGridBins(simPars)
 	is_selected = selector(simData['obsMag'],simData['obsMagErr'],
 	                       simData['obsFlux'],simData['obsFluxErr'])
@@ -15,6 +15,66 @@ def fixed_R_dispersion(lam1,lam2,R):
 	loglam = np.arange(loglam1,loglam2+dloglam,dloglam)
 	return np.exp(loglam)
 
+class RestFrameTemplate(object):
+	'''
+	A rest-frame template that can be placed at any redshift on a
+	logarithmic observed wavelength grid. On such a grid redshifting is a
+	shift of the pixel index by log(1+z)/dloglam, so the template is stored
+	once on a rest-frame grid that is oversample times finer and aligned
+	with the observed grid. The observed-frame template at redshift z is
+	a strided slice of the fine grid with linear sub-pixel interpolation.
+	  wave: observed wavelength grid (logarithmic)
+	  restWave: rest wavelengths of the template. If template is a
+	    function of rest wavelength, only the range of restWave is used.
+	  template: template values at restWave, or a callable
+	  fill_value: value used outside of the template wavelength range
+	'''
+	def __init__(self,wave,restWave,template,oversample=8,fill_value=0.0):
+		logwave = np.log(wave)
+		dloglam = np.diff(logwave)
+		if not np.allclose(dloglam,dloglam[0],rtol=1e-6,atol=0):
+			raise ValueError('RestFrameTemplate requires a logarithmic grid')
+		self.npix = len(wave)
+		self.logwave0 = logwave[0]
+		self.oversample = oversample
+		self.dloglam = dloglam[0] / oversample
+		self.fill_value = fill_value
+		# align the fine grid with the observed pixels, with a pixel of
+		# margin on either end
+		j1 = np.floor((np.log(restWave[0])-self.logwave0)/self.dloglam) - 1
+		j2 = np.ceil((np.log(restWave[-1])-self.logwave0)/self.dloglam) + 1
+		self.j1 = int(j1)
+		self.logwave = self.logwave0 + self.dloglam*np.arange(j1,j2+1)
+		self.wave = np.exp(self.logwave)
+		if callable(template):
+			self.template = template(self.wave)
+		else:
+			self.template = np.interp(self.logwave,np.log(restWave),
+			                          template,left=fill_value,
+			                          right=fill_value)
+		# pad the ends so that every index into the template is valid
+		self.template = np.concatenate([[fill_value],self.template,
+		                                [fill_value]])
+	def get(self,z):
+		'''
+		Return the template on the observed grid at redshift z, with shape
+		(npix,) for scalar z or z.shape+(npix,) for an array of redshifts.
+		'''
+		z = np.asarray(z,dtype=np.float64)
+		# fine-grid position of the first observed pixel, relative to the
+		# observed grid so that the interpolation does not depend on the
+		# template range; +1 for the pad
+		x = -np.log1p(z.ravel()) / self.dloglam
+		j0 = np.floor(x)
+		frac = (x - j0)[:,np.newaxis]
+		j = (j0.astype(np.int64) - self.j1 + 1)[:,np.newaxis] + \
+		        self.oversample*np.arange(self.npix)
+		offgrid = (j < 0) | (j > len(self.template)-2)
+		j[offgrid] = 0
+		tmpl = (1-frac)*self.template[j] + frac*self.template[j+1]
+		tmpl[offgrid] = self.fill_value
+		return tmpl.reshape(z.shape+(self.npix,))
+
 def deres(f,Rin,Rout,fout=None):
 	assert Rout < Rin
 	if fout is None:
@@ -27,13 +87,72 @@ def resample(x1,y1,x2):
 	resampfun = interp1d(x1,y1)
 	return resampfun(x2)
 
+class DistanceTable(object):
+	'''
+	Cosmological distances tabulated on a dense redshift grid, so that
+	distance moduli and volume elements can be obtained for arrays of
+	redshifts without a numerical integration per element.
+	The line-of-sight comoving distance is integrated over each step of
+	width dz with 5-point Gauss-Legendre quadrature and accumulated, and is
+	linearly interpolated between the nodes. With the default dz=1e-4 the
+	interpolation error in the distance modulus is <1e-6 mag for z>1e-3.
+	The table is extended automatically for redshifts beyond zmax.
+	'''
+	def __init__(self,cosmo,zmax=10.,dz=1e-4):
+		self.cosmo = cosmo
+		self.dz = dz
+		self.D_H = cosmo.hubble_distance.to('Mpc').value
+		self.Ok0 = cosmo.Ok0
+		self.zmax = 0
+		self.extend(zmax)
+	def extend(self,zmax):
+		if zmax <= self.zmax:
+			return
+		self.zmax = max(zmax,2*self.zmax)
+		self.z = np.arange(0,self.zmax+2*self.dz,self.dz)
+		x,w = np.polynomial.legendre.leggauss(5)
+		zq = self.z[:-1,np.newaxis] + 0.5*self.dz*(x+1)
+		dD_C = 0.5*self.dz*np.sum(w*self.cosmo.inv_efunc(zq),axis=-1)
+		self.D_C = self.D_H*np.concatenate([[0],np.cumsum(dD_C)])
+	def comoving_distance(self,z):
+		z = np.asarray(z,dtype=np.float64)
+		if z.size > 0:
+			self.extend(z.max())
+		return np.interp(z,self.z,self.D_C)
+	def comoving_transverse_distance(self,z):
+		D_C = self.comoving_distance(z)
+		if self.Ok0 == 0:
+			return D_C
+		sqrtOk0 = np.sqrt(np.abs(self.Ok0))
+		if self.Ok0 > 0:
+			return self.D_H/sqrtOk0 * np.sinh(sqrtOk0*D_C/self.D_H)
+		else:
+			return self.D_H/sqrtOk0 * np.sin(sqrtOk0*D_C/self.D_H)
+	def distmod(self,z):
+		'''Distance modulus in magnitudes.'''
+		D_L = (1+np.asarray(z))*self.comoving_transverse_distance(z)
+		with np.errstate(divide='ignore'):
+			return 5*np.log10(D_L) + 25
+	def dVdzdO(self,z):
+		'''Differential comoving volume in Mpc^3/sr.'''
+		D_M = self.comoving_transverse_distance(z)
+		return self.D_H * D_M**2 * self.cosmo.inv_efunc(z)
+
+_distanceTables = {}
+
+def getDistanceTable(cosmo):
+	'''Return the DistanceTable for a cosmology, building it if needed.'''
+	key = repr(cosmo)
+	if key not in _distanceTables:
+		_distanceTables[key] = DistanceTable(cosmo)
+	return _distanceTables[key]
+
 def mag2lum(obsBand,restBand,z,cosmo,alpha_nu=-0.5):
 	'''Convert observed mags to absolute mags using a simple power-law 
 	   k-correction.
 	'''
 	z = np.asarray(z)
-	DM = [cosmo.distmod(_z).value for _z in z.flat]
-	DM = np.array(DM).reshape(z.shape)
+	DM = getDistanceTable(cosmo).distmod(z)
 	# CFHT: http://www.cfht.hawaii.edu/Science/mswg/filters.html
 	effWave = {'SDSS-g':4670.,'SDSS-r':6165.,'SDSS-i':7471.,
 	           'CFHT-g':4770.,'CFHT-r':6230.,'CFHT-i':7630.}
@@ -48,3 +167,92 @@ def mag2lum(obsBand,restBand,z,cosmo,alpha_nu=-0.5):
 	           2.5*alpha_nu*np.log10(restWave/obsWave)
 	return kcorr + DM
 
+
+# identifiers for the random streams of the simulation stages, combined
+#  with the master seed to give each stage its own generator
+randomStreams = {'grid':1,'forest':2,'continuum':3,'emissionlines':4,
+                 'dust':5,'photometry':6}
+
+def stageRandomState(seed,stage):
+	'''Independent generator for one stage, derived from the master seed.'''
+	return np.random.RandomState([seed,randomStreams[stage]])
+
+# constants of the SplitMix64 generator
+_golden64 = np.uint64(0x9e3779b97f4a7c15)
+_mixMult = (np.uint64(0xbf58476d1ce4e5b9),np.uint64(0x94d049bb133111eb))
+
+def _mix64(x):
+	'''The SplitMix64 finalizer, a bijective scrambling of uint64 arrays.'''
+	x = x ^ (x >> np.uint64(30))
+	x = x * _mixMult[0]
+	x = x ^ (x >> np.uint64(27))
+	x = x * _mixMult[1]
+	return x ^ (x >> np.uint64(31))
+
+def _hash64(h,v):
+	'''Combine the uint64 hash h with the values v.'''
+	v = np.atleast_1d(np.asarray(v,dtype=np.uint64))
+	return _mix64(h ^ _mix64(v + _golden64))
+
+class ObjectRandomState(object):
+	'''
+	A stand-in for numpy.random.RandomState where each object draws from
+	its own stream, derived from (seed,stage,index,ncall) where index is 
+	the (global) object index and ncall counts the calls made. The values
+	an object receives thus do not depend on which other objects are drawn
+	with it, so any partitioning of the objects into chunks gives the same
+	result.
+	The streams are counter-based: the deviates of all objects are drawn
+	at once by hashing each object's key for the call with a counter over
+	the values it receives (SplitMix64), so that no generator is seeded
+	per object.
+	The size of each draw must include the object dimensions, given by
+	indices.shape and starting at axis; distribution parameters are
+	broadcast to the size.
+	'''
+	def __init__(self,seed,stage,indices,axis=0):
+		self.key = [int(seed),randomStreams[stage]]
+		self.indices = np.asarray(indices)
+		self.axis = axis
+		self.nCall = 0
+		h = _hash64(np.zeros(1,dtype=np.uint64),self.key[0])
+		h = _hash64(h,self.key[1])
+		self._objKeys = _hash64(h,self.indices.ravel())
+	def _uniforms(self,size):
+		'''
+		Two arrays of uniform deviates in [0,1) with shape size, drawn from
+		the object streams for the next call.
+		'''
+		size = (size,) if np.isscalar(size) else tuple(size)
+		objShape = self.indices.shape
+		nd,i0 = len(objShape),self.axis
+		if size[i0:i0+nd] != objShape:
+			raise ValueError('size %s does not include object dimensions %s'
+			                 % (size,objShape))
+		subShape = size[:i0] + size[i0+nd:]
+		nSub = int(np.prod(subShape))
+		callKeys = _hash64(self._objKeys,self.nCall)[:,np.newaxis]
+		self.nCall += 1
+		ctr = np.arange(1,2*nSub+1,dtype=np.uint64) * _golden64
+		bits = _mix64(callKeys + ctr) >> np.uint64(11)
+		u = bits.astype(np.float64) * 2.**-53
+		u = u.reshape(objShape+subShape+(2,))
+		u = np.moveaxis(u,list(range(nd)),list(range(i0,i0+nd)))
+		return u[...,0],u[...,1]
+	def random_sample(self,size):
+		return self._uniforms(size)[0]
+	def rand(self,*shape):
+		return self.random_sample(shape)
+	def standard_normal(self,size):
+		# Box-Muller transform
+		u1,u2 = self._uniforms(size)
+		return np.sqrt(-2*np.log1p(-u1)) * np.cos(2*np.pi*u2)
+	def randn(self,*shape):
+		return self.standard_normal(shape)
+	def normal(self,loc=0.0,scale=1.0,size=None):
+		return loc + scale*self.standard_normal(size)
+	def exponential(self,scale=1.0,size=None):
+		return -scale*np.log1p(-self.random_sample(size))
+	def randint(self,low,high,size):
+		u = self.random_sample(size)
+		return low + np.floor(u*(np.asarray(high)-low)).astype(np.int64)
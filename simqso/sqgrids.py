@@ -9,7 +9,8 @@ from astropy.table import Table
 from astropy.io.fits import Header,getdata
 from astropy.io import ascii as ascii_io
 
-from .sqbase import datadir,mag2lum
+from .sqbase import datadir,mag2lum,getDistanceTable,RestFrameTemplate
+from .sqbase import ObjectRandomState
 from . import dustextinction
 
 class MzGrid(object):
@@ -41,6 +42,31 @@ class MzGrid(object):
 			yield itM[0],itz[0],itM.multi_index
 			itM.iternext()
 			itz.iternext()
+	def iter_blocks(self,size,zSorted=False,indices=None):
+		'''
+		Iterate over the grid in blocks of up to size points. Each step
+		yields (ii,M,z,idx), where ii are the flat indices of the points in
+		the block, M and z their values, and idx the multi-index into the
+		grid as a tuple of index arrays.
+		  zSorted: visit the points in order of increasing redshift
+		  indices: only visit this subset of flat indices
+		With neither option each block is a contiguous range of ii.
+		'''
+		mv = self.mGrid.ravel()
+		zv = self.zGrid.ravel()
+		if indices is None:
+			order = zv.argsort(kind='mergesort') if zSorted else None
+		else:
+			order = np.asarray(indices)
+			if zSorted:
+				order = order[zv[order].argsort(kind='mergesort')]
+		n = len(zv) if order is None else len(order)
+		for i1 in range(0,n,size):
+			if order is None:
+				ii = np.arange(i1,min(i1+size,n))
+			else:
+				ii = order[i1:i1+size]
+			yield ii,mv[ii],zv[ii],np.unravel_index(ii,self.mGrid.shape)
 	def getRedshifts(self,sorted=False,return_index=False):
 		zv = self.zGrid.flatten()
 		if sorted:
@@ -77,7 +103,26 @@ class MzGrid(object):
 		else:
 			raiseValueError
 	def distMod(self,z):
-		return self.cosmo.distmod(z).value
+		return getDistanceTable(self.cosmo).distmod(z)
+	def _sampleCells(self):
+		'''
+		Distribute nPerBin points uniformly within each (M,z) cell, sorted
+		by redshift within the cell. Returns (nM,nz,nPerBin) arrays of the
+		M and z values.
+		All random deviates are drawn in a single call, laid out so that
+		they follow the order of the original loop over cells (nPerBin M
+		values then nPerBin z values for each cell in turn). The grid thus
+		does not change for a given random seed.
+		'''
+		u = np.random.rand(self.nM,self.nz,2,self.nPerBin)
+		mEdges = self.mEdges[:,np.newaxis,np.newaxis]
+		zEdges = self.zEdges[np.newaxis,:,np.newaxis]
+		binM = mEdges[:-1] + np.diff(mEdges,axis=0)*u[:,:,0]
+		binz = zEdges[:,:-1] + np.diff(zEdges,axis=1)*u[:,:,1]
+		zi = binz.argsort(axis=-1)
+		ii,jj = np.ogrid[:self.nM,:self.nz]
+		ii,jj = ii[...,np.newaxis],jj[...,np.newaxis]
+		return binM[ii,jj,zi],binz[ii,jj,zi]
 
 class LuminosityGrid(MzGrid):
 	def __init__(self,gridPar,cosmodef):
@@ -101,17 +146,7 @@ class FixedMzGrid(MzGrid):
 class LuminosityRedshiftGrid(LuminosityGrid):
 	def __init__(self,gridPar,cosmodef):
 		super(LuminosityRedshiftGrid,self).__init__(gridPar,cosmodef)
-		self.mGrid = np.zeros((self.nM,self.nz,self.nPerBin))
-		self.zGrid = np.zeros((self.nM,self.nz,self.nPerBin))
-		dM = np.diff(self.mEdges)
-		dz = np.diff(self.zEdges)
-		for i in range(self.nM):
-			for j in range(self.nz):
-				binM = self.mEdges[i] + dM[i]*np.random.rand(self.nPerBin)
-				binz = self.zEdges[j] + dz[j]*np.random.rand(self.nPerBin)
-				zi = binz.argsort()
-				self.mGrid[i,j,:] = binM[zi]
-				self.zGrid[i,j,:] = binz[zi]
+		self.mGrid,self.zGrid = self._sampleCells()
 	def getLuminosities(self,units='ergs/s/Hz'):
 		# convert M1450 -> ergs/s/Hz
 		pass
@@ -138,18 +173,8 @@ class FluxRedshiftGrid(FluxGrid):
 	'''
 	def __init__(self,gridPar,cosmodef):
 		super(FluxRedshiftGrid,self).__init__(gridPar,cosmodef)
-		self.appMagGrid = np.zeros((self.nM,self.nz,self.nPerBin))
-		self.zGrid = np.zeros((self.nM,self.nz,self.nPerBin))
-		dm = np.diff(self.mEdges)
-		dz = np.diff(self.zEdges)
 		# distribute quasars into bins of flux 
-		for i in range(self.nM):
-			for j in range(self.nz):
-				binm = self.mEdges[i] + dm[i]*np.random.rand(self.nPerBin)
-				binz = self.zEdges[j] + dz[j]*np.random.rand(self.nPerBin)
-				zi = binz.argsort()
-				self.appMagGrid[i,j,:] = binm[zi]
-				self.zGrid[i,j,:] = binz[zi]
+		self.appMagGrid,self.zGrid = self._sampleCells()
 		self.mGrid = self.appMagGrid - self.m2M(self.zGrid)
 
 # XXX needs updating
@@ -181,7 +206,6 @@ class MzGrid_QLFresample(FluxGrid):
 		mrange = (grid.mEdges[0],grid.mEdges[-1])
 		medges,mgrid = qlf.sample_at_flux_intervals(mrange,self.zbins,
 		                                            self.m2M,self.nM,self.nPerBin)
-		self.mEdges = medges
 		self.mEdges = medges - self.m2M(self.zbins)
 		self.mgrid = mgrid
 		self.mGrid = mgrid - self.m2M(self.zGrid)
@@ -193,8 +217,13 @@ class MzGrid_QLFresample(FluxGrid):
 
 class FluxGridFromData(FluxGrid):
 	def __init__(self,mzdata,gridPar,cosmodef):
+		gridPar.setdefault('nPerBin',len(mzdata['z']))
 		super(FluxGridFromData,self).__init__(gridPar,cosmodef)
-		gridshape = (self.nM,self.nz,self.nPerBin)
+		if gridPar.get('GridType') == 'LuminosityFunction':
+			# the points sampled from the LF are not binned
+			gridshape = (self.nPerBin,)
+		else:
+			gridshape = (self.nM,self.nz,self.nPerBin)
 		self.mGrid = mzdata['M'].copy().reshape(gridshape)
 		self.zGrid = mzdata['z'].copy().reshape(gridshape)
 		self.appMagGrid = mzdata['appMag'].copy().reshape(gridshape)
@@ -211,13 +240,22 @@ class LuminosityGridFromData(LuminosityGrid):
 		self.zGrid = mzdata['z'].copy().reshape(gridshape)
 
 class LuminosityFunctionFluxGrid(FluxGrid):
-	def __init__(self,gridPar,qlf,cosmodef,**kwargs):
+	'''
+	A grid of points sampled from a luminosity function. If sample is
+	given, it is used as the (m,z) values of the points instead, e.g. for
+	a chunk from iterLuminosityFunctionSample.
+	'''
+	def __init__(self,gridPar,qlf,cosmodef,sample=None,**kwargs):
 		# workaround -- base constructor needs this value, but we don't have
 		# it until we've done the sampling from the LF
 		gridPar['nPerBin'] = 0
 		super(LuminosityFunctionFluxGrid,self).__init__(gridPar,cosmodef)
-		m,z = qlf.sample_from_fluxrange(gridPar['mRange'],gridPar['zRange'],
-		                                self.m2M,cosmodef,**kwargs)
+		if sample is None:
+			m,z = qlf.sample_from_fluxrange(gridPar['mRange'],
+			                                gridPar['zRange'],
+			                                self.m2M,cosmodef,**kwargs)
+		else:
+			m,z = sample
 		# and need to set it into the parameter list so that it gets saved
 		# properly with the simulation output
 		gridPar['nPerBin'] = len(z)
@@ -226,7 +264,21 @@ class LuminosityFunctionFluxGrid(FluxGrid):
 		self.nPerBin = len(z)
 		self.mGrid = m - self.m2M(z)
 
+def iterLuminosityFunctionSample(gridPar,qlf,cosmodef,chunkSize,seed,
+                                 **kwargs):
+	'''
+	Sample the luminosity function over the flux and redshift ranges of
+	gridPar in chunks of chunkSize objects, yielding the (m,z) values of
+	each chunk. Chunk k is drawn with random seed (seed,k).
+	'''
+	fluxGrid = FluxGrid(dict(gridPar,nPerBin=0),cosmodef)
+	return qlf.iter_sample_from_fluxrange(gridPar['mRange'],gridPar['zRange'],
+	                                      fluxGrid.m2M,fluxGrid.cosmo,
+	                                      chunkSize,seed,**kwargs)
+
 class FixedPLContinuumGrid(object):
+	# slopes are independent of luminosity
+	luminosityDependent = False
 	def __init__(self,M,z,slopes,breakpoints):
 		self.slopes = np.asarray(slopes)
 		self.breakpoints = np.asarray(breakpoints)
@@ -240,12 +292,14 @@ class FixedPLContinuumGrid(object):
 			yield self.slopes,self.breakpoints
 
 class GaussianPLContinuumGrid(object):
-	def __init__(self,M,z,slopeMeans,slopeStds,breakpoints):
+	# slopes are independent of luminosity
+	luminosityDependent = False
+	def __init__(self,M,z,slopeMeans,slopeStds,breakpoints,rng=np.random):
 		self.slopeMeans = slopeMeans
 		self.slopeStds = slopeStds
 		self.breakpoints = np.concatenate([[0,],breakpoints])
 		shape = z.shape+(len(slopeMeans),)
-		x = np.random.randn(*shape)
+		x = rng.randn(*shape)
 		mu = np.asarray(slopeMeans)
 		sig = np.asarray(slopeStds)
 		self.slopes = mu + x*sig
@@ -263,6 +317,8 @@ class GaussianPLContinuumGrid(object):
 		return t
 
 class FixedVdBcompositeEMLineGrid(object):
+	# composite line strengths are independent of luminosity
+	luminosityDependent = False
 	def __init__(self,M,z,minEW=1.0,noFe=False):
 		self.minEW = minEW
 		self.all_lines = ascii_io.read(datadir+
@@ -319,17 +375,14 @@ class FixedVdBcompositeEMLineGrid(object):
 		return None
 
 class VW01FeTemplateGrid(object):
+	# template is independent of luminosity
+	luminosityDependent = False
 	def __init__(self,M,z,wave,fwhm=5000.,scales=None):
-		self.zbins = np.arange(z.min(),z.max()+0.005,0.005)
-		self.feGrid = np.empty((self.zbins.shape[0],wave.shape[0]))
+		self.z = np.array(z)
 		# the Fe template is an equivalent width spectrum
 		wave0,ew0 = self._restFrameFeTemplate(fwhm,scales)
-		for i,zbin in enumerate(self.zbins):
-			# in units of EW - no (1+z) when redshifting
-			rfEW = interp1d(wave0*(1+zbin),ew0,kind='slinear',
-			                bounds_error=False,fill_value=0.0)
-			self.feGrid[i] = rfEW(wave)
-		self.zi = np.searchsorted(self.zbins,z)
+		# in units of EW - no (1+z) when redshifting
+		self.feTemplate = RestFrameTemplate(wave,wave0,ew0)
 	def _loadVW01Fe(self,wave):
 		fepath = datadir+'VW01_Fe/'
 		feTemplate = np.zeros_like(wave)
@@ -373,14 +426,16 @@ class VW01FeTemplateGrid(object):
 		# template fixed in luminosity and redshift
 		return
 	def get(self,idx):
-		return self.feGrid[self.zi[idx]]
+		return self.feTemplate.get(self.z[idx])
 	def getTable(self,hdr):
 		'''Return a Table of all parameters and header information'''
 		hdr['FETEMPL'] = 'Vestergaard & Wilkes 2001 Iron Emission'
 		return None
 
 class VariedEmissionLineGrid(object):
-	def __init__(self,M1450,z,**kwargs):
+	# line strengths follow the luminosity (Baldwin effect)
+	luminosityDependent = True
+	def __init__(self,M1450,z,rng=np.random,**kwargs):
 		trendfn = kwargs.get('EmissionLineTrendFilename','emlinetrends_v5',)
 		self.fixed = kwargs.get('fixLineProfiles',False)
 		self.minEW = kwargs.get('minEW',0.0)
@@ -402,7 +457,7 @@ class VariedEmissionLineGrid(object):
 		xshape = z.shape + (nx,)
 		self.xv = {}
 		for k in ['wavelength','logEW','logWidth']:
-			self.xv[k] = np.random.standard_normal(xshape)
+			self.xv[k] = rng.standard_normal(xshape)
 		# store the line profile values in a structured array with each
 		# element having the same shape as the input grid
 		nf4 = str(z.shape)+'f4'
@@ -471,6 +526,8 @@ class VariedEmissionLineGrid(object):
 		return t
 
 class FixedDustGrid(object):
+	# E(B-V) is independent of luminosity
+	luminosityDependent = False
 	def __init__(self,M,z,dustModel,E_BmV):
 		self.dustModel = dustModel
 		self.E_BmV = E_BmV
@@ -487,18 +544,27 @@ class FixedDustGrid(object):
 		return None
 
 class ExponentialDustGrid(object):
-	def __init__(self,M,z,dustModel,E_BmV_scale,fraction=1):
+	# E(B-V) is independent of luminosity
+	luminosityDependent = False
+	def __init__(self,M,z,dustModel,E_BmV_scale,fraction=1,rng=np.random):
 		self.dustModel = dustModel
 		self.E_BmV_scale = E_BmV_scale
 		self.dust_fn = dustextinction.dust_fn[dustModel]
 		if fraction==1:
-			self.EBVdist = np.random.exponential(E_BmV_scale,M.shape)
+			self.EBVdist = rng.exponential(E_BmV_scale,M.shape)
+		elif isinstance(rng,ObjectRandomState):
+			# each object is independently assigned dust with probability
+			# fraction, so that the draws stay within the object streams
+			print 'using dust LOS fraction ',fraction
+			hasDust = rng.random_sample(M.shape) < fraction
+			EBV = rng.exponential(E_BmV_scale,M.shape)
+			self.EBVdist = np.where(hasDust,EBV,0).astype(np.float32)
 		else:
 			print 'using dust LOS fraction ',fraction
 			self.EBVdist = np.zeros_like(M).astype(np.float32)
 			N = fraction * M.size
-			ii = np.random.randint(0,M.size,(N,))
-			self.EBVdist.flat[ii] = np.random.exponential(E_BmV_scale,(N,)).astype(np.float32)
+			ii = rng.randint(0,M.size,(N,))
+			self.EBVdist.flat[ii] = rng.exponential(E_BmV_scale,(N,)).astype(np.float32)
 	def update(self,M,z):
 		# fixed in luminosity and redshift
 		return
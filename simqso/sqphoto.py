@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+import os
+import hashlib
 import numpy as np
 from collections import OrderedDict
 from scipy.interpolate import interp1d
@@ -42,6 +44,28 @@ def asinhmag2nmgy(_b,m):
 
 # Vega...
 
+#
+# Photometric uncertainty models
+#
+
+class PhotoUncModel(object):
+	'''
+	Base class for photometric uncertainty models. A model is constructed
+	for the list of bands used from a photo system, and is called with an
+	array of fluxes in nanomaggies with those bands along the last axis
+	(e.g., Nqso x Nbands), returning the flux uncertainties for all of the
+	bands at once. Any random draws are taken from rng, which can be a
+	RandomState or the numpy.random module [default].
+	Per-band parameters are stored as arrays over the bands.
+	'''
+	def __init__(self,bands):
+		self.bands = list(bands)
+	def _bandpars(self,pars):
+		'''Select the values for the model bands from a per-band dict.'''
+		return np.array([ pars[b] for b in self.bands ])
+	def __call__(self,f_nmgy,rng=np.random):
+		raise NotImplementedError
+
 #
 # SDSS photometry model
 #
@@ -55,46 +79,46 @@ _sdss_phot_pars = {
   'nMgyPerCount':[ 0.00981, 0.00378, 0.00507, 0.00662, 0.0337, ],
 }
 
-class sdssPhotoUnc(object):
-	'''sdss_photo_unc(b,f_nmgy)
-	   In a given SDSS band b, provide the uncertainty for a given flux in 
+class sdssPhotoUnc(PhotoUncModel):
+	'''sdssPhotoUnc(bands)
+	   In the given SDSS bands, provide the uncertainty for a given flux in 
 	   nanomaggies (f_nmgy) based on the distribution of observing conditions.
 	   --> Currently underestimates true scatter by using gaussians for the
 	       scatter, whereas the true distributions generally have long tails
 		   to higher values for sky, nEff, etc.
 	   see http://classic.sdss.org/dr7/algorithms/fluxcal.html for details
 	'''
-	def __init__(self,b):
-		i = 'ugriz'.find(b)
+	def __init__(self,bands):
+		super(sdssPhotoUnc,self).__init__(bands)
+		ii = [ 'ugriz'.find(b) for b in self.bands ]
 		self.pixArea = 0.396**2 # pix -> arcsec^2
-		self.gain = _sdss_phot_pars['gain'][i]
-		self.darkVar = _sdss_phot_pars['darkVariance'][i]
-		self.skyMean = _sdss_phot_pars['sky'][i]
-		self.skyStd = {'u':0.4,'g':0.4,'r':1.2,'i':2.0,'z':5.0}[b]
-		self.skyMin = {'u':0.6,'g':1.0,'r':2.2,'i':3.2,'z':8.3}[b]
+		self.gain = np.array(_sdss_phot_pars['gain'])[ii]
+		self.darkVar = np.array(_sdss_phot_pars['darkVariance'])[ii]
+		self.skyMean = np.array(_sdss_phot_pars['sky'])[ii]
+		self.skyStd = self._bandpars({'u':0.4,'g':0.4,'r':1.2,'i':2.0,'z':5.0})
+		self.skyMin = self._bandpars({'u':0.6,'g':1.0,'r':2.2,'i':3.2,'z':8.3})
 		#skyErr_nmgy = _sdss_phot_pars['skyErr'][i] # not used...
 		# nEffPsf distribution is roughly similar in all bands
-		self.npixMean = _sdss_phot_pars['nEffPsf'][i]
+		self.npixMean = np.array(_sdss_phot_pars['nEffPsf'])[ii]
 		self.npixStd = 5.0
 		self.npixMin = 10.0
-		self.c2fMean = _sdss_phot_pars['nMgyPerCount'][i]
-		self.c2fStd = {'u':2.3e-3,'g':3.9e-4,'r':2.7e-4,
-		               'i':3.7e-4,'z':5.6e-3}[b]
-		self.c2fMin = {'u':5.7e-3,'g':2.3e-3,'r':3.5e-3,
-		               'i':4.7e-3,'z':1.4e-2}[b]
+		self.c2fMean = np.array(_sdss_phot_pars['nMgyPerCount'])[ii]
+		self.c2fStd = self._bandpars({'u':2.3e-3,'g':3.9e-4,'r':2.7e-4,
+		                              'i':3.7e-4,'z':5.6e-3})
+		self.c2fMin = self._bandpars({'u':5.7e-3,'g':2.3e-3,'r':3.5e-3,
+		                              'i':4.7e-3,'z':1.4e-2})
 		# add in a global photometric calibration error term
 		self.calibrationError = 0.015
-	def __call__(self,f_nmgy):
+	def __call__(self,f_nmgy,rng=np.random):
 		shape = f_nmgy.shape
 		gain = self.gain
 		pixArea = self.pixArea
 		darkVar = self.darkVar
-		sky_nmgy_asec2 = np.clip(np.random.normal(self.skyMean,
-		                                          self.skyStd,shape),
+		sky_nmgy_asec2 = np.clip(rng.normal(self.skyMean,self.skyStd,shape),
 		                         self.skyMin,np.inf)
-		npix = np.clip(np.random.normal(self.npixMean,self.npixStd,shape),
+		npix = np.clip(rng.normal(self.npixMean,self.npixStd,shape),
 		               self.npixMin,np.inf)
-		c2f = np.clip(np.random.normal(self.c2fMean,self.c2fStd,shape),
+		c2f = np.clip(rng.normal(self.c2fMean,self.c2fStd,shape),
 		              self.c2fMin,np.inf)
 		df = np.sqrt( f_nmgy*(c2f/gain) + 
 		               sky_nmgy_asec2*pixArea*npix*(c2f/gain) +
@@ -102,86 +126,77 @@ class sdssPhotoUnc(object):
 		                 (self.calibrationError*f_nmgy)**2 )
 		return df
 
-class empiricalPhotoUnc(object):
+class empiricalPhotoUnc(PhotoUncModel):
 	'''approximation only valid in sky-dominated regime'''
-	def __call__(self,f_nmgy):
+	def _setTerms(self,bandNames,terms):
+		ii = [ bandNames.find(b) for b in self.bands ]
+		terms = np.asarray(terms)[ii]
+		self.a,self.b = terms[:,0],terms[:,1]
+		if terms.shape[1] > 3:
+			self.scatter_a,self.scatter_b = terms[:,2],terms[:,3]
+		else:
+			# ignoring magnitude-dependent scatter since all useful fluxes
+			# are in the sky-dominated regime
+			self.scatter_a,self.scatter_b = 0.0,terms[:,2]
+		# calibration uncertainty floor
+		self.err_floor = 0.015
+	def __call__(self,f_nmgy,rng=np.random):
 		shape = f_nmgy.shape
 		# set the flux for non-detections to be at d(mag) = 1.0
 		magLim = self.b / self.a
-		magAB = np.clip(nmgy2abmag(self.b,f_nmgy),0,magLim)
+		magAB = np.clip(nmgy2abmag(None,f_nmgy),0,magLim)
 		scatter = np.clip(self.scatter_a*magAB + self.scatter_b, 0.01, np.inf)
-		b = self.b + scatter*np.random.normal(size=shape)
+		b = self.b + scatter*rng.normal(size=shape)
 		log_dm = 2.5*(self.a*magAB - b)
 		dm = np.clip(10**log_dm, self.err_floor, np.inf)
-		f = np.clip(f_nmgy,abmag2nmgy(self.band,magLim),np.inf)
+		f = np.clip(f_nmgy,abmag2nmgy(None,magLim),np.inf)
 		return f * dm / 1.0857
 
 class ukidsslasPhotoUnc(empiricalPhotoUnc):
-	def __init__(self,b):
+	def __init__(self,bands):
+		super(ukidsslasPhotoUnc,self).__init__(bands)
 		UKIDSS_LAS_terms = np.array([[0.13616,3.1360,0.029],
 		                             [0.14665,3.3081,0.043],
 		                             [0.14429,3.2105,0.040],
 		                             [0.15013,3.3053,0.028]])
-		self.band = b
-		i = 'YJHK'.find(b)
-		self.a,self.b,self.scatter_b = UKIDSS_LAS_terms[i]
-		# ignoring magnitude-dependent scatter since all useful fluxes are
-		# in the sky-dominated regime
-		self.scatter_a = 0.0
+		self._setTerms('YJHK',UKIDSS_LAS_terms)
 		# scatter seems to be slightly overestimated
 		self.scatter_b *= 0.9
-		# calibration uncertainty floor
-		self.err_floor = 0.015
 
 class ukidssdxsPhotoUnc(empiricalPhotoUnc):
 	'''as with Stripe82, not valid at bright magnitudes (m<~20)'''
-	def __init__(self,b):
+	def __init__(self,bands):
+		super(ukidssdxsPhotoUnc,self).__init__(bands)
 		UKIDSS_DXS_terms = np.array([[0.13408,3.3978,0.016],
                                      [0.14336,3.5461,0.023]])
-		self.band = b
-		i = 'JK'.find(b)
-		self.a,self.b,self.scatter_b = UKIDSS_DXS_terms[i]
-		# ignoring magnitude-dependent scatter since all useful fluxes are
-		# in the sky-dominated regime
-		self.scatter_a = 0.0
+		self._setTerms('JK',UKIDSS_DXS_terms)
 		# scatter seems to be slightly overestimated again (?)
 		self.scatter_b *= 0.8
-		# calibration uncertainty floor
-		self.err_floor = 0.015
 
 class sdssStripe82PhotoUnc(empiricalPhotoUnc):
 	'''this fails at m<~18 when SDSS detections are no longer sky-dominated,
 	   but not really interested in bright objects on the Stripe...
 	   also, dominated by calibration uncertainty for bright objects anyway
     '''
-	def __init__(self,b):
+	def __init__(self,bands):
+		super(sdssStripe82PhotoUnc,self).__init__(bands)
 		stripe82terms = np.array([[0.15127,3.8529,0.00727,-0.1308],
                                   [0.15180,4.0233,0.00486,-0.0737],
                                   [0.14878,3.8970,0.00664,-0.1077],
                                   [0.14780,3.8024,0.00545,-0.0678],
                                   [0.14497,3.5437,0.00715,-0.1121]])
-		self.band = b
-		i = 'ugriz'.find(b)
-		self.a,self.b,self.scatter_a,self.scatter_b = stripe82terms[i]
-		# calibration uncertainty floor
-		self.err_floor = 0.015
+		self._setTerms('ugriz',stripe82terms)
 
 class cfhtlsWidePhotoUnc(empiricalPhotoUnc):
 	'''as with Stripe82, not valid at bright magnitudes (m<~19)'''
-	def __init__(self,b):
+	def __init__(self,bands):
+		super(cfhtlsWidePhotoUnc,self).__init__(bands)
 		cfhtlswideterms = np.array([[0.16191,4.4005,0.037],
                                     [0.15508,4.3392,0.034],
                                     [0.15902,4.3399,0.015],
                                     [0.15721,4.2786,0.028],
                                     [0.16092,4.1967,0.034]])
-		self.band = b
-		i = 'ugriz'.find(b)
-		self.a,self.b,self.scatter_b = cfhtlswideterms[i]
-		# ignoring magnitude-dependent scatter since all useful fluxes are
-		# in the sky-dominated regime
-		self.scatter_a = 0.0
-		# calibration uncertainty floor
-		self.err_floor = 0.015
+		self._setTerms('ugriz',cfhtlswideterms)
 
 
 # WISE photometric model
@@ -200,31 +215,30 @@ _wise_phot_pars = {
   'ABtoVega':{'W1':2.699,'W2':3.339,'W3':5.174,'W4':6.620},
 }
 
-class allwisePhotoUnc(object):
-	def __init__(self,b):
-		self.band = b
-		self.n = _wise_phot_pars['n'][b]
-		self.n_lo = _wise_phot_pars['n_lo'][b]
-		self.n_hi = _wise_phot_pars['n_hi'][b]
-		self.a = _wise_phot_pars['a'][b]
-		self.a_lo = _wise_phot_pars['a_lo'][b]
-		self.a_hi = _wise_phot_pars['a_hi'][b]
-		self.vegaConv = _wise_phot_pars['ABtoVega'][b]
-	def __call__(self,f_nmgy):
-		vegaMag = nmgy2abmag(self.band,f_nmgy) - self.vegaConv
+class allwisePhotoUnc(PhotoUncModel):
+	def __init__(self,bands):
+		super(allwisePhotoUnc,self).__init__(bands)
+		pars = {}
+		for k in ['n','n_lo','n_hi','a','a_lo','a_hi']:
+			# the depth variation terms are only available for some bands
+			pars[k] = np.array([ _wise_phot_pars[k].get(b,np.nan) 
+			                       for b in self.bands ])
+		self.n,self.n_lo,self.n_hi = pars['n'],pars['n_lo'],pars['n_hi']
+		self.a,self.a_lo,self.a_hi = pars['a'],pars['a_lo'],pars['a_hi']
+		self.depthVar = np.isfinite(self.n_lo) & np.isfinite(self.a_lo)
+		self.vegaConv = self._bandpars(_wise_phot_pars['ABtoVega'])
+	def __call__(self,f_nmgy,rng=np.random):
+		vegaMag = nmgy2abmag(None,f_nmgy) - self.vegaConv
 		sig_m = self.a + 1.0857*self.n/(10**(-0.4*vegaMag))
 		s = f_nmgy.shape
-		try:
-			# this is legacy code for approximating the depth variations
-			# over the sky, not really sure how valid it is
-			sig_m_lo = self.a_lo + 1.0857*self.n_lo/(10**(-0.4*vegaMag))
-			sig_m_hi = self.a_hi + 1.0857*self.n_hi/(10**(-0.4*vegaMag))
-			lo = np.abs(np.random.normal(scale=0.5*(sig_m-sig_m_lo),size=s))
-			hi = np.abs(np.random.normal(scale=0.5*(sig_m_hi-sig_m),size=s))
-			x = np.random.random(size=s)
-			sig_m += np.choose(x<0.5,[hi,-lo])
-		except:
-			pass
+		# this is legacy code for approximating the depth variations
+		# over the sky, not really sure how valid it is
+		sig_m_lo = self.a_lo + 1.0857*self.n_lo/(10**(-0.4*vegaMag))
+		sig_m_hi = self.a_hi + 1.0857*self.n_hi/(10**(-0.4*vegaMag))
+		lo = np.abs(0.5*(sig_m-sig_m_lo)*rng.normal(size=s))
+		hi = np.abs(0.5*(sig_m_hi-sig_m)*rng.normal(size=s))
+		x = rng.random_sample(size=s)
+		sig_m = np.where(self.depthVar,sig_m+np.where(x<0.5,-lo,hi),sig_m)
 		sig_m = np.clip(sig_m,0.03,np.inf)
 		return sig_m * f_nmgy / 1.0857
 
@@ -245,13 +259,89 @@ supported_photo_systems = {
   },
 }
 
+#
+# filter curve registry
+#
+
+filterCurveFile = datadir+'filtercurves.fits'
+
+class FilterCurve(object):
+	'''
+	A bandpass response curve read from the filter file, with the
+	interpolating function and the normalization computed once.
+	'''
+	def __init__(self,name,lam,Rlam,norm=None):
+		self.name = name
+		self.data = np.rec.fromarrays([lam,Rlam],names='lam,Rlam')
+		self.Rlam = interp1d(self.data.lam,self.data.Rlam,
+		                     bounds_error=False,fill_value=0.0,kind='slinear')
+		if norm is None:
+			# precompute the bandpass normalization
+			norm = simps(self.data.Rlam/self.data.lam, self.data.lam)
+		self.norm = norm
+
+_filterCurves = {}
+
+def _filterCachePath():
+	return os.path.splitext(filterCurveFile)[0] + '_cache.npz'
+
+def _load_persisted_filters():
+	cacheFile = _filterCachePath()
+	try:
+		if os.path.getmtime(cacheFile) < os.path.getmtime(filterCurveFile):
+			return
+		cache = np.load(cacheFile)
+	except (IOError,OSError):
+		return
+	for name in cache['names']:
+		name = str(name)
+		if name not in _filterCurves:
+			_filterCurves[name] = FilterCurve(name,cache[name+'_lam'],
+			                                  cache[name+'_Rlam'],
+			                                  float(cache[name+'_norm']))
+
+def _persist_filters():
+	arrs = {'names':np.array(sorted(_filterCurves))}
+	for name,fc in _filterCurves.items():
+		arrs[name+'_lam'] = fc.data.lam
+		arrs[name+'_Rlam'] = fc.data.Rlam
+		arrs[name+'_norm'] = fc.norm
+	try:
+		with open(_filterCachePath(),'wb') as f:
+			np.savez(f,**arrs)
+	except (IOError,OSError):
+		# e.g., a read-only installation
+		pass
+
+def getFilterCurves(names,persist=False):
+	'''
+	Return the FilterCurves for the extension names in the filter file.
+	Curves are kept for the lifetime of the process, and only extensions
+	not already loaded are read from the file. If persist is True, the
+	curves are also saved to (and restored from) a cache file next to the
+	filter file.
+	'''
+	missing = [ name for name in names if name not in _filterCurves ]
+	if missing and persist:
+		_load_persisted_filters()
+		missing = [ name for name in names if name not in _filterCurves ]
+	if missing:
+		with fits.open(filterCurveFile) as filterdata:
+			for name in missing:
+				fdat = filterdata[name].data
+				# copy the columns out so the file can be closed
+				_filterCurves[name] = FilterCurve(name,np.array(fdat['lam']),
+				                                  np.array(fdat['Rlam']))
+		if persist:
+			_persist_filters()
+	return [ _filterCurves[name] for name in names ]
+
 # should find a better container / organization for this
 def load_photo_map(params):
 	bandpasses = OrderedDict()
-	filterdata = fits.open(datadir+'filtercurves.fits')
-	mapObserved = {}
+	uncMaps = []
 	magSys = {}
-	filtName = {} # ugh
+	filtName = OrderedDict() # ugh
 	for photDesc in params['PhotoSystems']:
 		try:
 			photSysName,survey,bands = photDesc
@@ -265,24 +355,45 @@ def load_photo_map(params):
 			                 (photSysName,survey))
 		if bands is None:
 			bands = photSys['bands']
+		# one uncertainty model for all of the bands in the photo system
+		j = len(filtName)
+		uncMaps.append((photSys['uncMap'](bands),slice(j,j+len(bands))))
 		for band in bands:
 			bpName = '-'.join([photSysName,survey,band])
 			# a workaround for the naming of the extension in the filter file
 			_photSysName = {'UKIRT':'UKIDSS'}.get(photSysName,photSysName)
 			bpExt = '-'.join([_photSysName,band])
-			fdat = filterdata[bpExt].data
-			fcurv = interp1d(fdat.lam,fdat.Rlam,
-			                 bounds_error=False,fill_value=0.0,kind='slinear')
-			# precompute the bandpass normalization
-			norm = simps(fdat.Rlam/fdat.lam, fdat.lam)
-			bandpasses[bpName] = dict(Rlam=fcurv,norm=norm,data=fdat)
-			mapObserved[bpName] = photSys['uncMap'](band)
 			magSys[bpName] = photSys['magSys']
 			filtName[bpName] = bpExt
-	return dict(bandpasses=bandpasses,mapObserved=mapObserved,
+	filterCurves = getFilterCurves(filtName.values(),
+	                               persist=params.get('PersistFilterCache',
+	                                                  False))
+	for bpName,fc in zip(filtName,filterCurves):
+		bandpasses[bpName] = dict(Rlam=fc.Rlam,norm=fc.norm,data=fc.data)
+	return dict(bandpasses=bandpasses,uncMaps=uncMaps,
 	            magSys=magSys,filtName=filtName)
 
-def getPhotoCache(wave,photoMap):
+_photoCaches = OrderedDict()
+
+def getPhotoCache(wave,photoMap,maxCaches=16):
+	'''
+	Return the per-band pixel ranges and weights for synthetic photometry
+	on the wavelength grid. The results are cached by a hash of the grid
+	and the bandpass names, keeping the most recent maxCaches entries.
+	'''
+	wave = np.ascontiguousarray(wave)
+	key = (hashlib.sha1(wave.view(np.uint8)).hexdigest(),wave.dtype.str,
+	       tuple(photoMap['bandpasses']))
+	if key in _photoCaches:
+		photoCache = _photoCaches.pop(key)
+	else:
+		photoCache = _build_photo_cache(wave,photoMap)
+		if len(_photoCaches) >= maxCaches:
+			_photoCaches.popitem(last=False)
+	_photoCaches[key] = photoCache
+	return photoCache
+
+def _build_photo_cache(wave,photoMap):
 	photoCache = {}
 	for b,bp in photoMap['bandpasses'].items():
 		bpdata = bp['data']
@@ -300,36 +411,60 @@ def getPhotoCache(wave,photoMap):
 conv_Slam_to_Snu = 1/(c_Angs * 3631e-23)
 
 def calcSynPhot(spec,photoMap,photoCache=None,mags=None,fluxes=None):
+	'''
+	Synthetic photometry for a spectrum, or for a block of spectra if
+	spec.f_lambda has shape (K,npix), in which case the mags and fluxes
+	have shape (K,Nbands).
+	'''
+	shape = spec.f_lambda.shape[:-1] + (len(photoMap['bandpasses']),)
 	if mags is None:
-		mags = np.zeros(len(photoMap['bandpasses']))
+		mags = np.zeros(shape)
 	if fluxes is None:
-		fluxes = np.zeros(len(photoMap['bandpasses']))
+		fluxes = np.zeros(shape)
 	if photoCache is None:
 		photoCache = getPhotoCache(spec.wave,photoMap)
 	for j,b in enumerate(photoMap['bandpasses']):
 		fnorm = photoMap['bandpasses'][b]['norm']
 		i1,i2 = photoCache[b]['ii']
 		lamRlamdlam = photoCache[b]['lam_Rlam_dlam']
-		flam = spec.f_lambda[i1:i2]
-		flux = np.sum(flam*lamRlamdlam) / fnorm
-		fluxes[j] = flux * conv_Slam_to_Snu 
-		if fluxes[j] == 0:
-			mags[j] = 99.99
-		else:
-			mags[j] = min(-2.5*np.log10(fluxes[j]),99.99)  # AB mag
+		flam = spec.f_lambda[...,i1:i2]
+		flux = np.sum(flam*lamRlamdlam,axis=-1) / fnorm
+		fluxes[...,j] = flux * conv_Slam_to_Snu 
+		with np.errstate(divide='ignore',invalid='ignore'):
+			mags[...,j] = np.where(fluxes[...,j] == 0, 99.99,
+			                np.minimum(-2.5*np.log10(fluxes[...,j]),99.99))
 	fluxes *= 1e9 # nanomaggies
 	return mags,fluxes
 
-def calcObsPhot(synFlux,photoMap):
-	obsFlux = np.empty_like(synFlux)
-	obsFluxErr = np.empty_like(synFlux)
-	obsMag = np.empty_like(synFlux)
-	obsMagErr = np.empty_like(synFlux)
-	gridShape = synFlux.shape[:-1]
+def calcFluxErrors(synFlux,photoMap,rng=np.random):
+	'''
+	Flux uncertainties for all bands of synFlux (bands along the last
+	axis), with one call to the uncertainty model of each photo system.
+	'''
+	fluxErr = np.empty(synFlux.shape)
+	for uncMap,ii in photoMap['uncMaps']:
+		fluxErr[...,ii] = uncMap(synFlux[...,ii],rng)
+	return fluxErr
+
+def calcObsPhot(synFlux,photoMap,nRealizations=None,dtype=np.float32,
+                rng=np.random):
+	'''
+	Map the synthetic fluxes (nanomaggies, with bands along the last axis)
+	to observed fluxes and magnitudes with uncertainties. All random draws
+	are taken from rng [default: the numpy.random module]. If 
+	nRealizations is given, that many independent noise realizations are
+	drawn at once and the outputs have shape 
+	synFlux.shape+(nRealizations,) with type dtype, i.e., the realization
+	axis is last.
+	'''
+	if nRealizations is not None:
+		return calcObsPhotRealizations(synFlux,photoMap,nRealizations,dtype,
+		                               rng)
+	obsFluxErr = calcFluxErrors(synFlux,photoMap,rng)
+	obsFlux = synFlux + obsFluxErr*rng.randn(*synFlux.shape)
+	obsMag = np.empty_like(obsFlux)
+	obsMagErr = np.empty_like(obsFlux)
 	for j,b in enumerate(photoMap['bandpasses']):
-		obsFluxErr[...,j] = photoMap['mapObserved'][b](synFlux[...,j])
-		obsFlux[...,j] = synFlux[...,j] + \
-		                   obsFluxErr[...,j]*np.random.randn(*gridShape)
 		if photoMap['magSys'][b]=='AB':
 			obsMag[...,j],obsMagErr[...,j] = nmgy2abmag(b,obsFlux[...,j],
 			                                            obsFluxErr[...,j])
@@ -341,3 +476,15 @@ def calcObsPhot(synFlux,photoMap):
 	return {'obsFlux':obsFlux,'obsFluxErr':obsFluxErr,
 	        'obsMag':obsMag,'obsMagErr':obsMagErr}
 
+def calcObsPhotRealizations(synFlux,photoMap,nRealizations,dtype=np.float32,
+                            rng=np.random):
+	'''
+	Draw nRealizations noisy versions of the synthetic fluxes at once, by
+	mapping the fluxes broadcast to (nRealizations,)+synFlux.shape. See 
+	calcObsPhot.
+	'''
+	synFlux = np.asarray(synFlux)
+	f = np.broadcast_to(synFlux,(nRealizations,)+synFlux.shape)
+	photoData = calcObsPhot(f,photoMap,rng=rng)
+	return { k:np.rollaxis(arr,0,arr.ndim).astype(dtype)
+	           for k,arr in photoData.items() }
@@ -1,12 +1,20 @@
 #!/usr/bin/env python
 
 import os
+import re
 import ast
-from copy import copy
+from copy import copy,deepcopy
 import time
+import zlib
+import hashlib
+import shutil
+import tempfile
+from collections import OrderedDict
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import numpy as np
 from astropy.io import fits
-from astropy.table import Table,hstack
+from astropy.table import Table
 from astropy import cosmology
 
 from . import sqbase
@@ -28,6 +36,25 @@ def buildWaveGrid(simParams):
 	return wave
 
 
+def _stageRandom(simParams,stagePars,stage,shape=None,axis=0):
+	'''
+	Random generator for a simulation stage. By default, the numpy.random
+	module reseeded with the stage seed. If simParams['RandomStreams'] is 
+	set, an independent stream for the stage derived from the seed, which
+	is split into one stream per object (with object dimensions shape) if
+	shape is given. Objects are indexed starting from
+	simParams['ObjectIndexOffset'] [default:0].
+	'''
+	seed = stagePars.get('RandomSeed',simParams.get('RandomSeed'))
+	if not simParams.get('RandomStreams',False):
+		np.random.seed(seed)
+		return np.random
+	if shape is None:
+		return sqbase.stageRandomState(seed,stage)
+	indices = np.arange(np.prod(shape)).reshape(shape)
+	indices += simParams.get('ObjectIndexOffset',0)
+	return sqbase.ObjectRandomState(seed,stage,indices,axis)
+
 def buildMzGrid(simParams):
 	'''
 	Create a grid of points in (M,z) space, each of these points are
@@ -39,7 +66,10 @@ def buildMzGrid(simParams):
 		gridType = gridPars['GridType']
 	except KeyError:
 		raise ValueError('Must specify a GridType')
-	np.random.seed(gridPars.get('RandomSeed',simParams.get('RandomSeed')))
+	rng = _stageRandom(simParams,gridPars,'grid')
+	if rng is not np.random:
+		# the grid samplers draw from numpy.random
+		np.random.set_state(rng.get_state())
 	if gridType == 'LuminosityFunction':
 		try:
 			qlf = gridPars['QLFmodel']
@@ -68,7 +98,7 @@ def buildMzGrid(simParams):
 
 
 
-def buildForest(wave,z,simParams,outputDir):
+def buildForest(wave,z,simParams,outputDir,reuse=True):
 	'''
     Create a set of absorbers for a given number of lines-of-sight, 
 	sampled according to the input forest model. Then calculate the
@@ -76,40 +106,51 @@ def buildForest(wave,z,simParams,outputDir):
 	to individual QSOs. The number of LOSs is generally smaller so that
 	fewer forest computations are needed; individual LOSs are built up
 	in redshift steps as each QSO redshift is iterated.
+	If reuse is False, sightline forests are always generated and not
+	saved (a forest grid is still read from outputDir).
 	'''
 	forestParams = simParams['ForestParams']
-	np.random.seed(forestParams.get('RandomSeed',
-	               simParams.get('RandomSeed')))
+	rng = _stageRandom(simParams,forestParams,'forest',z.shape)
+	streamPars = {}
+	if rng is not np.random:
+		seed = forestParams.get('RandomSeed',simParams.get('RandomSeed'))
+		losSeed = (seed,sqbase.randomStreams['forest'])
+		streamPars = dict(rng=rng,losSeed=losSeed,losIds=rng.indices)
 	forestType = forestParams.get('ForestType','Sightlines')
 	nlos = forestParams.get('NumLinesOfSight',-1)
 	forestFn = forestParams['FileName']
 	if forestType == 'OneToOne':
 		nlos = -1
 	forestSpec = None
-	try:
-		print 'loading forest ',forestFn
-		forestSpec = hiforest.load_spectra(forestFn,outputDir)
-	except IOError:
-		pass
+	if reuse or forestType == 'Grid':
+		try:
+			print 'loading forest ',forestFn
+			forestSpec = hiforest.load_spectra(forestFn,outputDir)
+		except IOError:
+			pass
 	if forestType in ['Sightlines','OneToOne']:
 		if forestSpec is None:
 			print '... not found, generating forest'
 			forestSpec = hiforest.generate_N_spectra(wave,z,nlos,
-			                                         **forestParams)
-			hiforest.save_spectra(forestSpec,forestFn,outputDir)
+			                                 **dict(forestParams,**streamPars))
+			if reuse:
+				hiforest.save_spectra(forestSpec,forestFn,outputDir)
 	elif forestType == 'Grid':
 		if forestSpec is None:
 			raise ValueError('Need to supply a forest grid')
+		if 'rng' in streamPars:
+			forestPars = dict(forestParams,rng=rng)
+		else:
+			forestPars = forestParams
 		forestSpec = hiforest.generate_spectra_from_grid(wave,z,forestSpec,
-		                                                 **forestParams)
+		                                                 **forestPars)
 	print 'done!'
 	return forestSpec
 
 
 def buildContinuumModels(Mz,simParams):
 	continuumParams = simParams['QuasarModelParams']['ContinuumParams']
-	np.random.seed(continuumParams.get('RandomSeed',
-	               simParams.get('RandomSeed')))
+	rng = _stageRandom(simParams,continuumParams,'continuum',Mz.zGrid.shape)
 	slopes = continuumParams['PowerLawSlopes'][::2]
 	breakpts = continuumParams['PowerLawSlopes'][1::2]
 	print '... building continuum grid'
@@ -117,7 +158,8 @@ def buildContinuumModels(Mz,simParams):
 		meanSlopes = [s[0] for s in slopes]
 		stdSlopes = [s[1] for s in slopes]
 		continuumGrid = grids.GaussianPLContinuumGrid(Mz.mGrid,Mz.zGrid,
-		                                     meanSlopes,stdSlopes,breakpts)
+		                                     meanSlopes,stdSlopes,breakpts,
+		                                     rng=rng)
 	elif continuumParams['ContinuumModel'] == 'FixedPLawDistribution':
 		continuumGrid = grids.FixedPLContinuumGrid(Mz.mGrid,Mz.zGrid,
 		                                           slopes,breakpts)
@@ -129,7 +171,8 @@ def buildContinuumModels(Mz,simParams):
 
 def buildEmissionLineGrid(Mz,simParams):
 	emLineParams = simParams['QuasarModelParams']['EmissionLineParams']
-	np.random.seed(emLineParams.get('RandomSeed',simParams.get('RandomSeed')))
+	rng = _stageRandom(simParams,emLineParams,'emissionlines',
+	                   Mz.zGrid.shape)
 	try:
 		# if the user has passed in a model, instantiate it
 		emLineGrid = emLineParams['EmissionLineModel'](Mz.mGrid,Mz.zGrid,
@@ -149,7 +192,7 @@ def buildEmissionLineGrid(Mz,simParams):
 #		emLineGrid = qsotemplates.FixedLBQSemLineGrid(
 #		                                noFe=emLineParams.get('LBQSnoFe',False))
 	elif emLineParams['EmissionLineModel'] == 'VariedEmissionLineGrid':
-		emLineGrid = grids.VariedEmissionLineGrid(Mz.mGrid,Mz.zGrid,
+		emLineGrid = grids.VariedEmissionLineGrid(Mz.mGrid,Mz.zGrid,rng=rng,
 		                                          **emLineParams)
 	else:
 		raise ValueError('invalid emission line model: ' +
@@ -163,14 +206,15 @@ def buildEmissionLineGrid(Mz,simParams):
 def buildDustGrid(Mz,simParams):
 	print '... building dust extinction grid'
 	dustParams = simParams['QuasarModelParams']['DustExtinctionParams']
-	np.random.seed(dustParams.get('RandomSeed',simParams.get('RandomSeed')))
+	rng = _stageRandom(simParams,dustParams,'dust',Mz.zGrid.shape)
 	if dustParams['DustExtinctionModel'] == 'Fixed E(B-V)':
 		dustGrid = grids.FixedDustGrid(Mz.mGrid,Mz.zGrid,
 		                 dustParams['DustModelName'],dustParams['E(B-V)'])
 	elif dustParams['DustExtinctionModel']=='Exponential E(B-V) Distribution':
 		dustGrid = grids.ExponentialDustGrid(Mz.mGrid,Mz.zGrid,
 		                 dustParams['DustModelName'],dustParams['E(B-V)'],
-		                 fraction=dustParams.get('DustLOSfraction',1.0))
+		                 fraction=dustParams.get('DustLOSfraction',1.0),
+		                 rng=rng)
 	else:
 		raise ValueError('invalid dust extinction model: '+
 		                 dustParams['DustExtinctionModel'])
@@ -182,13 +226,21 @@ class SpectralFeature(object):
 		self.grid = grid
 	def update(self,*args):
 		self.grid.update(*args)
+	def luminosityDependent(self):
+		# assume user-supplied models depend on luminosity unless they
+		# declare otherwise
+		return getattr(self.grid,'luminosityDependent',True)
 	def getTable(self,hdr):
 		return self.grid.getTable(hdr)
 
 class EmissionLineFeature(SpectralFeature):
+	def __init__(self,grid,profiles='exact',tol=1e-3):
+		super(EmissionLineFeature,self).__init__(grid)
+		self.profiles = profiles
+		self.tol = tol
 	def apply_to_spec(self,spec,idx):
 		emlines = self.grid.get(idx)
-		spec.addEmissionLines(emlines)
+		spec.addEmissionLines(emlines,profiles=self.profiles,tol=self.tol)
 
 class IronEmissionFeature(SpectralFeature):
 	def apply_to_spec(self,spec,idx):
@@ -196,16 +248,47 @@ class IronEmissionFeature(SpectralFeature):
 		spec.addTemplate('Fe',feTemplate)
 
 class DustExtinctionFeature(SpectralFeature):
+	'''
+	Dust attenuation exp(-0.921 E(B-V) k(lambda_rest)). When the observed
+	wavelength grid and redshift range are given, k(lambda) is evaluated
+	once on a rest-frame template and the attenuation for any number of
+	objects is computed as an outer product with E(B-V) in a single exp.
+	Otherwise the dust function of the grid is evaluated for each object.
+	'''
+	def __init__(self,grid,wave=None,zRange=None):
+		super(DustExtinctionFeature,self).__init__(grid)
+		self.kbasis = None
+		klam = dustextinction.dust_klam.get(getattr(grid,'dustModel',None))
+		if klam is not None and wave is not None:
+			self.zRange = zRange
+			restRange = (wave[0]/(1+zRange[1]),wave[-1]/(1+zRange[0]))
+			self.kbasis = sqbase.RestFrameTemplate(wave,restRange,klam,
+			                                       fill_value=np.nan)
+	def attenuation(self,z,E_BmV):
+		'''Return the attenuation for objects at z with E(B-V).'''
+		k = self.kbasis.get(z)
+		return np.exp(-0.4*np.log(10)*np.asarray(E_BmV)[...,np.newaxis]*k)
 	def apply_to_spec(self,spec,idx):
-		dustfn = self.grid.get(idx)
-		spec.convolve_restframe(*dustfn)
+		dustfn,E_BmV = self.grid.get(idx)
+		if ( self.kbasis is None or len(spec.wave) != self.kbasis.npix or
+		     np.any(spec.z < self.zRange[0]) or
+		     np.any(spec.z > self.zRange[1]) ):
+			spec.convolve_restframe(dustfn,E_BmV)
+		else:
+			spec.f_lambda = spec.f_lambda * self.attenuation(spec.z,E_BmV)
 
 def buildFeatures(Mz,wave,simParams):
 	features = []
 	qsoParams = simParams['QuasarModelParams']
 	if 'EmissionLineParams' in qsoParams:
 		emLineGrid = buildEmissionLineGrid(Mz,simParams)
-		emLineFeature = EmissionLineFeature(emLineGrid)
+		emLineParams = qsoParams['EmissionLineParams']
+		profiles = emLineParams.get('LineProfiles','exact')
+		tol = emLineParams.get('LineProfileTol',1e-3)
+		if profiles == 'kerneltable':
+			print 'drawing emission line profiles from a table, tol=',tol
+		emLineFeature = EmissionLineFeature(emLineGrid,profiles=profiles,
+		                                    tol=tol)
 		features.append(emLineFeature)
 	if 'IronEmissionParams' in qsoParams:
 		# only option for now is the VW01 template
@@ -216,14 +299,158 @@ def buildFeatures(Mz,wave,simParams):
 		features.append(feFeature)
 	if 'DustExtinctionParams' in qsoParams:
 		dustGrid = buildDustGrid(Mz,simParams)
-		dustFeature = DustExtinctionFeature(dustGrid)
+		dustFeature = DustExtinctionFeature(dustGrid,wave,
+		                                    (Mz.zGrid.min(),Mz.zGrid.max()))
 		features.append(dustFeature)
 		pass
 	return features
 
 
+class SpectraWriter(object):
+	'''
+	Write simulated spectra to disk in blocks as they are generated, so that
+	memory use does not grow with the number of spectra saved.
+	The spectra are stored as float32 rows of a FITS image, one row per
+	object in the same order as the flattened (M,z) grid. Rows are staged
+	in an uncompressed file and can be overwritten in place (e.g., by later
+	iterations of buildQSOspectra). If fileName ends in '.gz' the staged
+	file is gzip-compressed on close(), with blocks compressed in parallel
+	by nThreads threads. A 'ROWINDEX' extension lists the rows that were
+	written. If resume is True and the staged file already exists (e.g.,
+	from a preempted run), it is reopened rather than recreated.
+	'''
+	def __init__(self,fileName,wave,nSpec,blockSize=1000,nThreads=1,
+	             resume=False):
+		self.fileName = fileName
+		self.compress = fileName.endswith('.gz')
+		if self.compress:
+			self.stageFileName = fileName[:-3]+'.stage'
+		else:
+			self.stageFileName = fileName
+		self.nSpec = nSpec
+		self.npix = len(wave)
+		self.blockSize = blockSize
+		self.nThreads = nThreads
+		logwave = np.log(wave[:2])
+		hdr = fits.Header([('SIMPLE',True),('BITPIX',-32),('NAXIS',2),
+		                   ('NAXIS1',self.npix),('NAXIS2',nSpec),
+		                   ('EXTEND',True),
+		                   ('CD1_1',np.diff(logwave)[0]),('CRPIX1',1),
+		                   ('CRVAL1',logwave[0]),('CTYPE1','LOGWAVE')])
+		hdrStr = hdr.tostring().encode('ascii')
+		self.rowBytes = 4*self.npix
+		self.dataOffset = len(hdrStr)
+		dataSize = nSpec*self.rowBytes
+		dataSize += -dataSize % 2880
+		if not ( resume and os.path.exists(self.stageFileName) and
+		         os.path.getsize(self.stageFileName) == 
+		                                      self.dataOffset+dataSize ):
+			with open(self.stageFileName,'wb') as f:
+				f.write(hdrStr)
+				f.truncate(self.dataOffset+dataSize)
+		self._fh = open(self.stageFileName,'r+b')
+		self.written = np.zeros(nSpec,dtype=bool)
+		self._buf = np.empty((blockSize,self.npix),dtype=np.float32)
+		self._rows = []
+	def __setitem__(self,i,f_lambda):
+		# accepts a single row or arrays of rows
+		for row,f in zip(np.atleast_1d(i),np.atleast_2d(f_lambda)):
+			self._buf[len(self._rows)] = f
+			self._rows.append(row)
+			if len(self._rows) == self.blockSize:
+				self.flush()
+	def flush(self):
+		'''Write the buffered spectra to disk.'''
+		if len(self._rows) == 0:
+			return
+		rows = np.array(self._rows)
+		buf = self._buf[:len(rows)].astype('>f4')
+		# write each contiguous run of rows with a single call
+		breaks = np.where(np.diff(rows) != 1)[0] + 1
+		for run in np.split(np.arange(len(rows)),breaks):
+			self._fh.seek(self.dataOffset + rows[run[0]]*self.rowBytes)
+			self._fh.write(buf[run].tostring())
+		self.written[rows] = True
+		self._rows = []
+	def rescale(self,scale):
+		'''Multiply each stored spectrum by scale (one value per row).'''
+		self.flush()
+		for i1 in range(0,self.nSpec,self.blockSize):
+			i2 = min(i1+self.blockSize,self.nSpec)
+			self._fh.seek(self.dataOffset + i1*self.rowBytes)
+			blk = np.frombuffer(self._fh.read((i2-i1)*self.rowBytes),
+			                    dtype='>f4').reshape(i2-i1,self.npix)
+			blk = blk * scale[i1:i2,np.newaxis].astype(np.float32)
+			self._fh.seek(self.dataOffset + i1*self.rowBytes)
+			self._fh.write(blk.astype('>f4').tostring())
+	def _compress(self):
+		# concatenated gzip members form a valid gzip stream, so the blocks
+		# can be compressed independently
+		def gzblock(buf):
+			z = zlib.compressobj(6,zlib.DEFLATED,31)
+			return z.compress(buf) + z.flush()
+		chunkSize = self.blockSize*self.rowBytes
+		pool = ThreadPool(self.nThreads) if self.nThreads > 1 else None
+		with open(self.stageFileName,'rb') as fin:
+			with open(self.fileName,'wb') as fout:
+				while True:
+					chunks = [fin.read(chunkSize) for i in range(self.nThreads)]
+					chunks = [c for c in chunks if len(c) > 0]
+					if len(chunks) == 0:
+						break
+					if pool is None:
+						zchunks = map(gzblock,chunks)
+					else:
+						zchunks = pool.map(gzblock,chunks)
+					for zc in zchunks:
+						fout.write(zc)
+		if pool is not None:
+			pool.close()
+		os.remove(self.stageFileName)
+	def close(self):
+		'''Finish writing the spectra and compress the output file.'''
+		self.flush()
+		self._fh.close()
+		rowIndex = np.zeros(self.written.sum(),dtype=[('index','i8')])
+		rowIndex['index'] = np.where(self.written)[0]
+		fits.append(self.stageFileName,rowIndex,
+		            fits.Header([('EXTNAME','ROWINDEX')]))
+		if self.compress:
+			self._compress()
+
+def _rescaleSynPhot(dm,synMag,synFlux,spectra=None):
+	'''
+	Brighten each object by dm magnitudes. The synthetic fluxes are linear
+	in f_lambda, and every spectral component scales with the continuum
+	normalization, so this is equivalent to rebuilding the spectra at
+	M-dm.
+	'''
+	fscale = 10**(0.4*dm)
+	synFlux *= fscale[...,np.newaxis]
+	ii = np.where(synFlux > 0)
+	synMag[ii] = np.minimum(-2.5*np.log10(1e-9*synFlux[ii]),99.99)
+	if isinstance(spectra,SpectraWriter):
+		spectra.rescale(fscale.flatten())
+	elif spectra is not None:
+		spectra *= fscale.reshape(-1,1)
+
+def _saveCheckpoint(checkpoint,**state):
+	# write to a temporary file and rename, so that an interruption while
+	# writing leaves the previous checkpoint intact
+	tmpFile = checkpoint+'.tmp'
+	with open(tmpFile,'wb') as f:
+		np.savez(f,**state)
+	os.rename(tmpFile,checkpoint)
+
+def _loadCheckpoint(checkpoint):
+	with open(checkpoint,'rb') as f:
+		cp = np.load(f)
+		return { k:cp[k] for k in cp.files }
+
 def buildQSOspectra(wave,Mz,forest,photoMap,simParams,
-                    maxIter,saveSpectra=False):
+                    maxIter,saveSpectra=False,linearFluxScaling=False,
+                    blockSize=100,checkpoint=None,checkpointInterval=600.,
+                    resume=False,catalog=None):
 	'''
 	Assemble the spectral components of each QSO from the input parameters.
 	---
@@ -237,19 +464,95 @@ def buildQSOspectra(wave,Mz,forest,photoMap,simParams,
 	  'DustExtinctionModel' : 'None',
 	                          'Fixed E(B-V)',
 	                          'Exponential E(B-V) Distribution'
+	---
+	saveSpectra can be a SpectraWriter, in which case spectra are streamed
+	to disk rather than stored in memory.
+	If linearFluxScaling is set, the photometry from each pass over a flux
+	grid is rescaled analytically to the updated luminosities. This saves
+	time only when none of the spectral components depend on luminosity:
+	the rescaling is then exact and a single pass is made. Otherwise (e.g.,
+	with the Baldwin effect of VariedEmissionLineGrid) the full spectra are
+	still rebuilt on every pass, as without the option, and the rescaling
+	only brings the final photometry to the final luminosities.
+	The spectra are built blockSize objects at a time, so the continuum
+	and feature grids must accept a multi-index of arrays in get().
+	If checkpoint is a file name, the synthetic photometry, the completed
+	objects, the iteration number, the current magnitudes, and the random
+	state are saved there every checkpointInterval seconds and at the end
+	of each iteration. With resume, a run continues from the checkpoint,
+	giving the same results as an uninterrupted run; the features are
+	rebuilt from their random seeds (one is chosen and saved if the
+	parameters have none) and updated to the checkpointed magnitudes.
+	Saved spectra must then be streamed by a SpectraWriter opened with
+	resume. Spectra rescaled in place at the end of an iteration are not
+	protected against an interruption during the rescaling.
+	catalog can be a FitsTableWriter whose first table is the simulation
+	catalog (see qsoSimulation), in which case M and the synthetic
+	photometry of each block are written to it as soon as the block is
+	built, so that partial results are on disk during a long run.
 	'''
-	if saveSpectra:
+	if isinstance(saveSpectra,SpectraWriter):
+		spectra = saveSpectra
+	elif saveSpectra:
+		if checkpoint is not None:
+			raise ValueError('checkpointing requires a SpectraWriter')
 		spectra = np.zeros((Mz.mGrid.size,len(wave)))
 	else:
 		spectra = None
 	nforest = len(forest['wave'])
 	assert np.all(np.abs(forest['wave']-wave[:nforest]<1e-3))
+	state = None
+	if checkpoint is not None:
+		if resume and os.path.exists(checkpoint):
+			state = _loadCheckpoint(checkpoint)
+			print 'resuming from checkpoint at iteration ',state['iterNum']+1
+			if str(state.get('units',Mz.units)) != Mz.units:
+				raise ValueError('checkpoint is for a grid in %s units' % 
+				                 state['units'])
+			if simParams.get('RandomSeed') is None:
+				simParams['RandomSeed'] = int(state['seed'])
+		elif simParams.get('RandomSeed') is None:
+			# the features must be reproducible when resuming
+			simParams['RandomSeed'] = np.random.randint(2**31-1)
 	continua = buildContinuumModels(Mz,simParams)
 	features = buildFeatures(Mz,wave,simParams)
 	spec = QSOSpectrum(wave)
 	gridShape = Mz.mGrid.shape
 	synMag = np.zeros(gridShape+(len(photoMap['bandpasses']),))
 	synFlux = np.zeros_like(synMag)
+	done = np.zeros(Mz.mGrid.size,dtype=bool)
+	startIter = 0
+	if state is not None:
+		startIter = int(state['iterNum'])
+		synMag[:] = state['synMag'].reshape(synMag.shape)
+		synFlux[:] = state['synFlux'].reshape(synFlux.shape)
+		done[:] = state['done']
+		if startIter > 0:
+			Mz.mGrid[:] = state['mGrid'].reshape(gridShape)
+			continua.update(Mz.mGrid,Mz.zGrid)
+			for feature in features:
+				feature.update(Mz.mGrid,Mz.zGrid)
+		if isinstance(spectra,SpectraWriter):
+			spectra.written[:] = state['spectraWritten']
+		np.random.set_state(('MT19937',state['rngKeys'],int(state['rngPos']),
+		                     int(state['rngHasGauss']),
+		                     float(state['rngGauss'])))
+	def saveCheckpoint(iterNum):
+		if isinstance(spectra,SpectraWriter):
+			spectra.flush()
+			spectraWritten = spectra.written
+		else:
+			spectraWritten = np.zeros(0,dtype=bool)
+		rngState = np.random.get_state()
+		_saveCheckpoint(checkpoint,iterNum=iterNum,
+		                synMag=synMag,synFlux=synFlux,done=done,
+		                mGrid=Mz.mGrid,units=Mz.units,
+		                seed=simParams['RandomSeed'],
+		                rngKeys=rngState[1],rngPos=rngState[2],
+		                rngHasGauss=rngState[3],rngGauss=rngState[4],
+		                spectraWritten=spectraWritten)
+		return time.time()
+	lastCheckpoint = time.time()
 	photoCache = sqphoto.getPhotoCache(wave,photoMap)
 	print 'units are ',Mz.units
 	if Mz.units == 'luminosity':
@@ -264,10 +567,16 @@ def buildQSOspectra(wave,Mz,forest,photoMap,simParams,
 		except:
 			raise ValueError('band ',Mz.obsBand,' not found in ',bands)
 		print 'fluxBand is ',fluxBand,bands
-	for iterNum in range(nIter):
+		fixedShape = not ( getattr(continua,'luminosityDependent',True) or
+		                   any(f.luminosityDependent() for f in features) )
+		if linearFluxScaling and not fixedShape:
+			print 'luminosity-dependent features, rebuilding spectra each pass'
+	for iterNum in range(startIter,nIter):
 		print 'buildQSOspectra iteration ',iterNum+1,' out of ',nIter
-		for M,z,idx in Mz:
-			i = np.ravel_multi_index(idx,gridShape)
+		for ii,M,z,idx in Mz.iter_blocks(blockSize):
+			if done[ii].all():
+				# completed before the checkpoint
+				continue
 			spec.setRedshift(z)
 			# start with continuum
 			spec.setPowerLawContinuum(continua.get(idx),
@@ -277,7 +586,7 @@ def buildQSOspectra(wave,Mz,forest,photoMap,simParams,
 			for feature in features:
 				feature.apply_to_spec(spec,idx)
 			# apply HI forest blanketing
-			spec.f_lambda[:nforest] *= forest['T'][i]
+			spec.f_lambda[...,:nforest] *= forest['T'][ii]
 			# calculate synthetic magnitudes from the spectra through the
 			# specified bandpasses
 			synMag[idx],synFlux[idx] = sqphoto.calcSynPhot(spec,photoMap,
@@ -285,20 +594,44 @@ def buildQSOspectra(wave,Mz,forest,photoMap,simParams,
 			                                               synMag[idx],
 			                                               synFlux[idx])
 			if saveSpectra:
-				spectra[i] = spec.f_lambda
+				spectra[ii] = spec.f_lambda
+			if catalog is not None:
+				# the blocks are contiguous ranges of rows
+				catalog.write(0,ii[0],{'M':M,'synFlux':synFlux[idx],
+				                       'synMag':synMag[idx]})
+			done[ii] = True
+			if ( checkpoint is not None and 
+			       time.time() - lastCheckpoint > checkpointInterval ):
+				lastCheckpoint = saveCheckpoint(iterNum)
+		if isinstance(spectra,SpectraWriter):
+			spectra.flush()
 ###		print 'before: ',Mz.mGrid,synMag[...,-1]
 		if nIter > 1:
+			dm = synMag[...,fluxBand] - Mz.appMagGrid
 			dmagMax = Mz.updateMags(synMag[...,fluxBand])
+			if linearFluxScaling:
+				_rescaleSynPhot(dm,synMag,synFlux,spectra)
+				if fixedShape:
+					print 'spectral shapes fixed, skipping remaining iterations'
+					break
 			continua.update(Mz.mGrid,Mz.zGrid)
 			for feature in features:
 				feature.update(Mz.mGrid,Mz.zGrid)
 ###			print 'after: ',Mz.mGrid,synMag[...,-1]
 			if dmagMax < 0.01:
 				break
+			done[:] = False
+			if checkpoint is not None and iterNum+1 < nIter:
+				lastCheckpoint = saveCheckpoint(iterNum+1)
 	return dict(synMag=synMag,synFlux=synFlux,
 	            continua=continua,features=features,spectra=spectra)
 
 
+class NullForest(object):
+	'''No forest applied, overrides T to always return one.'''
+	def __getitem__(self,i):
+		return 1
+
 class TimerLog():
 	def __init__(self):
 		self.stages = ['StartSimulation']
@@ -318,21 +651,40 @@ class TimerLog():
 			print '%20s %8.3f %8.3f %8.3f' % t
 		print
 
+def _restoreMzGrid(gridData,simParams):
+	'''
+	Rebuild the (M,z) grid from the values saved in an output file. Grids
+	in flux units, including those sampled from a luminosity function,
+	are saved with their apparent magnitudes.
+	'''
+	if 'appMag' in gridData.dtype.names:
+		return grids.FluxGridFromData(gridData,simParams['GridParams'],
+		                              simParams.get('Cosmology'))
+	else:
+		return grids.LuminosityGridFromData(gridData,simParams['GridParams'],
+		                                    simParams.get('Cosmology'))
+
+def _gridTable(M,z,appMag=None):
+	# the grid columns in a fixed order, so that new and resumed runs
+	# write the same catalog
+	if appMag is None:
+		return Table([M,z],names=('M','z'))
+	return Table([M,z,appMag],names=('M','z','appMag'))
+
 def initGridData(simParams,Mz):
 	if Mz.units == 'flux':
-		return Table({'M':Mz.mGrid.flatten(),'z':Mz.zGrid.flatten(),
-		              'appMag':Mz.appMagGrid.flatten()})
+		return _gridTable(Mz.mGrid.flatten(),Mz.zGrid.flatten(),
+		                  Mz.appMagGrid.flatten())
 	else:
-		return Table({'M':Mz.mGrid.flatten(),'z':Mz.zGrid.flatten()})
+		return _gridTable(Mz.mGrid.flatten(),Mz.zGrid.flatten())
 
 def writeGridData(simParams,Mz,gridData,outputDir):
 	simPar = copy(simParams)
 	# XXX need to write parameters out or something...
 	simPar['Cosmology'] = simPar['Cosmology'].name
-	try:
-		del simPar['GridParams']['QLFmodel']
-	except:
-		pass
+	# copy the grid parameters so the caller's QLF model is kept
+	simPar['GridParams'] = copy(simPar['GridParams'])
+	simPar['GridParams'].pop('QLFmodel',None)
 	hdr0 = fits.Header()
 	hdr0['GRIDPARS'] = str(simPar['GridParams'])
 	hdr0['GRIDUNIT'] = Mz.units
@@ -343,66 +695,449 @@ def writeGridData(simParams,Mz,gridData,outputDir):
 	hdulist.writeto(os.path.join(outputDir,simPar['GridFileName']+'.fits'),
 	                clobber=True)
 
-def readSimulationData(fileName,outputDir,retParams=False):
-	qsoData = fits.getdata(os.path.join(outputDir,fileName+'.fits'),1)
-	qsoData = Table(qsoData)
+def readSimulationParams(fileName,outputDir='./'):
+	'''Return the simulation parameters stored in an output file.'''
+	hdr = fits.getheader(os.path.join(outputDir,fileName+'.fits'),0)
+	simPars = ast.literal_eval(hdr['SQPARAMS'])
+	# XXX get it from parameters...
+###	simPars['Cosmology'] = {
+###	  'WMAP9':cosmology.WMAP9,
+###	}[simPars['Cosmology']]
+	return simPars
+
+def readSimulationData(fileName,outputDir,retParams=False,
+                       columns=None,rows=None):
+	'''
+	Read the catalog of a simulation output file as a Table, restricted
+	to columns and rows if given (see SimulationData.read).
+	'''
+	simData = SimulationData(fileName,outputDir)
+	qsoData = simData.read(columns,rows)
 	if retParams:
-		hdr = fits.getheader(os.path.join(outputDir,fileName+'.fits'),0)
-		simPars = ast.literal_eval(hdr['SQPARAMS'])
-		# XXX get it from parameters...
-###		simPars['Cosmology'] = {
-###		  'WMAP9':cosmology.WMAP9,
-###		}[simPars['Cosmology']]
-		return qsoData,simPars
+		return qsoData,simData.params()
 	return qsoData
 
-def writeSimulationData(simParams,Mz,gridData,simQSOs,photoData,outputDir,
-                        writeFeatures):
-	outShape = gridData['z'].shape
-	fShape = outShape + (-1,) # shape for a "feature", vector at each point
+# binary table formats and the corresponding (big-endian) numpy types
+_fitsFormats = {'L':'S1','A':'S','B':'u1','I':'>i2','J':'>i4','K':'>i8',
+                'E':'>f4','D':'>f8','C':'>c8','M':'>c16'}
+
+class SimulationData(object):
+	'''
+	Lazy reader of a simulation output file. Only the headers are read
+	when the file is opened; the table is memory-mapped and columns are
+	returned as views of the file, so that only the columns (and rows)
+	that are used are read from disk. Logical columns are converted to
+	bool when accessed. The simulation parameters (SQPARAMS) are parsed
+	on request with params(). Columns already read keep their values when
+	the file is rewritten by a later run.
+	  simData = SimulationData('sim','outputs/')
+	  M = simData['M']
+	  synMag = simData.column('synMag',rows=(0,1000))
+	'''
+	def __init__(self,fileName,outputDir='./',ext=1):
+		self.fileName = os.path.join(outputDir,fileName+'.fits')
+		with open(self.fileName,'rb') as f:
+			hdr = self.header0 = fits.Header.fromfile(f)
+			for i in range(ext):
+				f.seek(self._dataSize(hdr),os.SEEK_CUR)
+				hdr = fits.Header.fromfile(f)
+			dataOffset = f.tell()
+		if hdr.get('XTENSION') != 'BINTABLE':
+			raise ValueError('extension %d is not a binary table' % ext)
+		self.header = hdr
+		self.nRows = hdr['NAXIS2']
+		self.dtype = self._tableDtype(hdr)
+		self.colnames = list(self.dtype.names)
+		self._data = None
+		if self.nRows > 0:
+			self._data = np.memmap(self.fileName,dtype=self.dtype,mode='r',
+			                       offset=dataOffset,shape=(self.nRows,))
+	@staticmethod
+	def _dataSize(hdr):
+		naxis = [ hdr['NAXIS%d' % i] for i in range(1,hdr['NAXIS']+1) ]
+		nBytes = abs(hdr['BITPIX'])//8 * hdr.get('GCOUNT',1) * \
+		          ( hdr.get('PCOUNT',0) + (np.prod(naxis) if naxis else 0) )
+		return nBytes + (-nBytes % 2880)
+	@staticmethod
+	def _tableDtype(hdr):
+		fields = []
+		for i in range(1,hdr['TFIELDS']+1):
+			tform = hdr['TFORM%d' % i].strip()
+			nrep,code = re.match(r'(\d*)(\w?)',tform).groups()
+			nrep = int(nrep or 1)
+			if code not in _fitsFormats:
+				raise ValueError('unsupported column format %s' % tform)
+			if 'TSCAL%d' % i in hdr or 'TZERO%d' % i in hdr:
+				raise ValueError('scaled columns are not supported')
+			if code == 'A':
+				dt,nrep = 'S%d' % nrep,1
+			else:
+				dt = _fitsFormats[code]
+			tdim = hdr.get('TDIM%d' % i)
+			if tdim is not None:
+				# FITS dimensions are in Fortran order
+				shape = tuple(int(n) for n in tdim.strip('() ').split(','))
+				shape = shape[::-1]
+				if code == 'A':
+					shape = shape[:-1]
+			else:
+				shape = (nrep,) if nrep > 1 else ()
+			fields.append((hdr['TTYPE%d' % i],dt,shape))
+		return np.dtype(fields)
+	def __len__(self):
+		return self.nRows
+	def __contains__(self,name):
+		return name in self.colnames
+	def __getitem__(self,name):
+		return self.column(name)
+	def params(self):
+		'''The simulation parameters stored in the primary header.'''
+		return ast.literal_eval(self.header0['SQPARAMS'])
+	def gridShape(self):
+		'''The shape of the (M,z) grid of the simulation.'''
+		return ast.literal_eval(self.header0['GRIDDIM'])
+	def _rows(self,rows):
+		if rows is None:
+			return slice(None)
+		elif isinstance(rows,tuple):
+			return slice(*rows)
+		return rows
+	def column(self,name,rows=None):
+		'''
+		The values of column name, for all rows or for rows given as a 
+		slice, a (start,stop) pair, or an index array. Returned as a view
+		of the file where possible.
+		'''
+		if name not in self.colnames:
+			raise KeyError(name)
+		if self._data is None:
+			return np.zeros((0,)+self.dtype[name].shape,
+			                dtype=self.dtype[name].base)
+		col = self._data[name][self._rows(rows)]
+		if self.dtype[name].base == np.dtype('S1'):
+			col = col == b'T'
+		return col
+	def read(self,columns=None,rows=None):
+		'''
+		Return the columns (default all) and rows (as for column) as a
+		Table that shares memory with the file.
+		'''
+		if columns is None:
+			columns = self.colnames
+		return Table([ self.column(name,rows) for name in columns ],
+		             names=columns,copy=False)
+
+class FitsTableWriter(object):
+	'''
+	Write a FITS file of binary tables incrementally. Each table is
+	declared with its columns and number of rows, which fixes its size
+	and place in the file, and rows are then written in chunks as they
+	become available. Rows not yet written are zero, so the file is a
+	valid FITS file at all times. Tables are declared in order; a table
+	can be declared after rows of the previous tables have been written.
+	The file is written under a temporary name (fileName+'.tmp') and only
+	replaces fileName at close(), so that an existing output stays intact
+	until the new one is complete, including for any readers that have it
+	memory-mapped. Used as a context manager the writer is closed on exit;
+	if an exception is raised the partial file is left under its
+	temporary name and the existing output is kept.
+	'''
+	def __init__(self,fileName,header=None):
+		self.fileName = fileName
+		self.tmpFileName = fileName + '.tmp'
+		hdrStr = fits.PrimaryHDU(header=header).header.tostring()
+		with open(self.tmpFileName,'wb') as f:
+			f.write(hdrStr.encode('ascii'))
+		self._fh = open(self.tmpFileName,'r+b')
+		self.tables = []
+	def __enter__(self):
+		return self
+	def __exit__(self,excType,excValue,traceback):
+		if excType is None:
+			self.close()
+		else:
+			self.abort()
+		return False
+	@staticmethod
+	def _diskDtype(dtype):
+		# big-endian rows as stored in the file, logicals as 'T'/'F'
+		fields = []
+		for name in dtype.names:
+			dt,shape = dtype[name].base,dtype[name].shape
+			if dt.kind == 'b':
+				dt = np.dtype('S1')
+			elif dt.kind == 'U':
+				dt = np.dtype('S%d' % (dt.itemsize//4))
+			else:
+				dt = dt.newbyteorder('>')
+			fields.append((name,dt,shape))
+		return np.dtype(fields)
+	def addTable(self,columns,nRows,header=None):
+		'''
+		Declare a binary table with nRows rows, returning its index.
+		columns is a list of (name,dtype,shape) giving the type and shape
+		of each row's entry. Any keywords in header not already describing
+		the table are added to its header.
+		'''
+		dtype = np.dtype([ (name,dt,tuple(shape)) 
+		                      for name,dt,shape in columns ])
+		hdr = fits.BinTableHDU.from_columns(np.zeros(1,dtype=dtype)).header
+		hdr['NAXIS2'] = nRows
+		if header is not None:
+			for card in header.cards:
+				if card.keyword not in hdr:
+					hdr.append(card)
+		diskDtype = self._diskDtype(dtype)
+		assert hdr['NAXIS1'] == diskDtype.itemsize
+		hdrStr = hdr.tostring().encode('ascii')
+		self._fh.seek(0,os.SEEK_END)
+		offset = self._fh.tell() + len(hdrStr)
+		dataSize = nRows*diskDtype.itemsize
+		dataSize += -dataSize % 2880
+		self._fh.write(hdrStr)
+		self._fh.truncate(offset+dataSize)
+		self.tables.append(dict(offset=offset,dtype=diskDtype,nRows=nRows))
+		return len(self.tables) - 1
+	def write(self,ext,i1,data):
+		'''
+		Write rows of table ext starting at row i1, from a mapping of
+		column names to arrays with the same number of rows. If only some
+		of the columns are given the others keep their values in the file.
+		'''
+		table = self.tables[ext]
+		dtype = table['dtype']
+		names = [ name for name in dtype.names if name in data ]
+		if len(names) < len(data):
+			raise KeyError('columns %s not in table' % 
+			               sorted(set(data)-set(names)))
+		nrows = len(data[names[0]])
+		if i1+nrows > table['nRows']:
+			raise ValueError('rows %d:%d beyond end of table' % (i1,i1+nrows))
+		offset = table['offset'] + i1*dtype.itemsize
+		if len(names) < len(dtype.names):
+			self._fh.seek(offset)
+			buf = np.frombuffer(self._fh.read(nrows*dtype.itemsize),
+			                    dtype=dtype).copy()
+		else:
+			buf = np.empty(nrows,dtype=dtype)
+		for name in names:
+			col = np.asarray(data[name])
+			if col.dtype.kind == 'b':
+				col = np.where(col,b'T',b'F')
+			buf[name] = col.reshape(buf[name].shape)
+		self._fh.seek(offset)
+		self._fh.write(buf.tostring())
+		self._fh.flush()
+	def close(self):
+		'''Close the file and move it into place as fileName.'''
+		if self._fh.closed:
+			return
+		self._fh.close()
+		os.rename(self.tmpFileName,self.fileName)
+	def abort(self):
+		'''Close the file, leaving it under its temporary name.'''
+		self._fh.close()
+
+def _readFeatureHDU(fileName,outputDir):
+	'''Return a copy of the feature extension of an output file, if any.'''
+	with fits.open(os.path.join(outputDir,fileName+'.fits')) as hdus:
+		if len(hdus) < 3:
+			return None
+		return fits.BinTableHDU(data=hdus[2].data.copy(),
+		                        header=hdus[2].header.copy())
+
+def _writeColumns(writer,columns,header=None,chunkSize=10000):
+	# write the columns (an ordered mapping of arrays with rows along the
+	# first axis) as a new table, one chunk of rows at a time
+	nRows = len(next(iter(columns.values())))
+	ext = writer.addTable([ (name,arr.dtype,arr.shape[1:]) 
+	                           for name,arr in columns.items() ],
+	                      nRows,header)
+	for i1 in range(0,nRows,chunkSize):
+		writer.write(ext,i1,{ name:arr[i1:i1+chunkSize] 
+		                        for name,arr in columns.items() })
+
+def openSimulationData(simParams,Mz,gridData,outputDir):
+	'''
+	Return a FitsTableWriter for the simulation output, with the model
+	parameters in its primary header. The output file is replaced when
+	the writer is closed.
+	'''
 	# Primary extension just contains model parameters in header
 	simPar = copy(simParams)
 	# XXX need to write parameters out or something...
 	simPar['Cosmology'] = simPar['Cosmology'].name
-	try:
-		del simPar['GridParams']['QLFmodel']
-	except:
-		pass
+	# copy the grid parameters so the caller's QLF model is kept
+	simPar['GridParams'] = copy(simPar['GridParams'])
+	simPar['GridParams'].pop('QLFmodel',None)
 	hdr0 = fits.Header()
 	hdr0['SQPARAMS'] = str(simPar)
 	hdr0['GRIDUNIT'] = Mz.units
-	hdr0['GRIDDIM'] = str(outShape)
-	hdulist = [fits.PrimaryHDU(header=hdr0),]
-	# extension 1 contains the M,z grid and synthetic and observed fluxes
-	if simQSOs is None:
-		dataTab = gridData
-	else:
-		fluxData = Table({'synMag':simQSOs['synMag'].reshape(fShape),
-		                  'synFlux':simQSOs['synFlux'].reshape(fShape)})
+	hdr0['GRIDDIM'] = str(gridData['z'].shape)
+	return FitsTableWriter(os.path.join(outputDir,
+	                                    simParams['FileName']+'.fits'),hdr0)
+
+def _catalogColumns(gridData,simQSOs,photoData):
+	# the catalog columns: the M,z grid and synthetic and observed fluxes
+	outShape = gridData['z'].shape
+	fShape = outShape + (-1,) # shape for a "feature", vector at each point
+	columns = OrderedDict([ (name,np.asarray(gridData[name]))
+	                           for name in gridData.colnames ])
+	if simQSOs is not None:
+		columns['synFlux'] = simQSOs['synFlux'].reshape(fShape)
+		columns['synMag'] = simQSOs['synMag'].reshape(fShape)
 		if photoData is not None:
-			_photoData = Table({ field:arr.reshape(fShape) 
-			                        for field,arr in photoData.items() })
-			dataTab = hstack([gridData,fluxData,_photoData])
+			# keep any trailing axes after the bands (i.e., realizations)
+			nGridDim = simQSOs['synFlux'].ndim - 1
+			for field in sorted(photoData):
+				arr = photoData[field]
+				columns[field] = arr.reshape(outShape+arr.shape[nGridDim:])
+	return columns
+
+def _declareCatalog(writer,gridData,nBands,obsPhot=True,nRealizations=None,
+                   chunkSize=10000):
+	'''
+	Declare the catalog as the first table of writer, before the spectra
+	are built, and write its grid columns. Space is reserved for the
+	synthetic photometry in nBands bands and, if obsPhot, for the
+	observed photometry as returned by sqphoto.calcObsPhot with
+	nRealizations. Rows are then filled in as they are computed (see
+	buildQSOspectra and _finishCatalog).
+	'''
+	columns = [ (name,gridData[name].dtype,()) for name in gridData.colnames ]
+	columns += [ ('synFlux',np.float64,(nBands,)),
+	             ('synMag',np.float64,(nBands,)) ]
+	if obsPhot:
+		if nRealizations is None:
+			obsType,obsShape = np.float64,(nBands,)
 		else:
-			dataTab = hstack([gridData,fluxData])
-	hdu1 = fits.BinTableHDU.from_columns(np.array(dataTab))
-	hdulist.append(hdu1)
-	# extension 2 contains feature information (slopes, line widths, etc.)
-	if writeFeatures and simQSOs is not None:
-		hdr2 = fits.Header()
-		contData = simQSOs['continua'].getTable(hdr2)
-		featureData = [feature.getTable(hdr2) 
-		                  for feature in simQSOs['features']]
-		featureData = [t for t in featureData if t is not None]
-		featureTab = hstack([contData,]+featureData)
-		hdu2 = fits.BinTableHDU.from_columns(np.array(featureTab))
-		hdu2.header += hdr2
-		hdulist.append(hdu2)
-	hdulist = fits.HDUList(hdulist)
-	hdulist.writeto(os.path.join(outputDir,simParams['FileName']+'.fits'),
-	                clobber=True)
+			obsType,obsShape = np.float32,(nBands,nRealizations)
+		columns += [ (field,obsType,obsShape) for field in 
+		               ['obsFlux','obsFluxErr','obsMag','obsMagErr'] ]
+	ext = writer.addTable(columns,len(gridData))
+	for i1 in range(0,len(gridData),chunkSize):
+		writer.write(ext,i1,{ name:np.asarray(gridData[name][i1:i1+chunkSize])
+		                        for name in gridData.colnames })
+	return ext
+
+def _finishCatalog(writer,gridData,simQSOs,photoData,writeFeatures,
+                  chunkSize=10000):
+	'''
+	Write the final M, synthetic photometry and observed photometry to
+	the catalog declared with _declareCatalog, and the features as a new
+	table if writeFeatures.
+	'''
+	columns = _catalogColumns(gridData,simQSOs,photoData)
+	for name in gridData.colnames:
+		if name != 'M':
+			del columns[name]
+	for i1 in range(0,len(gridData),chunkSize):
+		writer.write(0,i1,{ name:arr[i1:i1+chunkSize] 
+		                      for name,arr in columns.items() })
+	if writeFeatures:
+		columns,hdr2 = _featureColumns(simQSOs)
+		_writeColumns(writer,columns,hdr2,chunkSize)
+
+def writeSimulationData(simParams,Mz,gridData,simQSOs,photoData,outputDir,
+                        writeFeatures,chunkSize=10000):
+	'''
+	Write the simulation catalog. The tables are declared up front and
+	written in chunks of chunkSize rows directly from the grid, photometry
+	and feature arrays, without assembling the full catalog in memory.
+	'''
+	with openSimulationData(simParams,Mz,gridData,outputDir) as writer:
+		# extension 1 contains the M,z grid and synthetic and observed fluxes
+		columns = _catalogColumns(gridData,simQSOs,photoData)
+		_writeColumns(writer,columns,chunkSize=chunkSize)
+		# extension 2 contains feature information (slopes, line widths, etc.)
+		if writeFeatures and simQSOs is not None:
+			columns,hdr2 = _featureColumns(simQSOs)
+			_writeColumns(writer,columns,hdr2,chunkSize)
+
+def _featureColumns(simQSOs):
+	'''
+	The feature columns (an ordered mapping of names to arrays) and their
+	header, from the continuum and feature grids of simQSOs, or from
+	its 'featureHDU' if the features were restored from a previous output.
+	'''
+	if 'featureHDU' in simQSOs:
+		featureHDU = simQSOs['featureHDU']
+		columns = OrderedDict([ (name,featureHDU.data[name])
+		                           for name in featureHDU.columns.names ])
+		return columns,featureHDU.header
+	hdr = fits.Header()
+	contData = simQSOs['continua'].getTable(hdr)
+	featureData = [feature.getTable(hdr) for feature in simQSOs['features']]
+	featureData = [t for t in featureData if t is not None]
+	columns = OrderedDict()
+	for t in [contData,]+featureData:
+		for name in t.colnames:
+			if name in columns:
+				raise ValueError('duplicate feature column %s' % name)
+			columns[name] = np.asarray(t[name])
+	return columns,hdr
 
 
+def _chunkParams(params,k,deriveSeeds=True):
+	'''
+	Copy of the parameter dicts for chunk k, with each random seed
+	replaced by one derived from it and k (if deriveSeeds).
+	'''
+	chunkPars = {}
+	for key,val in params.items():
+		if isinstance(val,dict):
+			chunkPars[key] = _chunkParams(val,k,deriveSeeds)
+		elif key == 'RandomSeed' and val is not None and deriveSeeds:
+			chunkPars[key] = np.random.RandomState([val,k]).randint(2**31-1)
+		else:
+			chunkPars[key] = val
+	return chunkPars
+
+def qsoSimulationChunks(simParams,**kwargs):
+	'''
+	Run a simulation of objects sampled from a luminosity function in
+	chunks of GridParams['ChunkSize'] objects, so that memory use is set by
+	the chunk size rather than by the total number of objects. Each chunk
+	is run through the complete qsoSimulation pipeline with its own random
+	seeds (derived from the seeds in simParams and the chunk number) and
+	written to its own output files, named by appending _NNN to FileName
+	(and to the forest FileName). With RandomStreams, the chunks instead
+	share the seeds and the objects draw from streams indexed by their
+	position in the full sample.
+	'''
+	gridPars = simParams['GridParams']
+	qlfArgs = dict(gridPars.get('QLFargs',{}))
+	qlfArgs.pop('tabulated',None)
+	seed = gridPars.get('RandomSeed',simParams.get('RandomSeed'))
+	if seed is None:
+		seed = np.random.randint(2**31-1)
+	streams = simParams.get('RandomStreams',False)
+	if streams and simParams.get('RandomSeed') is None:
+		simParams = dict(simParams,RandomSeed=seed)
+	chunks = grids.iterLuminosityFunctionSample(gridPars,
+	                                            gridPars['QLFmodel'],
+	                                            simParams.get('Cosmology'),
+	                                            gridPars['ChunkSize'],seed,
+	                                            **qlfArgs)
+	nObj = 0
+	for k,(m,z) in enumerate(chunks):
+		print 'simulating chunk %d with %d objects' % (k,len(z))
+		chunkPars = _chunkParams(simParams,k,deriveSeeds=not streams)
+		if streams:
+			chunkPars['ObjectIndexOffset'] = nObj
+		nObj += len(z)
+		chunkPars['FileName'] = '%s_%03d' % (simParams['FileName'],k)
+		if 'ForestParams' in chunkPars:
+			forestPars = chunkPars['ForestParams']
+			forestPars['FileName'] = '%s_%03d' % (forestPars['FileName'],k)
+		del chunkPars['GridParams']['ChunkSize']
+		chunkPars.pop('GridFileName',None)
+		Mz = grids.LuminosityFunctionFluxGrid(chunkPars['GridParams'],
+		                                      gridPars['QLFmodel'],
+		                                      chunkPars.get('Cosmology'),
+		                                      sample=(m,z))
+		qsoSimulation(chunkPars,MzGrid=Mz,**kwargs)
+
 def qsoSimulation(simParams,**kwargs):
 	'''
 	Run a complete simulation.
@@ -417,16 +1152,43 @@ def qsoSimulation(simParams,**kwargs):
 	Keyword arguments:
 	  saveSpectra: save the simulated spectra, not just the photometry.
 	        Beware! filt could be quite large (Nqso x Npixels) [default:False]
+	        The spectra are streamed to disk in blocks as float32.
+	  spectraBlockSize: number of spectra per block written [default:1000]
+	  spectraThreads: number of threads used to compress the spectra
+	                  [default:1]
+	  blockSize: number of spectra built at once [default:100]
+	  checkpoint: periodically save the state of the spectrum stage to
+	              <FileName>_checkpoint.npz in outputDir [default:False]
+	  checkpointInterval: seconds between checkpoints [default:600]
+	  resume: continue a preempted run from its checkpoint, if one exists
+	          [default:False]
 	  forestOnly: only generate the forest transmission spectra [default:False]
-      onlyMap: only do the simulation of observed photometry, assuming 
+	  onlyMap: only do the simulation of observed photometry, assuming 
 	           synthetic photometry has already been generated [default:False]
+	           The synthetic photometry and features are restored from the
+	           existing output file.
+	  nRealizations: draw this many noise realizations of the observed
+	                 photometry, stored as float32 with the realization
+	                 axis last [default:None, a single realization]
 	  noPhotoMap: skip the simulation of observed photometry [default:False]
 	  writeFeatures: in addition to photometry, save all of the individual
 	                 spectral features for each object (continuum slopes,
 	                 emission line parameters, etc.), sufficient to reproduce
 	                 spectra from output files [default:False]
 	  outputDir: write files to this directory [default:'./']
+	  MzGrid: use this (M,z) grid rather than generating one
+	  cacheDir: run the simulation as a sequence of stages with outputs
+	            cached in this directory, see qsoSimulationCached
+	            [default:None]
+	If GridParams includes 'ChunkSize' for a 'LuminosityFunction' grid,
+	the simulation is run in chunks by qsoSimulationChunks.
 	'''
+	gridPars = simParams['GridParams']
+	if ( gridPars.get('GridType') == 'LuminosityFunction' and 
+	     gridPars.get('ChunkSize') ):
+		return qsoSimulationChunks(simParams,**kwargs)
+	if kwargs.get('cacheDir') is not None:
+		return qsoSimulationCached(simParams,**kwargs)
 	saveSpectra = kwargs.get('saveSpectra',False)
 	forestOnly = kwargs.get('forestOnly',False)
 	onlyMap = kwargs.get('onlyMap',False)
@@ -434,11 +1196,23 @@ def qsoSimulation(simParams,**kwargs):
 	noWriteOutput = kwargs.get('noWriteOutput',False)
 	writeFeatures = kwargs.get('writeFeatures',False)
 	outputDir = kwargs.get('outputDir','./')
+	nRealizations = kwargs.get('nRealizations')
+	resume = kwargs.get('resume',False)
+	if ( simParams.get('RandomStreams',False) and 
+	     simParams.get('RandomSeed') is None ):
+		# the stage and object streams are derived from the master seed
+		simParams['RandomSeed'] = np.random.randint(2**31-1)
+	if kwargs.get('checkpoint',False) or resume:
+		checkpoint = os.path.join(outputDir,
+		                          simParams['FileName']+'_checkpoint.npz')
+	else:
+		checkpoint = None
 	#
 	# build or restore the grid of (M,z) for each QSO
 	#
 	wave = buildWaveGrid(simParams)
 	timerLog = TimerLog()
+	qsoData = None
 	try:
 		# simulation data already exists, load the Mz grid
 		cosmo = simParams['Cosmology'] # XXX
@@ -452,15 +1226,12 @@ def qsoSimulation(simParams,**kwargs):
 		# XXX hack copy back in
 		simParams['GridParams']['QLFmodel'] = qlf
 		simParams['Cosmology'] = cosmo
-		if simParams['GridParams']['GridType'].startswith('Flux'):
-			Mz = grids.FluxGridFromData(qsoData,simParams['GridParams'],
-			                            simParams.get('Cosmology'))
-			gridData = qsoData['M','z','appMag']
-			#gridData = qsoData['appMag','z']
+		Mz = _restoreMzGrid(qsoData,simParams)
+		if Mz.units == 'flux':
+			gridData = _gridTable(qsoData['M'],qsoData['z'],
+			                      qsoData['appMag'])
 		else:
-			Mz = grids.LuminosityGridFromData(qsoData,simParams['GridParams'],
-			                                  simParams.get('Cosmology'))
-			gridData = qsoData['M','z']
+			gridData = _gridTable(qsoData['M'],qsoData['z'])
 	except IOError:
 		print simParams['FileName']+' output not found'
 		if 'GridFileName' in simParams:
@@ -468,19 +1239,14 @@ def qsoSimulation(simParams,**kwargs):
 			try:
 				gridData = fits.getdata(os.path.join(outputDir,
 				                        simParams['GridFileName']+'.fits'))
-				if simParams['GridParams']['GridType'].startswith('Flux'):
-					Mz = grids.FluxGridFromData(gridData,
-					                            simParams['GridParams'],
-					                            simParams.get('Cosmology'))
-				else:
-					Mz = grids.LuminosityGridFromData(gridData,
-					                                  simParams['GridParams'],
-					                                simParams.get('Cosmology'))
+				Mz = _restoreMzGrid(gridData,simParams)
 			except IOError:
 				print simParams['GridFileName'],' not found, generating'
 				Mz = buildMzGrid(simParams)
 				gridData = initGridData(simParams,Mz)
 				writeGridData(simParams,Mz,gridData,outputDir)
+		elif kwargs.get('MzGrid') is not None:
+			Mz = kwargs['MzGrid']
 		else:
 			print 'generating Mz grid'
 			Mz = buildMzGrid(simParams)
@@ -496,15 +1262,11 @@ def qsoSimulation(simParams,**kwargs):
 	#
 	if not onlyMap:
 		if 'ForestParams' not in simParams:
-			# no forest applied, overrides T to always return one
-			class NullForest(object):
-				def __getitem__(self,i):
-					return 1
 			forest = dict(wave=wave[:2],T=NullForest())
 		else:
 			forest = buildForest(wave,Mz.getRedshifts(),simParams,outputDir)
-		# make sure that the forest redshifts actually match the grid
-		assert np.allclose(forest['z'],Mz.zGrid.flatten())
+			# make sure that the forest redshifts actually match the grid
+			assert np.allclose(forest['z'],Mz.zGrid.flatten())
 	if forestOnly:
 		timerLog.dump()
 		return
@@ -514,31 +1276,440 @@ def qsoSimulation(simParams,**kwargs):
 	# of the intrinsic QSO spectrum, then calculate photometry
 	#
 	photoMap = sqphoto.load_photo_map(simParams['PhotoMapParams'])
-	if not onlyMap:
+	if onlyMap and ( qsoData is None or 'synFlux' not in qsoData.colnames ):
+		raise ValueError('onlyMap requires existing synthetic photometry')
+	catalog = None
+	if not noWriteOutput:
+		# the catalog rows are written as they are computed, and the new
+		# output replaces the existing one once it is complete
+		catalog = openSimulationData(simParams,Mz,gridData,outputDir)
+		_declareCatalog(catalog,gridData,len(photoMap['bandpasses']),
+		                obsPhot=not noPhotoMap,nRealizations=nRealizations)
+	try:
+		if onlyMap:
+			simQSOs = {'synMag':np.array(qsoData['synMag']),
+			           'synFlux':np.array(qsoData['synFlux'])}
+			if writeFeatures:
+				simQSOs['featureHDU'] = _readFeatureHDU(simParams['FileName'],
+				                                        outputDir)
+				if simQSOs['featureHDU'] is None:
+					del simQSOs['featureHDU']
+					writeFeatures = False
+		else:
+			if saveSpectra:
+				specFile = os.path.join(outputDir,
+				                      simParams['FileName']+'_spectra.fits.gz')
+				saveSpectra = SpectraWriter(specFile,wave,Mz.numQSO(),
+				               blockSize=kwargs.get('spectraBlockSize',1000),
+				               nThreads=kwargs.get('spectraThreads',1),
+				               resume=resume)
+			linearScaling = simParams.get('LinearFluxScaling',False)
+			simQSOs = buildQSOspectra(wave,Mz,forest,photoMap,simParams,
+			                        maxIter=simParams.get('maxFeatureIter',3),
+			                        saveSpectra=saveSpectra,
+			                        linearFluxScaling=linearScaling,
+			                        blockSize=kwargs.get('blockSize',100),
+			                        checkpoint=checkpoint,
+			                        checkpointInterval=kwargs.get(
+			                                    'checkpointInterval',600.),
+			                        resume=resume,catalog=catalog)
+		timerLog('Build Quasar Spectra')
+		#
+		# map the simulated photometry to observed values with uncertainties
+		#
+		if not noPhotoMap:
+			print 'mapping photometry'
+			# realizations are drawn along a leading axis
+			rng = _stageRandom(simParams,simParams['PhotoMapParams'],
+			                   'photometry',simQSOs['synFlux'].shape[:-1],
+			                   axis=0 if nRealizations is None else 1)
+			photoData = sqphoto.calcObsPhot(simQSOs['synFlux'],photoMap,
+			                                nRealizations=nRealizations,
+			                                rng=rng)
+			timerLog('PhotoMap')
+		else:
+			photoData = None
+		timerLog.dump()
+		if catalog is not None:
+			gridData['M'] = Mz.mGrid.flatten()
+			_finishCatalog(catalog,gridData,simQSOs,photoData,writeFeatures)
+	except:
+		if catalog is not None:
+			# keep the partial results, and the previous output
+			catalog.abort()
+		raise
+	if catalog is not None:
+		catalog.close()
+	if saveSpectra:
+		simQSOs['spectra'].close()
+	if checkpoint is not None and os.path.exists(checkpoint):
+		os.remove(checkpoint)
+
+# The stages of a simulation, in order, as
+#   stage: (upstream stages, parameters)
+# where the parameters are simParams keys (dotted for nested keys) or the
+# keyword arguments of the run that the stage output depends on.
+simulationStages = OrderedDict([
+  ('wave',     ([],['waveRange','SpecDispersion','DispersionScale'])),
+  ('grid',     ([],['GridParams','Cosmology','RandomSeed','RandomStreams',
+                    'MzGrid'])),
+  ('forest',   (['wave','grid'],['ForestParams','RandomSeed','RandomStreams',
+                                 'ObjectIndexOffset','forestGridFile'])),
+  ('features', (['grid'],['QuasarModelParams','RandomSeed','RandomStreams',
+                          'ObjectIndexOffset'])),
+  ('synphot',  (['wave','forest','features'],
+                ['PhotoMapParams.PhotoSystems','maxFeatureIter',
+                 'LinearFluxScaling','blockSize'])),
+  ('obsphot',  (['synphot'],['PhotoMapParams','RandomSeed','RandomStreams',
+                             'ObjectIndexOffset','nRealizations'])),
+])
+
+def _paramKey(val):
+	'''
+	A string representation of a parameter value that does not change
+	between runs, used to hash the stage parameters. Arrays are hashed,
+	functions are represented by their code, constants, and closures,
+	and objects without a repr by their public attributes.
+	'''
+	if isinstance(val,dict):
+		return '{%s}' % ','.join('%r:%s' % (k,_paramKey(val[k]))
+		                            for k in sorted(val))
+	elif isinstance(val,(list,tuple)):
+		return '[%s]' % ','.join(_paramKey(v) for v in val)
+	elif isinstance(val,np.ndarray):
+		return 'array(%s,%s,%s)' % (val.dtype.str,val.shape,
+		               hashlib.sha1(np.ascontiguousarray(val)).hexdigest())
+	elif val is None or np.isscalar(val):
+		return repr(val)
+	elif hasattr(val,'__code__'):
+		# a function
+		cells = [c.cell_contents for c in (val.__closure__ or [])]
+		return 'function(%s,%s,%s)' % (_paramKey(val.__code__),
+		                               _paramKey(val.__defaults__),
+		                               _paramKey(cells))
+	elif hasattr(val,'co_code'):
+		return 'code(%s,%s,%s)' % (hashlib.sha1(val.co_code).hexdigest(),
+		                           _paramKey(val.co_consts),
+		                           _paramKey(val.co_names))
+	elif type(val).__repr__ is not object.__repr__:
+		return repr(val)
+	elif hasattr(val,'__dict__'):
+		# private attributes are taken to be caches
+		attrs = { k:v for k,v in vars(val).items() if not k.startswith('_') }
+		return '%s.%s(%s)' % (type(val).__module__,type(val).__name__,
+		                      _paramKey(attrs))
+	else:
+		return repr(val)
+
+def stageKeys(simParams,**kwargs):
+	'''
+	The cache key of each stage in simulationStages, a hash of the stage
+	parameters (from simParams, or kwargs for the run arguments) and the
+	keys of the upstream stages. A stage key thus changes whenever any
+	parameter it depends on, directly or through its upstream stages,
+	changes.
+	'''
+	keys = OrderedDict()
+	for stage,(upstream,params) in simulationStages.items():
+		stagePars = {}
+		for name in params:
+			if name in kwargs:
+				val = kwargs[name]
+			else:
+				val = simParams
+				for k in name.split('.'):
+					val = val.get(k) if isinstance(val,dict) else None
+			stagePars[name] = val
+		key = _paramKey([stage,[keys[u] for u in upstream],stagePars])
+		keys[stage] = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+	return keys
+
+# stage outputs held in memory, by cache file name
+_stageStore = {}
+
+class StageCache(object):
+	'''
+	Stored outputs of the simulation stages. The output of a stage is kept
+	in cacheDir as <stage>_<key>.npz, with the key from stageKeys, so that
+	outputs computed with any earlier set of parameters stay valid and 
+	are found again when those parameters are used. The outputs of the
+	stages in keep are also held in memory, where they are found first.
+	'''
+	def __init__(self,cacheDir,keys,keep=()):
+		self.cacheDir = cacheDir
+		self.keys = keys
+		self.keep = keep
+		if not os.path.exists(cacheDir):
+			os.makedirs(cacheDir)
+	def fileName(self,stage,suffix='.npz'):
+		return os.path.join(self.cacheDir,
+		                    '%s_%s%s' % (stage,self.keys[stage],suffix))
+	def load(self,stage):
+		'''The stored output of stage as a dict of arrays, or None.'''
+		fileName = self.fileName(stage)
+		if fileName in _stageStore:
+			print 'stage %s [%s]: in memory' % (stage,self.keys[stage])
+			return dict(_stageStore[fileName])
+		if not os.path.exists(fileName):
+			print 'stage %s [%s]: computing' % (stage,self.keys[stage])
+			return None
+		print 'stage %s [%s]: cached' % (stage,self.keys[stage])
+		arrays = _loadCheckpoint(fileName)
+		if stage in self.keep:
+			_stageStore[fileName] = dict(arrays)
+		return arrays
+	def save(self,stage,**arrays):
+		fileName = self.fileName(stage)
+		_saveCheckpoint(fileName,**arrays)
+		if stage in self.keep:
+			_stageStore[fileName] = arrays
+
+def _gridArrays(Mz):
+	arrays = dict(units=Mz.units,nPerBin=Mz.nPerBin,
+	              mGrid=Mz.mGrid,zGrid=Mz.zGrid)
+	if Mz.units == 'flux':
+		arrays['appMagGrid'] = Mz.appMagGrid
+	return arrays
+
+def _restoreGridArrays(arrays,simParams):
+	'''Rebuild the (M,z) grid stored by _gridArrays.'''
+	gridPars = dict(simParams['GridParams'],nPerBin=int(arrays['nPerBin']))
+	gridData = {'M':arrays['mGrid'].ravel(),'z':arrays['zGrid'].ravel()}
+	if str(arrays['units']) == 'flux':
+		gridData['appMag'] = arrays['appMagGrid'].ravel()
+		Mz = grids.FluxGridFromData(gridData,gridPars,
+		                            simParams.get('Cosmology'))
+		Mz.appMagGrid = arrays['appMagGrid']
+	else:
+		Mz = grids.LuminosityGridFromData(gridData,gridPars,
+		                                  simParams.get('Cosmology'))
+	# keep the shape of the original grid (copied, since mGrid is rescaled
+	# in place and the arrays may be shared between runs)
+	Mz.mGrid = arrays['mGrid'].copy()
+	Mz.zGrid = arrays['zGrid'].copy()
+	return Mz
+
+def qsoSimulationCached(simParams,cacheDir,**kwargs):
+	'''
+	Run a simulation as the sequence of stages in simulationStages, where
+	the output of each stage is stored in cacheDir under a key derived 
+	from its parameters and those of its upstream stages (see stageKeys).
+	A stage is only computed if its output for the current parameters is
+	not in the cache, so when parameters change only the stages that
+	depend on them are rerun. The catalog (and spectra) is then written
+	to outputDir as in qsoSimulation.
+	The continuum and feature grids are rebuilt from their seeds along
+	with the synthetic photometry, which stores the feature values. 
+	A run without a RandomSeed is given one, so that its stages can be
+	reused. Accepts the qsoSimulation keywords saveSpectra,
+	spectraBlockSize, spectraThreads, blockSize, forestOnly, noPhotoMap,
+	noWriteOutput, writeFeatures, nRealizations, outputDir, and MzGrid,
+	and keepStages, the stages whose outputs are also held in memory.
+	'''
+	simParams = deepcopy(simParams)
+	saveSpectra = kwargs.get('saveSpectra',False)
+	outputDir = kwargs.get('outputDir','./')
+	nRealizations = kwargs.get('nRealizations')
+	blockSize = kwargs.get('blockSize',100)
+	if simParams.get('RandomSeed') is None:
+		simParams['RandomSeed'] = np.random.randint(2**31-1)
+	runPars = dict(nRealizations=nRealizations,blockSize=blockSize)
+	Mz = kwargs.get('MzGrid')
+	if Mz is not None:
+		runPars['MzGrid'] = _gridArrays(Mz)
+	forestPars = simParams.get('ForestParams',{})
+	if forestPars.get('ForestType') == 'Grid':
+		gridFile = os.path.join(outputDir,forestPars['FileName']+'.fits.gz')
+		runPars['forestGridFile'] = (gridFile,os.path.getsize(gridFile),
+		                             os.path.getmtime(gridFile))
+	cache = StageCache(cacheDir,stageKeys(simParams,**runPars),
+	                   keep=kwargs.get('keepStages',()))
+	timerLog = TimerLog()
+	wave = buildWaveGrid(simParams)
+	#
+	# (M,z) grid
+	#
+	if Mz is None:
+		arrays = cache.load('grid')
+		if arrays is None:
+			Mz = buildMzGrid(simParams)
+			cache.save('grid',**_gridArrays(Mz))
+		else:
+			Mz = _restoreGridArrays(arrays,simParams)
+	Mz.setCosmology(simParams.get('Cosmology'))
+	gridData = initGridData(simParams,Mz)
+	timerLog('Initialize Grid')
+	#
+	# forest transmission spectra
+	#
+	if 'ForestParams' not in simParams:
+		forest = dict(wave=wave[:2],T=NullForest())
+	else:
+		forest = cache.load('forest')
+		if forest is None:
+			forest = buildForest(wave,Mz.getRedshifts(),simParams,outputDir,
+			                     reuse=False)
+			cache.save('forest',**forest)
+		assert np.allclose(forest['z'],Mz.zGrid.flatten())
+	timerLog('Generate Forest')
+	if kwargs.get('forestOnly',False):
+		timerLog.dump()
+		return
+	#
+	# spectral features and synthetic photometry
+	#
+	photoMap = sqphoto.load_photo_map(simParams['PhotoMapParams'])
+	arrays = cache.load('synphot')
+	specFile = cache.fileName('synphot','_spectra.fits.gz')
+	if arrays is None or ( saveSpectra and not os.path.exists(specFile) ):
+		if saveSpectra:
+			# written under a name unique to this process and then renamed,
+			# as concurrent runs may compute the same stage
+			tmpSpecFile = cache.fileName('synphot',
+			                             '_spectra_%d.fits.gz' % os.getpid())
+			saveSpectra = SpectraWriter(tmpSpecFile,wave,Mz.numQSO(),
+			                   blockSize=kwargs.get('spectraBlockSize',1000),
+			                   nThreads=kwargs.get('spectraThreads',1))
+		linearScaling = simParams.get('LinearFluxScaling',False)
 		simQSOs = buildQSOspectra(wave,Mz,forest,photoMap,simParams,
 		                          maxIter=simParams.get('maxFeatureIter',3),
-		                          saveSpectra=saveSpectra)
+		                          saveSpectra=saveSpectra,
+		                          linearFluxScaling=linearScaling,
+		                          blockSize=blockSize)
+		if saveSpectra:
+			simQSOs['spectra'].close()
+			os.rename(tmpSpecFile,specFile)
+		columns,hdr = _featureColumns(simQSOs)
+		features = np.empty(Mz.zGrid.size,dtype=[ (name,col.dtype,col.shape[1:])
+		                              for name,col in columns.items() ])
+		for name,col in columns.items():
+			features[name] = col
+		cache.save('synphot',synMag=simQSOs['synMag'],
+		           synFlux=simQSOs['synFlux'],mGrid=Mz.mGrid,
+		           features=features,featureHeader=hdr.tostring())
+	else:
+		Mz.mGrid[:] = arrays['mGrid']
+		hdr = fits.Header.fromstring(str(arrays['featureHeader']))
+		featureHDU = fits.BinTableHDU.from_columns(arrays['features'],
+		                                           header=hdr)
+		simQSOs = dict(synMag=arrays['synMag'],synFlux=arrays['synFlux'],
+		               featureHDU=featureHDU)
 	timerLog('Build Quasar Spectra')
 	#
-	# map the simulated photometry to observed values with uncertainties
+	# observed photometry
 	#
-	if not noPhotoMap:
-		print 'mapping photometry'
-		np.random.seed(simParams['PhotoMapParams'].get('RandomSeed',
-		               simParams.get('RandomSeed')))
-		photoData = sqphoto.calcObsPhot(simQSOs['synFlux'],photoMap)
+	photoData = None
+	if not kwargs.get('noPhotoMap',False):
+		photoData = cache.load('obsphot')
+		if photoData is None:
+			rng = _stageRandom(simParams,simParams['PhotoMapParams'],
+			                   'photometry',simQSOs['synFlux'].shape[:-1],
+			                   axis=0 if nRealizations is None else 1)
+			photoData = sqphoto.calcObsPhot(simQSOs['synFlux'],photoMap,
+			                                nRealizations=nRealizations,
+			                                rng=rng)
+			cache.save('obsphot',**photoData)
 		timerLog('PhotoMap')
-	else:
-		photoData = None
 	timerLog.dump()
-	if not noWriteOutput:
+	if not kwargs.get('noWriteOutput',False):
 		gridData['M'] = Mz.mGrid.flatten()
 		writeSimulationData(simParams,Mz,gridData,simQSOs,photoData,
-		                    outputDir,writeFeatures)
-	if saveSpectra:
-		fits.writeto(os.path.join(outputDir,
-		                          simParams['FileName']+'_spectra.fits.gz'),
-		             simQSOs['spectra'],clobber=True)
+		                    outputDir,kwargs.get('writeFeatures',False))
+		if saveSpectra:
+			outFile = os.path.join(outputDir,
+			                       simParams['FileName']+'_spectra.fits.gz')
+			if os.path.exists(outFile):
+				os.remove(outFile)
+			try:
+				os.link(specFile,outFile)
+			except OSError:
+				shutil.copyfile(specFile,outFile)
+
+def _updateParams(params,overrides):
+	'''
+	Copy of params with the values in overrides, where nested dicts are
+	updated rather than replaced.
+	'''
+	params = copy(params)
+	for key,val in overrides.items():
+		if isinstance(val,dict) and isinstance(params.get(key),dict):
+			params[key] = _updateParams(params[key],val)
+		else:
+			params[key] = val
+	return params
+
+# the variant parameters and run arguments of the current sweep, set 
+# before the worker processes are started so that they are inherited
+# rather than pickled
+_sweepRuns = []
+
+def _runSweepVariant(i):
+	simParams,kwargs = _sweepRuns[i]
+	if kwargs.get('MzGrid') is not None:
+		# the grid magnitudes are rescaled in place
+		kwargs = dict(kwargs,MzGrid=deepcopy(kwargs['MzGrid']))
+	qsoSimulationCached(simParams,**kwargs)
+	return simParams['FileName']
+
+def qsoSimulationSweep(simParams,variants,nProc=1,**kwargs):
+	'''
+	Run a simulation for each of a list of variants of simParams, given 
+	as dicts of the parameters to change (nested dicts are merged into
+	those of simParams, so {'QuasarModelParams':{'EmissionLineParams':
+	{'scaleEWs':{...}}}} only changes the line scalings). Each variant
+	is written to its own output files, named by FileName if the variant
+	sets it or by appending _NNN to the FileName of simParams.
+	The runs use the stage cache of qsoSimulationCached, in cacheDir if
+	given or otherwise in a temporary directory. The (M,z) grids and
+	forests of the variants are built once, before the variants are run, 
+	and held in memory, where they are shared with the nProc worker 
+	processes. All variants use the same random seed (picked if simParams
+	does not have one), so they share their grid and forest unless they
+	change the parameters of those stages.
+	Accepts the keywords of qsoSimulationCached, and returns the list of
+	the variant FileNames.
+	'''
+	global _sweepRuns
+	cacheDir = kwargs.pop('cacheDir',None)
+	tmpCache = cacheDir is None
+	if tmpCache:
+		cacheDir = tempfile.mkdtemp(prefix='sqcache_',
+		                            dir=kwargs.get('outputDir','./'))
+	kwargs = dict(kwargs,cacheDir=cacheDir,keepStages=('grid','forest'))
+	if simParams.get('RandomSeed') is None:
+		simParams = dict(simParams,RandomSeed=np.random.randint(2**31-1))
+	runs = []
+	for i,overrides in enumerate(variants):
+		varPars = _updateParams(simParams,overrides)
+		if 'FileName' not in overrides:
+			varPars['FileName'] = '%s_%03d' % (simParams['FileName'],i)
+		runs.append((varPars,kwargs))
+	try:
+		# build the shared stages, once for each distinct forest stage
+		sharedKeys = set()
+		for varPars,_ in runs:
+			keys = stageKeys(varPars)
+			if keys['forest'] not in sharedKeys:
+				sharedKeys.add(keys['forest'])
+				qsoSimulationCached(varPars,**dict(kwargs,forestOnly=True))
+		_sweepRuns = runs
+		if nProc > 1:
+			pool = Pool(nProc)
+			try:
+				fileNames = pool.map(_runSweepVariant,range(len(runs)))
+			finally:
+				pool.close()
+				pool.join()
+		else:
+			fileNames = [ _runSweepVariant(i) for i in range(len(runs)) ]
+	finally:
+		_sweepRuns = []
+		for fileName in list(_stageStore):
+			if fileName.startswith(os.path.join(cacheDir,'')):
+				del _stageStore[fileName]
+		if tmpCache:
+			shutil.rmtree(cacheDir)
+	return fileNames
 
 def generateForestGrid(simParams,**kwargs):
 	forestParams = simParams['ForestParams']
@@ -553,7 +1724,10 @@ def generateForestGrid(simParams,**kwargs):
 	zbins = np.arange(*forestParams['GridzBins'])
 	nlos = forestParams['NumLinesOfSight']
 	timerLog = TimerLog()
-	tgrid = hiforest.generate_grid_spectra(wave,zbins,nlos,**forestParams)
+	streams = forestParams.get('RandomStreams',
+	                           simParams.get('RandomStreams',False))
+	tgrid = hiforest.generate_grid_spectra(wave,zbins,nlos,
+	                            **dict(forestParams,RandomStreams=streams))
 	timerLog('BuildForest')
 	hiforest.save_spectra(tgrid,forestParams['FileName'],outputDir)
 	timerLog.dump()
@@ -0,0 +1,75 @@
+import pytest
+from astropy.cosmology import FlatLambdaCDM
+
+@pytest.fixture
+def simParams():
+	'''A small flux-redshift grid simulation, without a forest.'''
+	return {
+	  'FileName':'testsim',
+	  'waveRange':(3000.,3.0e4),
+	  'SpecDispersion':500,
+	  'Cosmology':FlatLambdaCDM(70,0.3,name='test'),
+	  'RandomSeed':1,
+	  'GridParams':{
+	    'GridType':'FluxRedshiftGrid',
+	    'mRange':(17,22.1,1.),
+	    'zRange':(2.0,3.1,0.5),
+	    'nPerBin':3,
+	    'ObsBand':'SDSS-i',
+	    'RestBand':1450.,
+	  },
+	  'QuasarModelParams':{
+	    'ContinuumParams':{
+	      'ContinuumModel':'GaussianPLawDistribution',
+	      'PowerLawSlopes':[(-1.5,0.3),1100,(-0.5,0.3),
+	                    5700,(-0.37,0.3),9730,(-1.7,0.3),22300,(-1.03,0.3)],
+	    },
+	    'EmissionLineParams':{
+	      'EmissionLineModel':'VariedEmissionLineGrid',
+	      'scaleEWs':{'LyAb':1.1,'LyAn':1.1},
+	    },
+	    'DustExtinctionParams':{
+	      'DustExtinctionModel':'Exponential E(B-V) Distribution',
+	      'DustModelName':'SMC',
+	      'E(B-V)':0.03,
+	    },
+	  },
+	  'PhotoMapParams':{
+	    'PhotoSystems':[('SDSS','Legacy'),('UKIRT','UKIDSS_LAS')],
+	  },
+	}
+
+@pytest.fixture
+def forestParams():
+	'''A few low-resolution sightlines, for use with simParams.'''
+	return {
+	  'FileName':'testsim_forest',
+	  'ForestModel':'Worseck&Prochaska2011',
+	  'zRange':(0.0,3.5),
+	  'ForestType':'Sightlines',
+	  'NumLinesOfSight':5,
+	  'Rmin':3000.,
+	}
+
+@pytest.fixture
+def qlf():
+	'''The BOSS DR9 luminosity function (LEDE model of Ross et al. 2013).'''
+	from simqso import lumfun
+	c1,c2 = -0.689, -0.809
+	logPhiStar = lambda z: -5.83 + c1*(z-2.2)
+	MStar = lambda z: -26.49 + c2*(z-2.2)
+	return lumfun.DoublePowerLawLF(logPhiStar,MStar,-1.31,-3.45)
+
+@pytest.fixture
+def lfSimParams(simParams,qlf):
+	'''simParams with the grid sampled from the luminosity function.'''
+	simParams['GridParams'] = {
+	  'GridType':'LuminosityFunction',
+	  'QLFmodel':qlf,
+	  'QLFargs':{'skyArea':2},
+	  'mRange':(17.0,22.2),
+	  'zRange':(2.0,4.0),
+	  'ObsBand':'SDSS-i',
+	  'RestBand':1450.,
+	}
+	return simParams
@@ -0,0 +1,36 @@
+import numpy as np
+
+from simqso import hiforest,sqbase
+
+def test_voigt_table_grid_length(monkeypatch):
+	# the table is built for the first grid it sees, here the longer one
+	monkeypatch.delattr(hiforest.VoigtTable,'_instance',raising=False)
+	wave = sqbase.fixed_R_dispersion(3500.,4000.,3e4)
+	n = len(wave)//2
+	a = np.array([1e-7,1e-7,1e-7])
+	b = np.array([20.,30.,40.])
+	c_voigt = np.array([0.3,0.5,0.9])
+	# lines within, straddling, and beyond the end of the shorter grid
+	lambda_z = wave[[n-5,n+2,n+50]]
+	tau = {}
+	for npix in [len(wave),n]:
+		tau[npix] = hiforest.fast_sum_of_voigts(wave[:npix],np.zeros(npix),
+		                                        c_voigt,a,lambda_z,b,
+		                                        1e-5,15.,1e10)
+	assert np.all(tau[n] == tau[len(wave)][:n])
+	assert tau[n][-1] > 0
+
+def test_save_spectra(tmpdir):
+	wave = sqbase.fixed_R_dispersion(3500.,4000.,3e3)
+	rs = np.random.RandomState(1)
+	spec = dict(wave=wave,T=rs.rand(4,len(wave)).astype(np.float32),
+	            z=np.array([2.1,2.5,3.0,3.2]),losMap=np.arange(4),
+	            nLOS=2,zbins=np.array([2.0,2.5,3.0]),seed=5,losStreams=True)
+	hiforest.save_spectra(spec,'forest',str(tmpdir))
+	rv = hiforest.load_spectra('forest',str(tmpdir))
+	assert np.allclose(rv['wave'],wave,rtol=1e-10)
+	assert np.array_equal(rv['T'],spec['T'])
+	assert np.array_equal(rv['z'],spec['z'].astype(np.float32))
+	assert np.array_equal(rv['losMap'],spec['losMap'])
+	assert np.array_equal(rv['zbins'],spec['zbins'])
+	assert rv['nLOS'] == 2 and rv['seed'] == 5 and rv['losStreams']
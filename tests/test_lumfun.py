@@ -0,0 +1,137 @@
+import pytest
+import numpy as np
+from scipy.integrate import quad
+from astropy.cosmology import FlatLambdaCDM
+
+from simqso import lumfun,sqbase
+
+cosmo = FlatLambdaCDM(70,0.3)
+m2M = lambda z: sqbase.mag2lum('SDSS-i',1450.,z,cosmo)
+
+def invertLF(qlf,Mrange,z,y,n=3000):
+	# invert the CDF of the LF on a fine grid of magnitudes
+	M = np.linspace(Mrange[0],Mrange[1],n)
+	phi = 10**qlf.logPhi(M,z)
+	cdf = np.concatenate([[0],np.cumsum(0.5*(phi[1:]+phi[:-1]))])
+	return np.interp(y,cdf/cdf[-1],M)
+
+def test_sample_from_fluxrange(qlf):
+	np.random.seed(1)
+	m,z = qlf.sample_from_fluxrange((17,22.2),(2.0,4.0),m2M,cosmo,
+	                                skyArea=5)
+	assert np.all((z >= 2) & (z <= 4) & (m >= 17) & (m <= 22.2))
+	# the magnitude quantiles are the second set of draws
+	np.random.seed(1)
+	y = np.random.random((2,len(z)))[1]
+	ref = np.array([ invertLF(qlf,(22.2-m2M(z[i]),17-m2M(z[i])),z[i],y[i]) 
+	                   for i in range(100) ]) + m2M(z[:100])
+	err = np.abs(m[:100]-ref)
+	assert np.median(err) < 3e-4 and err.max() < 2e-3
+
+def test_integer_parameters():
+	args = ((-28.,-22.),-6.,-26.,-2.,-4.)
+	for k in [0,1]:
+		I = lumfun.integrateDPL(*args,k=k)
+		assert lumfun.integrateDPL((-28,-22),-6,-26,-2,-4,k=k) == I
+	M = np.array([-28,-26,-22])
+	assert np.all(lumfun.cumulativeDPL(M,-6,-26,-2,-4) == 
+	              lumfun.cumulativeDPL(M.astype(float),*args[1:]))
+
+def test_gl_integrate():
+	edges = np.linspace(0,3,7)
+	I = lumfun.glIntegrate(lambda x: np.exp(-x)*np.sin(5*x),edges,epsrel=1e-12)
+	ref = [ quad(lambda x: np.exp(-x)*np.sin(5*x),a,b,epsrel=1e-13)[0]
+	           for a,b in zip(edges[:-1],edges[1:]) ]
+	assert np.allclose(I,ref,rtol=0,atol=1e-12)
+	with pytest.warns(UserWarning):
+		lumfun.glIntegrate(lambda x: np.sin(50*x),edges,epsrel=1e-12,
+		                   maxiter=2)
+
+def test_integrate(qlf):
+	# compare to the scalar quad integration over redshift
+	for mrange,zrange in [((17,22),(2,3)),((15,24),(0.5,5.))]:
+		dVdzdO = lumfun.interp_dVdzdO(zrange,cosmo)
+		Mrange = lambda z: (mrange[0]-m2M(z),mrange[1]-m2M(z))
+		phi_z = lambda z: lumfun.integrateDPL(Mrange(z),*qlf.eval_at_z(z)) * \
+		                        dVdzdO(z)
+		ref = 4*np.pi*quad(phi_z,*zrange,epsrel=1e-10)[0]
+		nqso = qlf.integrate(mrange,zrange,m2M,cosmo,epsrel=1e-10)
+		assert np.abs(nqso/ref-1) < 1e-8
+
+def test_eval_params(qlf):
+	z = np.linspace(0.1,5,37).reshape(1,-1)
+	vals = qlf.eval_params(z)
+	assert vals.shape == (4,)+z.shape
+	ref = np.array([ qlf.eval_at_z(_z) for _z in z.flat ]).T
+	assert np.allclose(vals.reshape(4,-1),ref,rtol=1e-15,atol=0)
+	# linear evolution is interpolated exactly
+	assert np.allclose(qlf.eval_params_cached(z),vals,rtol=1e-13,atol=0)
+	# evolution functions that do not take arrays
+	MStar = lambda z: -26.49 - 0.809*(z-2.2) if z < 3 else -27.3
+	qlf.set_param_evol('MStar',MStar)
+	vals = qlf.eval_params(z)
+	assert np.all(vals[1] == [ MStar(_z) for _z in z.flat ])
+	# and the cache is cleared when the evolution changes
+	assert np.allclose(qlf.eval_params_cached(np.array([4.]))[1],-27.3)
+
+def test_tabulated_dpl_integral():
+	rs = np.random.RandomState(1)
+	a = rs.uniform(0.3,2.5,20)
+	b = rs.uniform(2.6,4.8,20)
+	x = np.sort(10**rs.uniform(-5,4,(20,2)),axis=1)
+	# mixed (a,b) in a single call
+	F = lumfun.tabulatedDPL_Lintegral(x,a[:,None],b[:,None])
+	for i in range(20):
+		f = lambda t: 1/(np.exp((a[i]-1)*t) + np.exp((b[i]-1)*t))
+		ref = quad(f,*np.log(x[i]),epsrel=1e-13,epsabs=0,limit=500)[0]
+		assert np.abs((F[i,1]-F[i,0])/ref-1) < 1e-7
+		Fi = lumfun.tabulatedDPL_Lintegral(x[i],a[i],b[i])
+		assert np.allclose(Fi[1]-Fi[0],F[i,1]-F[i,0],rtol=1e-12,atol=0)
+
+def loopFluxIntervals(qlf,mrange,zbins,Nintervals,nPerBin):
+	# the original per-redshift implementation of sample_at_flux_intervals
+	medges = np.empty((Nintervals+1,len(zbins)))
+	mgrid = np.empty((Nintervals,len(zbins),nPerBin))
+	xedges = np.linspace(0.,1,Nintervals+1)
+	for j,z in enumerate(zbins):
+		Mrange = np.array(mrange[::-1]) - m2M(z)
+		Mbins = np.linspace(Mrange[0],Mrange[1],30)
+		logPhiStar,MStar,alpha,beta = qlf.eval_at_z(z)
+		Lbins = 10**(-0.4*(Mbins-MStar))
+		Lcdf = lumfun.tabulatedDPL_Lintegral(Lbins,-alpha,-beta)
+		Lcdf = (Lcdf-Lcdf[0]) / (Lcdf[-1]-Lcdf[0])
+		medges[:,j] = np.interp(xedges,Lcdf,Mbins)[::-1] + m2M(z)
+		for i in range(Nintervals):
+			x = xedges[i] + (xedges[i+1]-xedges[i])*np.random.random(nPerBin)
+			mgrid[i,j,:] = np.interp(x,Lcdf,Mbins) + m2M(z)
+	return medges,mgrid
+
+def test_sample_at_flux_intervals(qlf):
+	zbins = np.linspace(2.1,3.9,7)
+	np.random.seed(1)
+	medges,mgrid = qlf.sample_at_flux_intervals((17,22.2),zbins,m2M,5,4)
+	np.random.seed(1)
+	refedges,refgrid = loopFluxIntervals(qlf,(17,22.2),zbins,5,4)
+	assert np.allclose(medges,refedges,rtol=0,atol=1e-12)
+	assert np.allclose(mgrid,refgrid,rtol=0,atol=1e-12)
+
+def test_integrate_moment(qlf):
+	# an evolving faint-end slope, on enough redshifts that the integrals
+	# are done by direct quadrature rather than from the tables
+	qlf.set_param_evol('alpha',lambda z: -1.31 - 0.1*(z-2.2))
+	z = np.linspace(0.5,5,50)
+	Mrange = (-30.,-22.)
+	e1450,e912 = qlf.ionizing_emissivity(z,Mrange)
+	c = 4*np.pi*(3.0856775814913673e19)**2
+	for i in range(0,50,7):
+		logPhiStar,MStar,alpha,beta = qlf.eval_at_z(z[i])
+		LStar = c * 10**(-0.4*(MStar+48.6))
+		ref = LStar * lumfun.integrateDPL(Mrange,logPhiStar,MStar,
+		                                  alpha+1,beta+1)
+		assert np.abs(e1450[i]/ref-1) < 1e-8
+		# the number density, against quadrature over M (the integral is
+		# in L, so it is negative for M1 < M2)
+		n = qlf.integrate_moment(z[i],Mrange)
+		ref = quad(lambda M: 10**qlf.logPhi(M,z[i]),*Mrange,epsrel=1e-12)[0]
+		assert np.abs(-n/(ref*1.0857*np.log(10)/2.5)-1) < 1e-8
+	assert np.allclose(e912/e1450,e912[0]/e1450[0],rtol=1e-14)
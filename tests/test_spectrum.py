@@ -0,0 +1,92 @@
+import numpy as np
+
+from simqso import spectrum
+
+
+def loopContinuum(wave,z,slopes,breakpts):
+	# segment-by-segment construction, continuing the last slope to the
+	# end of the spectrum
+	f_lambda = np.zeros_like(wave)
+	f_lambda[0] = 1.0
+	alpha_lams = -(2+np.asarray(slopes))
+	wb = np.searchsorted(wave,np.asarray(breakpts,dtype=np.float32)*(1+z))
+	ii = np.where((wb>0)&(wb<=len(wave)))[0]
+	w1 = 1
+	for alpha_lam,w2 in zip(alpha_lams[ii-1],wb[ii]):
+		f_lambda[w1:w2] = f_lambda[w1-1] * \
+		                     (wave[w1:w2]/wave[w1-1])**alpha_lam
+		w1 = w2
+	f_lambda[w1:] = f_lambda[w1-1] * (wave[w1:]/wave[w1-1])**alpha_lams[-1]
+	return f_lambda
+
+def test_power_law_continuum():
+	wave = 3000*np.exp(np.arange(2000)/500.)
+	breakpts = np.array([0,1100,5700,9730,22300])
+	rng = np.random.RandomState(1)
+	z = rng.uniform(0.5,4,20)
+	slopes = rng.normal(-1,0.5,(20,5))
+	f_lambda = spectrum.powerLawContinuum(wave,z,slopes,breakpts)
+	for k in range(20):
+		ref = loopContinuum(wave,z[k],slopes[k],breakpts)
+		assert np.allclose(f_lambda[k],ref,rtol=1e-12,atol=0)
+		# a single object, and breaks without the leading zero
+		f1 = spectrum.powerLawContinuum(wave,z[k],slopes[k],breakpts[1:])
+		assert np.allclose(f1,ref,rtol=1e-12,atol=0)
+
+def test_line_table_tolerance():
+	dloglam = 1/500.
+	wave = 3000*np.exp(dloglam*np.arange(3000))
+	rng = np.random.RandomState(2)
+	K,N = 50,5
+	lineWave = rng.uniform(3500,20000,(K,N))
+	sigpix = np.exp(rng.uniform(np.log(0.5),np.log(50),(K,N)))
+	sigma = sigpix*lineWave*dloglam
+	# unit peak height
+	eqWidth = np.sqrt(2*np.pi)*sigma
+	for tol in [1e-2,1e-3]:
+		table = spectrum.GaussianLineTable(dloglam,tol)
+		template,exact = table.render(wave,np.ones((K,len(wave))),
+		                              lineWave,eqWidth,sigma)
+		assert not exact.any()
+		for k in range(K):
+			ref = np.sum(np.exp(-0.5*((wave[:,np.newaxis]-lineWave[k])
+			                                             / sigma[k])**2),
+			             axis=1)
+			assert np.abs(template[k]-ref).max() < tol
+
+def renderLines(wave,lineWave,eqWidth,sigma,nsig):
+	# direct evaluation of each line, cut off at nsig sigma
+	template = np.zeros_like(wave)
+	for lw,ew,sig in zip(lineWave,eqWidth,sigma):
+		ii = np.abs(wave-lw) < nsig*sig
+		template[ii] += ew/(np.sqrt(2*np.pi)*sig) * \
+		                  np.exp(-0.5*((wave[ii]-lw)/sig)**2)
+	return template
+
+def test_emission_line_profiles():
+	dloglam = 1/500.
+	wave = 3000*np.exp(dloglam*np.arange(3000))
+	lineWave = np.array([4000.,6000.,20000.])
+	# the last line is too broad for the table
+	sigma = np.array([2.,20.,60.])*lineWave*dloglam
+	eqWidth = np.array([10.,50.,100.])
+	def addLines(**kwargs):
+		spec = spectrum.QSOSpectrum(wave)
+		spec.setRedshift(0.)
+		spec.plcontinuum = np.ones_like(wave)
+		spec.f_lambda = spec.plcontinuum.copy()
+		spec.addEmissionLines((lineWave,eqWidth,sigma),**kwargs)
+		return spec.templates['EmissionLines']
+	# by default the lines are evaluated directly out to 3.5 sigma
+	ref = renderLines(wave,lineWave,eqWidth,sigma,3.5)
+	assert np.allclose(addLines(),ref,rtol=1e-12,atol=1e-15)
+	# table profiles, and the direct fallback, share the table truncation
+	tol = 1e-3
+	nsig = spectrum.getLineTable(dloglam,tol).nsig
+	template = addLines(profiles='kerneltable',tol=tol)
+	ref = renderLines(wave,lineWave,eqWidth,sigma,nsig)
+	peak = eqWidth/(np.sqrt(2*np.pi)*sigma)
+	assert np.abs(template-ref).max() < tol*peak.max()
+	broad = wave > 8000
+	assert np.allclose(template[broad],ref[broad],rtol=1e-12,atol=1e-15)
+	assert np.array_equal(template[broad] > 0,ref[broad] > 0)
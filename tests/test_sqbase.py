@@ -0,0 +1,36 @@
+import numpy as np
+from astropy.cosmology import FlatLambdaCDM,LambdaCDM
+
+from simqso import sqbase
+
+
+def test_rest_frame_template():
+	wave = 3000*np.exp(np.arange(3000)/2000.)
+	restWave = np.linspace(1000.,3000.,500)
+	fun = lambda w: (w/1500.)**-1.5 * (1 + 0.3*np.sin(w/50.))
+	z = np.array([0.5,1.1,2.345,3.0,7.0])
+	# tabulated templates are interpolated linearly in log(wave), and
+	# then again on the fine grid
+	tabfun = lambda w: np.interp(np.log(w),np.log(restWave),fun(restWave))
+	for template,ref,rtol in [(fun,fun,1e-5),(fun(restWave),tabfun,1e-4)]:
+		rft = sqbase.RestFrameTemplate(wave,restWave,template,fill_value=-1)
+		tmpl = rft.get(z)
+		assert tmpl.shape == z.shape+wave.shape
+		for k in range(len(z)):
+			w0 = wave/(1+z[k])
+			# away from the template edges
+			inside = (w0 > restWave[0]+5) & (w0 < restWave[-1]-5)
+			assert np.allclose(tmpl[k,inside],ref(w0[inside]),rtol=rtol)
+			assert np.all(tmpl[k,(w0<restWave[0]-5)|(w0>restWave[-1]+5)]==-1)
+			assert np.array_equal(rft.get(z[k]),tmpl[k])
+
+def test_distance_table():
+	z = np.array([0.01,0.1,0.5,1.,2.,3.5,6.,12.])
+	for cosmo in [FlatLambdaCDM(70,0.3),LambdaCDM(70,0.3,0.6),
+	              LambdaCDM(70,0.3,0.8)]:
+		dt = sqbase.getDistanceTable(cosmo)
+		assert sqbase.getDistanceTable(cosmo) is dt
+		assert np.allclose(dt.distmod(z),cosmo.distmod(z).value,
+		                   rtol=0,atol=1e-6)
+		dV = cosmo.differential_comoving_volume(z).value
+		assert np.allclose(dt.dVdzdO(z),dV,rtol=1e-6,atol=0)
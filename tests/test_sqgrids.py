@@ -0,0 +1,50 @@
+import numpy as np
+from astropy.cosmology import FlatLambdaCDM
+
+from simqso import sqgrids as grids
+
+cosmo = FlatLambdaCDM(70,0.3)
+gridPars = {'mRange':(17,22.1,1.),'zRange':(2.0,4.1,0.5),'nPerBin':7,
+            'ObsBand':'SDSS-i','RestBand':1450.}
+
+def loopCells(mEdges,zEdges,nPerBin):
+	# fill the grid one cell at a time
+	shape = (len(mEdges)-1,len(zEdges)-1,nPerBin)
+	mGrid,zGrid = np.zeros(shape),np.zeros(shape)
+	for i in range(shape[0]):
+		for j in range(shape[1]):
+			binM = mEdges[i] + (mEdges[i+1]-mEdges[i])*np.random.rand(nPerBin)
+			binz = zEdges[j] + (zEdges[j+1]-zEdges[j])*np.random.rand(nPerBin)
+			zi = binz.argsort()
+			mGrid[i,j],zGrid[i,j] = binM[zi],binz[zi]
+	return mGrid,zGrid
+
+def test_sample_cells_matches_loop():
+	np.random.seed(12345)
+	Mz = grids.FluxRedshiftGrid(gridPars,cosmo)
+	after = np.random.rand()
+	np.random.seed(12345)
+	mGrid,zGrid = loopCells(Mz.mEdges,Mz.zEdges,gridPars['nPerBin'])
+	assert np.array_equal(Mz.appMagGrid,mGrid)
+	assert np.array_equal(Mz.zGrid,zGrid)
+	# the random stream is left in the same state
+	assert np.random.rand() == after
+
+def test_iter_blocks():
+	np.random.seed(1)
+	Mz = grids.FluxRedshiftGrid(gridPars,cosmo)
+	n = Mz.numQSO()
+	for kwargs in [{},{'zSorted':True},{'indices':np.arange(3,n,4)}]:
+		ii = []
+		for i,M,z,idx in Mz.iter_blocks(17,**kwargs):
+			assert len(i) <= 17
+			assert np.array_equal(M,Mz.mGrid[idx])
+			assert np.array_equal(z,Mz.zGrid.flat[i])
+			ii.append(i)
+		ii = np.concatenate(ii)
+		if 'indices' in kwargs:
+			assert np.array_equal(ii,kwargs['indices'])
+		else:
+			assert np.array_equal(np.sort(ii),np.arange(n))
+		if kwargs.get('zSorted'):
+			assert np.all(np.diff(Mz.zGrid.flat[ii]) >= 0)
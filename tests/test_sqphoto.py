@@ -0,0 +1,83 @@
+import os
+import shutil
+import numpy as np
+from scipy.integrate import simps
+from astropy.io import fits
+
+from simqso import sqbase,sqphoto
+
+photoParams = {'PhotoSystems':[('SDSS','Legacy'),('UKIRT','UKIDSS_LAS')]}
+
+def test_filter_curves():
+	photoMap = sqphoto.load_photo_map(photoParams)
+	with fits.open(sqphoto.filterCurveFile) as filterdata:
+		for bpName,bp in photoMap['bandpasses'].items():
+			fdat = filterdata[photoMap['filtName'][bpName]].data
+			assert np.all(bp['data'].lam == fdat.lam)
+			assert bp['norm'] == simps(fdat.Rlam/fdat.lam,fdat.lam)
+	# the curves are shared by later photo maps
+	photoMap2 = sqphoto.load_photo_map(photoParams)
+	for b in photoMap['bandpasses']:
+		assert photoMap2['bandpasses'][b]['Rlam'] is \
+		          photoMap['bandpasses'][b]['Rlam']
+
+def test_persisted_filter_curves(tmpdir,monkeypatch):
+	filterFile = str(tmpdir.join('filtercurves.fits'))
+	shutil.copy(sqphoto.filterCurveFile,filterFile)
+	monkeypatch.setattr(sqphoto,'filterCurveFile',filterFile)
+	monkeypatch.setattr(sqphoto,'_filterCurves',{})
+	params = dict(photoParams,PersistFilterCache=True)
+	photoMap = sqphoto.load_photo_map(params)
+	assert os.path.exists(str(tmpdir.join('filtercurves_cache.npz')))
+	# restored from the cache without reading the filter file
+	monkeypatch.setattr(sqphoto,'_filterCurves',{})
+	def fail(*args,**kwargs):
+		raise IOError
+	monkeypatch.setattr(sqphoto.fits,'open',fail)
+	photoMap2 = sqphoto.load_photo_map(params)
+	for b,bp in photoMap['bandpasses'].items():
+		assert np.all(photoMap2['bandpasses'][b]['data'] == bp['data'])
+		assert photoMap2['bandpasses'][b]['norm'] == bp['norm']
+
+def test_photo_cache():
+	photoMap = sqphoto.load_photo_map(photoParams)
+	wave = sqbase.fixed_R_dispersion(3000.,3e4,500)
+	photoCache = sqphoto.getPhotoCache(wave,photoMap)
+	assert sqphoto.getPhotoCache(wave.copy(),photoMap) is photoCache
+	ref = sqphoto._build_photo_cache(wave,photoMap)
+	for b in photoMap['bandpasses']:
+		assert photoCache[b]['ii'] == ref[b]['ii']
+		assert np.all(photoCache[b]['lam_Rlam_dlam'] ==
+		              ref[b]['lam_Rlam_dlam'])
+	# a different grid gets its own entry
+	assert sqphoto.getPhotoCache(wave[1:],photoMap) is not photoCache
+
+class MeanRandom(object):
+	'''Replaces the random draws by their mean values.'''
+	def normal(self,loc=0.0,scale=1.0,size=None):
+		return np.zeros(size) + loc
+	def random_sample(self,size=None):
+		return np.zeros(size) + 0.25
+
+def test_unc_models():
+	# fluxes in nanomaggies from 17th to 23rd mag
+	f = 10**(-0.4*(np.linspace(17,23,20)-22.5))
+	for photSysName,photSystems in sqphoto.supported_photo_systems.items():
+		for survey,photSys in photSystems.items():
+			bands = photSys['bands']
+			uncMap = photSys['uncMap'](bands)
+			fluxes = np.repeat(f[:,None],len(bands),axis=1)
+			df = uncMap(fluxes,MeanRandom())
+			assert df.shape == fluxes.shape
+			np.random.seed(1)
+			dfr = uncMap(np.repeat(fluxes,500,axis=0),np.random)
+			dfr = np.median(dfr.reshape(len(f),500,-1),axis=1)
+			# each band matches the model for that band alone
+			for j,b in enumerate(bands):
+				df1 = photSys['uncMap']([b])(fluxes[:,j:j+1],MeanRandom())
+				assert np.allclose(df[:,j],df1[:,0],rtol=1e-14,atol=0)
+				np.random.seed(2)
+				df1 = photSys['uncMap']([b])(np.repeat(fluxes[:,j:j+1],500,
+				                                       axis=0),np.random)
+				df1 = np.median(df1.reshape(len(f),500),axis=1)
+				assert np.allclose(dfr[:,j],df1,rtol=0.1,atol=0)
@@ -0,0 +1,373 @@
+import os
+from copy import deepcopy
+import pytest
+import numpy as np
+from astropy.io import fits
+
+from simqso import sqrun,sqphoto
+from simqso import sqgrids as grids
+
+
+def buildSpectra(simParams,**kwargs):
+	wave = sqrun.buildWaveGrid(simParams)
+	Mz = sqrun.buildMzGrid(simParams)
+	photoMap = sqphoto.load_photo_map(simParams['PhotoMapParams'])
+	forest = dict(wave=wave[:2],T=sqrun.NullForest())
+	kwargs.setdefault('maxIter',3)
+	simQSOs = sqrun.buildQSOspectra(wave,Mz,forest,photoMap,simParams,
+	                                **kwargs)
+	return Mz,simQSOs
+
+def test_linear_flux_scaling_fixed_shape(simParams):
+	# without luminosity-dependent features the rescaled photometry is
+	# exact: the flux band hits the grid magnitudes and the colors are
+	# those of the rebuilt spectra
+	del simParams['QuasarModelParams']['EmissionLineParams']
+	Mz,simQSOs = buildSpectra(simParams,linearFluxScaling=True)
+	synMag = simQSOs['synMag']
+	assert np.allclose(synMag[...,3],Mz.appMagGrid,atol=1e-8)
+	Mz2,simQSOs2 = buildSpectra(simParams,maxIter=10)
+	colors = np.diff(synMag,axis=-1)
+	colors2 = np.diff(simQSOs2['synMag'],axis=-1)
+	assert np.allclose(colors,colors2,atol=1e-8)
+
+def test_linear_flux_scaling_final_luminosities(simParams):
+	Mz,simQSOs = buildSpectra(simParams,linearFluxScaling=True)
+	assert np.allclose(simQSOs['synMag'][...,3],Mz.appMagGrid,atol=1e-8)
+
+def test_spectra_writer(tmpdir):
+	wave = np.exp(np.linspace(np.log(3000.),np.log(9000.),500))
+	rng = np.random.RandomState(1)
+	spectra = rng.uniform(0.5,1.5,(23,len(wave)))
+	fileName = str(tmpdir.join('spec.fits.gz'))
+	writer = sqrun.SpectraWriter(fileName,wave,25,blockSize=4,nThreads=3)
+	# rows arrive out of order, singly and in blocks, and are overwritten
+	writer[0] = np.zeros(len(wave))
+	writer[np.arange(10,23)] = spectra[10:]
+	for i in range(10):
+		writer[i] = spectra[i]
+	writer.rescale(np.full(25,2.0))
+	writer.close()
+	with fits.open(fileName) as hdus:
+		hdr = hdus[0].header
+		assert hdr['CTYPE1'] == 'LOGWAVE'
+		assert np.allclose(np.exp(hdr['CRVAL1']+hdr['CD1_1']*np.arange(2)),
+		                   wave[:2])
+		assert hdus[0].data.shape == (25,len(wave))
+		assert np.array_equal(hdus[0].data[:23],
+		                      (2*spectra).astype(np.float32))
+		assert np.all(hdus[0].data[23:] == 0)
+		assert np.array_equal(hdus['ROWINDEX'].data['index'],np.arange(23))
+
+def test_dust_attenuation():
+	simParams = dict(waveRange=(3000.,3.0e4),SpecDispersion=500)
+	wave = sqrun.buildWaveGrid(simParams)
+	rng = np.random.RandomState(1)
+	z = rng.uniform(0.5,4,50)
+	E_BmV = rng.exponential(0.1,50)
+	for dustModel in ['SMC','CalzettiSB']:
+		grid = grids.FixedDustGrid(None,z,dustModel,0.1)
+		feature = sqrun.DustExtinctionFeature(grid,wave,(z.min(),z.max()))
+		atten = feature.attenuation(z,E_BmV)
+		for k in range(len(z)):
+			restWave = wave/(1+z[k])
+			ref = grid.dust_fn(restWave,np.ones_like(wave),E_BmV[k])
+			# except the pixel straddling the step in the Calzetti curve
+			ok = np.abs(restWave-6300) > 2*restWave/500.
+			assert np.allclose(atten[k,ok],ref[ok],rtol=3e-5,atol=0)
+
+def test_block_size(simParams):
+	# spectra built in blocks match those built one at a time
+	Mz1,simQSOs1 = buildSpectra(simParams,blockSize=1,saveSpectra=True)
+	for blockSize in [7,100]:
+		Mz,simQSOs = buildSpectra(simParams,blockSize=blockSize,
+		                          saveSpectra=True)
+		assert np.array_equal(Mz.mGrid,Mz1.mGrid)
+		assert np.array_equal(simQSOs['synFlux'],simQSOs1['synFlux'])
+		assert np.array_equal(simQSOs['spectra'],simQSOs1['spectra'])
+
+def test_simulation_chunks(lfSimParams,tmpdir):
+	gridPars = dict(lfSimParams['GridParams'],RandomSeed=5)
+	chunks = list(grids.iterLuminosityFunctionSample(gridPars,
+	                                                 gridPars['QLFmodel'],
+	                                                 lfSimParams['Cosmology'],
+	                                                 100,5,skyArea=2))
+	assert len(chunks) > 1
+	# each chunk is reproduced on its own
+	for k,(m,z) in enumerate(grids.iterLuminosityFunctionSample(gridPars,
+	                                                 gridPars['QLFmodel'],
+	                                                 lfSimParams['Cosmology'],
+	                                                 100,5,skyArea=2)):
+		assert np.array_equal(m,chunks[k][0])
+		assert np.array_equal(z,chunks[k][1])
+	lfSimParams['GridParams'] = dict(gridPars,ChunkSize=100)
+	sqrun.qsoSimulation(lfSimParams,outputDir=str(tmpdir))
+	for k,(m,z) in enumerate(chunks):
+		simData = sqrun.readSimulationData('testsim_%03d' % k,str(tmpdir))
+		assert np.allclose(simData['z'],z,rtol=1e-12)
+		assert np.allclose(simData['appMag'],m,rtol=1e-12)
+	assert not tmpdir.join('testsim_%03d.fits' % len(chunks)).check()
+
+def test_only_map(simParams,tmpdir):
+	sqrun.qsoSimulation(simParams,outputDir=str(tmpdir))
+	ref = sqrun.readSimulationData('testsim',str(tmpdir))
+	ref = { k:np.array(ref[k]) for k in ['synFlux','obsFlux','obsMag'] }
+	# re-mapping the synthetic photometry reproduces the observed values
+	sqrun.qsoSimulation(simParams,outputDir=str(tmpdir),onlyMap=True)
+	simData = sqrun.readSimulationData('testsim',str(tmpdir))
+	for k in ref:
+		assert np.array_equal(simData[k],ref[k])
+	sqrun.qsoSimulation(simParams,outputDir=str(tmpdir),onlyMap=True,
+	                    nRealizations=20)
+	simData = sqrun.readSimulationData('testsim',str(tmpdir))
+	assert np.array_equal(simData['synFlux'],ref['synFlux'])
+	for k in ['obsFlux','obsFluxErr','obsMag','obsMagErr']:
+		assert simData[k].shape == ref['synFlux'].shape+(20,)
+		assert simData[k].dtype.type is np.float32
+	# the realizations scatter about the synthetic fluxes
+	dev = (simData['obsFlux']-simData['synFlux'][...,None]) / \
+	          simData['obsFluxErr']
+	assert np.abs(dev.mean()) < 0.1 and np.abs(dev.std()-1) < 0.1
+
+def test_fits_table_writer(tmpdir):
+	fileName = str(tmpdir.join('tables.fits'))
+	rs = np.random.RandomState(1)
+	data1 = {'z':rs.rand(25),'idx':np.arange(25,dtype=np.int32),
+	         'flag':rs.rand(25)>0.5,'flux':rs.rand(25,3,2).astype(np.float32),
+	         'name':np.array(['q%d' % i for i in range(25)])}
+	data2 = {'slope':rs.randn(7,4)}
+	hdr = fits.Header()
+	hdr['TESTKEY'] = 'value'
+	writer = sqrun.FitsTableWriter(fileName,hdr)
+	ext1 = writer.addTable([('z',np.float64,()),('idx',np.int32,()),
+	                        ('flag',np.bool_,()),('flux',np.float32,(3,2)),
+	                        ('name','S3',())],25)
+	# rows out of order, and the last rows not yet written
+	for i1,i2 in [(10,20),(0,10)]:
+		writer.write(ext1,i1,{k:v[i1:i2] for k,v in data1.items()})
+	# the file is written under a temporary name until it is closed
+	assert not os.path.exists(fileName)
+	tab = fits.getdata(fileName+'.tmp',1)
+	assert np.all(tab['z'][20:] == 0) and np.all(tab['z'][:20] == data1['z'][:20])
+	# a subset of the columns, keeping the others
+	writer.write(ext1,20,{'z':data1['z'][20:]})
+	tab = fits.getdata(fileName+'.tmp',1)
+	assert np.all(tab['z'][20:] == data1['z'][20:]) and np.all(tab['idx'][20:] == 0)
+	writer.write(ext1,20,{k:v[20:] for k,v in data1.items() if k != 'z'})
+	with pytest.raises(KeyError):
+		writer.write(ext1,0,{'zz':data1['z']})
+	ext2 = writer.addTable([('slope',np.float64,(4,))],7,hdr)
+	writer.write(ext2,0,data2)
+	writer.close()
+	with fits.open(fileName) as hdus:
+		assert len(hdus) == 3
+		assert hdus[0].header['TESTKEY'] == 'value'
+		for k,v in data1.items():
+			assert np.array_equal(hdus[1].data[k],v)
+		assert hdus[1].data['flag'].dtype == np.bool_
+		assert np.array_equal(hdus[2].data['slope'],data2['slope'])
+		assert hdus[2].header['TESTKEY'] == 'value'
+	assert not os.path.exists(fileName+'.tmp')
+	# an exception leaves the existing file in place, and the partial one
+	with pytest.raises(ValueError):
+		with sqrun.FitsTableWriter(fileName) as writer:
+			ext = writer.addTable([('z',np.float64,())],5)
+			writer.write(ext,0,{'z':np.ones(2)})
+			writer.write(ext,3,{'z':np.zeros(3)})
+	assert writer._fh.closed
+	with fits.open(fileName) as hdus:
+		assert np.array_equal(hdus[2].data['slope'],data2['slope'])
+	assert np.array_equal(fits.getdata(fileName+'.tmp',1)['z'],[1,1,0,0,0])
+	with sqrun.FitsTableWriter(fileName) as writer:
+		ext = writer.addTable([('z',np.float64,())],5)
+		writer.write(ext,0,{'z':np.ones(5)})
+	assert not os.path.exists(fileName+'.tmp')
+	assert np.array_equal(fits.getdata(fileName,1)['z'],np.ones(5))
+
+def test_simulation_data(tmpdir):
+	rs = np.random.RandomState(2)
+	data1 = {'z':rs.rand(25),'idx':np.arange(25,dtype=np.int32),
+	         'flag':rs.rand(25)>0.5,'flux':rs.rand(25,3,2).astype(np.float32),
+	         'name':np.array(['q%d' % i for i in range(25)]).astype('S3')}
+	data2 = {'slope':rs.randn(7,4)}
+	writer = sqrun.FitsTableWriter(str(tmpdir.join('tables.fits')))
+	ext1 = writer.addTable([('z',np.float64,()),('idx',np.int32,()),
+	                        ('flag',np.bool_,()),('flux',np.float32,(3,2)),
+	                        ('name','S3',())],25)
+	writer.write(ext1,0,data1)
+	ext2 = writer.addTable([('slope',np.float64,(4,))],7)
+	writer.write(ext2,0,data2)
+	writer.close()
+	simData = sqrun.SimulationData('tables',str(tmpdir))
+	assert len(simData) == 25 and 'flag' in simData
+	assert sorted(simData.colnames) == sorted(data1)
+	with fits.open(str(tmpdir.join('tables.fits'))) as hdus:
+		for k,v in data1.items():
+			assert np.array_equal(simData[k],v)
+			ref = hdus[1].data[k]
+			if ref.dtype.kind == 'U':
+				# astropy decodes strings
+				ref = np.char.encode(ref)
+			assert np.array_equal(simData[k],ref)
+			for rows in [(3,9),slice(20,None),np.array([0,7,24])]:
+				rr = slice(*rows) if isinstance(rows,tuple) else rows
+				assert np.array_equal(simData.column(k,rows),v[rr])
+	assert simData['flag'].dtype == np.bool_
+	assert simData['flux'].shape == (25,3,2)
+	tab = simData.read(['z','flag'],rows=(5,10))
+	assert tab.colnames == ['z','flag'] and len(tab) == 5
+	assert np.array_equal(tab['flag'],data1['flag'][5:10])
+	simData2 = sqrun.SimulationData('tables',str(tmpdir),ext=2)
+	assert np.array_equal(simData2['slope'],data2['slope'])
+	with pytest.raises(KeyError):
+		simData['slope']
+
+def test_simulation_data_rewrite(simParams,tmpdir):
+	sqrun.qsoSimulation(simParams,outputDir=str(tmpdir))
+	simData = sqrun.SimulationData('testsim',str(tmpdir))
+	assert simData.gridShape() == (len(simData),)
+	assert simData.params()['GridParams'] == simParams['GridParams']
+	with fits.open(str(tmpdir.join('testsim.fits'))) as hdus:
+		ref = hdus[1].data.copy()
+	for k in simData.colnames:
+		assert np.array_equal(simData[k],ref[k])
+	# columns read before the output is rewritten keep their values
+	obsFlux = simData['obsFlux']
+	sqrun.qsoSimulation(simParams,outputDir=str(tmpdir),onlyMap=True,
+	                    nRealizations=2)
+	assert np.array_equal(obsFlux,ref['obsFlux'])
+	newFlux = sqrun.readSimulationData('testsim',str(tmpdir))['obsFlux']
+	assert newFlux.shape == ref['obsFlux'].shape+(2,)
+
+def test_resume(lfSimParams,tmpdir,monkeypatch):
+	refDir,outDir = str(tmpdir.mkdir('ref')),str(tmpdir.mkdir('out'))
+	lfSimParams['maxFeatureIter'] = 3
+	sqrun.qsoSimulation(lfSimParams,outputDir=refDir,blockSize=10)
+	nQSO = len(sqrun.readSimulationData('testsim',refDir))
+	# interrupt the run partway through the second pass over the grid
+	calcSynPhot = sqphoto.calcSynPhot
+	nCalls = [0]
+	def interrupt(*args,**kwargs):
+		nCalls[0] += 1
+		if nCalls[0] > (nQSO+9)//10 + 3:
+			raise KeyboardInterrupt
+		return calcSynPhot(*args,**kwargs)
+	monkeypatch.setattr(sqphoto,'calcSynPhot',interrupt)
+	with pytest.raises(KeyboardInterrupt):
+		sqrun.qsoSimulation(lfSimParams,outputDir=outDir,blockSize=10,
+		                    checkpoint=True,checkpointInterval=0)
+	assert tmpdir.join('out','testsim_checkpoint.npz').check()
+	# the rows of the completed blocks are on disk, and the output
+	# written before the spectra were built is kept
+	partial = fits.getdata(os.path.join(outDir,'testsim.fits.tmp'),1)
+	assert np.all(np.any(partial['synFlux'] != 0,axis=1))
+	assert np.all(partial['obsFlux'] == 0)
+	assert 'synFlux' not in sqrun.readSimulationData('testsim',outDir).colnames
+	monkeypatch.setattr(sqphoto,'calcSynPhot',calcSynPhot)
+	sqrun.qsoSimulation(lfSimParams,outputDir=outDir,blockSize=10,
+	                    resume=True)
+	assert not tmpdir.join('out','testsim_checkpoint.npz').check()
+	ref = sqrun.readSimulationData('testsim',refDir)
+	simData = sqrun.readSimulationData('testsim',outDir)
+	assert ref.colnames[:3] == ['M','z','appMag']
+	assert ref.colnames == simData.colnames
+	for k in ref.colnames:
+		assert np.array_equal(simData[k],ref[k])
+
+def readTables(outputDir,fileName):
+	# the catalog and feature tables of an output file
+	with fits.open(os.path.join(outputDir,fileName+'.fits')) as hdus:
+		return [ hdus[i].data.copy() for i in (1,2) ]
+
+def runPartition(simParams,outputDir,M,z,i1,i2):
+	# run objects i1:i2 of (M,z) with the object random streams
+	simParams = deepcopy(simParams)
+	simParams.update(FileName='part%d_%d' % (i1,i2),RandomStreams=True,
+	                 ObjectIndexOffset=i1)
+	if 'ForestParams' in simParams:
+		simParams['ForestParams']['FileName'] = simParams['FileName']+'_forest'
+	simParams['GridParams'] = {'GridType':'LuminosityRedshiftGrid',
+	                           'mRange':(-28,-23.9,4.),'zRange':(2.2,3.3,1.),
+	                           'nPerBin':i2-i1,'LumUnits':'M1450'}
+	Mz = grids.LuminosityGridFromData({'M':M[i1:i2],'z':z[i1:i2]},
+	                                  simParams['GridParams'],
+	                                  simParams['Cosmology'])
+	sqrun.qsoSimulation(simParams,outputDir=outputDir,MzGrid=Mz,
+	                    writeFeatures=True,blockSize=3)
+	return readTables(outputDir,simParams['FileName'])
+
+def test_partition_independence(simParams,forestParams,tmpdir):
+	simParams['ForestParams'] = forestParams
+	rs = np.random.RandomState(3)
+	M,z = rs.uniform(-28,-24,12),rs.uniform(2.2,3.2,12)
+	ref = runPartition(simParams,str(tmpdir),M,z,0,12)
+	for i1,i2 in [(0,5),(5,12)]:
+		part = runPartition(simParams,str(tmpdir),M,z,i1,i2)
+		for tab,reftab in zip(part,ref):
+			for name in reftab.names:
+				assert np.array_equal(tab[name],reftab[name][i1:i2])
+
+def test_cached_stages(simParams,forestParams,tmpdir,monkeypatch):
+	simParams['ForestParams'] = forestParams
+	refDir,outDir = str(tmpdir.mkdir('ref')),str(tmpdir.mkdir('out'))
+	cacheDir = str(tmpdir.join('cache'))
+	sqrun.qsoSimulation(simParams,outputDir=refDir,writeFeatures=True)
+	ref = readTables(refDir,'testsim')
+	def check(tables,ref):
+		for tab,reftab in zip(tables,ref):
+			assert tab.names == reftab.names
+			for name in reftab.names:
+				assert np.array_equal(tab[name],reftab[name])
+	sqrun.qsoSimulation(simParams,outputDir=outDir,cacheDir=cacheDir,
+	                    writeFeatures=True)
+	check(readTables(outDir,'testsim'),ref)
+	# a second run loads every stage from the cache
+	def fail(*args,**kwargs):
+		raise AssertionError('stage recomputed')
+	for fn in ['buildMzGrid','buildForest','buildQSOspectra']:
+		monkeypatch.setattr(sqrun,fn,fail)
+	monkeypatch.setattr(sqphoto,'calcObsPhot',fail)
+	sqrun.qsoSimulation(simParams,outputDir=outDir,cacheDir=cacheDir,
+	                    writeFeatures=True)
+	check(readTables(outDir,'testsim'),ref)
+	# changing the photometric noise reruns only the observed photometry
+	monkeypatch.undo()
+	for fn in ['buildMzGrid','buildForest','buildQSOspectra']:
+		monkeypatch.setattr(sqrun,fn,fail)
+	simParams['PhotoMapParams']['RandomSeed'] = 12345
+	sqrun.qsoSimulation(simParams,outputDir=outDir,cacheDir=cacheDir,
+	                    writeFeatures=True)
+	tab,features = readTables(outDir,'testsim')
+	check([features],ref[1:])
+	for name in ['M','z','appMag','synMag','synFlux']:
+		assert np.array_equal(tab[name],ref[0][name])
+	assert not np.array_equal(tab['obsFlux'],ref[0]['obsFlux'])
+
+def test_sweep(simParams,forestParams,tmpdir):
+	simParams['ForestParams'] = forestParams
+	variants = [{'QuasarModelParams':{'EmissionLineParams':
+	                                     {'scaleEWs':{'LyAb':s,'LyAn':s}}}}
+	               for s in (0.8,1.2)]
+	variants.append({'QuasarModelParams':{'DustExtinctionParams':
+	                                         {'E(B-V)':0.1}},
+	                 'FileName':'dusty'})
+	refDir = str(tmpdir.mkdir('ref'))
+	refs = []
+	for i,overrides in enumerate(variants):
+		varPars = sqrun._updateParams(simParams,overrides)
+		varPars['FileName'] = 'ref%d' % i
+		varPars['ForestParams'] = dict(forestParams,FileName='ref%d_forest'%i)
+		sqrun.qsoSimulation(varPars,outputDir=refDir,writeFeatures=True)
+		refs.append(readTables(refDir,varPars['FileName']))
+	for nProc in (1,2):
+		outDir = str(tmpdir.mkdir('out%d' % nProc))
+		names = sqrun.qsoSimulationSweep(simParams,variants,nProc=nProc,
+		                                 outputDir=outDir,writeFeatures=True)
+		assert names == ['testsim_000','testsim_001','dusty']
+		for name,ref in zip(names,refs):
+			for tab,reftab in zip(readTables(outDir,name),ref):
+				for col in reftab.names:
+					assert np.array_equal(tab[col],reftab[col])
+		# the temporary stage cache is removed
+		assert sorted(os.listdir(outDir)) == \
+		          sorted([ name+'.fits' for name in names ])